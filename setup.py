@@ -21,11 +21,29 @@ Because hives are for ants and bees.
     keywords = "database hivedb",
     url = "http://eagain.net/software/snakepit/",
 
+    install_requires = [
+        # needs sqlalchemy.exc and ConnectionProxy
+        'SQLAlchemy >=0.5, <0.7',
+        ],
+
     entry_points = {
         'console_scripts': [
             'snakepit-create-hive = snakepit.cli:create_hive',
             'snakepit-create-dimension = snakepit.cli:create_dimension',
             'snakepit-create-node = snakepit.cli:create_node',
+            'snakepit-update-node = snakepit.cli:update_node',
+            'snakepit-create-replica = snakepit.cli:create_replica',
+            'snakepit-create-resource = snakepit.cli:create_resource',
+            'snakepit-create-secondary = snakepit.cli:create_secondary',
+            'snakepit-collect-statistics = snakepit.cli:collect_statistics',
+            'snakepit-migrate-directory = snakepit.cli:migrate_directory',
+            'snakepit-snapshot-directory = snakepit.cli:snapshot_directory',
+            'snakepit-move-bucket = snakepit.cli:move_bucket',
+            'snakepit-upgrade-hive = snakepit.cli:upgrade_hive',
+            'snakepit-set-read-only = snakepit.cli:set_read_only',
+            'snakepit-add-range = snakepit.cli:add_range',
+            'snakepit-split-range = snakepit.cli:split_range',
+            'snakepit-move-records = snakepit.cli:move_records',
             ],
         },
 
@@ -0,0 +1,33 @@
+"""
+Virtual buckets: partition by hashing values instead of keeping a
+directory of every value.
+
+A dimension created with C{partitioning=snakepit.hive.BUCKET} has a
+fixed number of buckets. Every value belongs to the bucket
+L{bucket_of} says, and the hive only stores which node each bucket is
+on, in C{bucket_metadata}. That mapping is small enough to be cached
+whole with the rest of the hive metadata. Buckets get a node the
+first time a value in them is assigned, and are moved between nodes
+with L{snakepit.create.move_bucket}. Only moves bump the hive
+revision; other processes find the first node of a bucket when they
+miss it.
+"""
+
+import zlib
+
+def bucket_of(dimension_value, bucket_count):
+    """
+    Get the bucket of C{dimension_value}.
+
+    The hash is the same in every process and on every platform,
+    unlike the builtin C{hash}.
+
+    @type bucket_count: int
+
+    @rtype: int
+    """
+    if isinstance(dimension_value, unicode):
+        data = dimension_value.encode('utf-8')
+    else:
+        data = str(dimension_value)
+    return (zlib.crc32(data) & 0xffffffff) % bucket_count
@@ -0,0 +1,1091 @@
+"""
+In-process cache of hive metadata.
+
+Dimensions and nodes change very rarely, so instead of asking the hive
+about them on every routing call, they are loaded in bulk and kept in
+memory. Writers bump C{semaphore_metadata.revision} whenever they
+change the metadata; readers poll that single value to notice when
+their copy is stale.
+
+The C{read_only} flag of the hive comes with the same poll, so
+checking it costs no queries of its own.
+
+By default the poll runs on the calling thread, every
+C{poll_interval} seconds. Long-running processes should call
+C{get_cache(hive_metadata).start()} once at startup, so polls run on a
+background thread and lookups only read memory. Either way, while the
+hive cannot be reached the cached copy keeps being served, and polls
+back off up to C{max_backoff} seconds apart.
+"""
+
+import collections
+import threading
+import time
+import weakref
+
+import sqlalchemy as sq
+
+from snakepit import hive, directory, engines, ranges, singleflight
+
+class Dimension(object):
+    """
+    A cached row of C{partition_dimension_metadata}.
+    """
+
+    def __init__(
+        self,
+        id,
+        name,
+        index_uri,
+        db_type,
+        partitioning=None,
+        bucket_count=None,
+        ):
+        self.id = id
+        self.name = name
+        self.index_uri = index_uri
+        self.db_type = db_type
+        if partitioning is None:
+            partitioning = hive.DIRECTORY
+        self.partitioning = partitioning
+        self.bucket_count = bucket_count
+
+    def __repr__(self):
+        return '<Dimension %d %r>' % (self.id, self.name)
+
+class Node(object):
+    """
+    A cached row of C{node_metadata}.
+
+    @ivar weight: share of new records relative to other nodes
+
+    @type weight: float
+
+    @ivar capacity: most records to place on the node, C{None} for no
+    limit
+
+    @type capacity: int or None
+
+    @ivar replicas: URIs of read replicas of the node
+
+    @type replicas: list of str
+    """
+
+    def __init__(
+        self,
+        id,
+        dimension_id,
+        name,
+        uri,
+        read_only,
+        weight=1.0,
+        capacity=None,
+        replicas=None,
+        ):
+        self.id = id
+        self.dimension_id = dimension_id
+        self.name = name
+        self.uri = uri
+        self.read_only = read_only
+        self.weight = weight
+        self.capacity = capacity
+        if replicas is None:
+            replicas = []
+        self.replicas = replicas
+
+    def __repr__(self):
+        return '<Node %d %r>' % (self.id, self.name)
+
+class Resource(object):
+    """
+    A cached row of C{resource_metadata}.
+    """
+
+    def __init__(
+        self,
+        id,
+        dimension_id,
+        name,
+        db_type,
+        is_partitioning_resource,
+        ):
+        self.id = id
+        self.dimension_id = dimension_id
+        self.name = name
+        self.db_type = db_type
+        self.is_partitioning_resource = is_partitioning_resource
+
+    def __repr__(self):
+        return '<Resource %d %r>' % (self.id, self.name)
+
+class SecondaryIndex(object):
+    """
+    A cached row of C{secondary_index_metadata}.
+    """
+
+    def __init__(self, id, resource_id, column_name, db_type):
+        self.id = id
+        self.resource_id = resource_id
+        self.column_name = column_name
+        self.db_type = db_type
+
+    def __repr__(self):
+        return '<SecondaryIndex %d %r>' % (self.id, self.column_name)
+
+class NodeStatistics(object):
+    """
+    A cached row of C{node_statistics}.
+
+    C{record_count} also counts records assigned by this process since
+    the row was loaded.
+    """
+
+    def __init__(self, node_id, record_count=0, latency=None):
+        self.node_id = node_id
+        self.record_count = record_count
+        self.latency = latency
+
+    def __repr__(self):
+        return '<NodeStatistics %d records=%d latency=%r>' % (
+            self.node_id, self.record_count, self.latency)
+
+def _get_semaphore(hive_metadata):
+    t = hive_metadata.tables['semaphore_metadata']
+    q = sq.select(
+        [
+            t.c.revision,
+            t.c.read_only,
+            ],
+        limit=1,
+        )
+    res = q.execute().fetchone()
+    if res is None:
+        return (0, False)
+    return (res[t.c.revision], bool(res[t.c.read_only]))
+
+def get_revision(hive_metadata):
+    """
+    Get current metadata revision of the hive.
+
+    @return: revision number, 0 if the hive has never been revised
+
+    @rtype: int
+    """
+    (revision, read_only) = _get_semaphore(hive_metadata)
+    return revision
+
+def bump_revision(hive_metadata):
+    """
+    Increment the metadata revision of the hive, and forget the
+    cached metadata.
+
+    See L{snakepit.create.bump_revision}.
+    """
+    t = hive_metadata.tables['semaphore_metadata']
+    r = t.update(values={t.c.revision: t.c.revision+1}).execute()
+    if r.rowcount < 1:
+        # hive created before revisions were tracked
+        t.insert().execute(
+            read_only=False,
+            revision=1,
+            )
+    get_cache(hive_metadata).invalidate()
+
+class HiveMetadataCache(object):
+    """
+    Dimension and node metadata of one hive, kept in memory.
+
+    The revision of the hive is checked at most once every
+    C{poll_interval} seconds; a lookup that misses always checks it,
+    so newly created dimensions and nodes are found right away.
+    Concurrent misses share one check. With L{start}, a background
+    thread does the checking instead; nothing starts it for you.
+
+    A failed poll keeps the cached copy, and the next one waits twice
+    as long, up to C{max_backoff} seconds.
+    """
+
+    def __init__(
+        self,
+        hive_metadata,
+        poll_interval=1.0,
+        statistics_interval=60.0,
+        max_backoff=60.0,
+        ):
+        self.hive_metadata = hive_metadata
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.statistics_interval = statistics_interval
+        self._statistics = {}
+        self._statistics_loaded = None
+        self._lock = threading.Lock()
+        self._revision = None
+        self._generation = 0
+        self._loaded = False
+        self._read_only = False
+        self._next_check = None
+        self._failures = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self._flight = singleflight.SingleFlight()
+        self._dimensions = {}
+        self._nodes = {}
+        self._resources = {}
+        self._secondary_indexes = {}
+        self._bucket_nodes = {}
+        self._tables = {}
+
+    def invalidate(self):
+        """
+        Forget everything, forcing a reload on next access.
+        """
+        self._lock.acquire()
+        try:
+            self._revision = None
+            self._next_check = None
+            # a refresh in flight may have read the old revision
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        t = self.hive_metadata.tables['partition_dimension_metadata']
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.name,
+                t.c.index_uri,
+                t.c.db_type,
+                t.c.partitioning,
+                t.c.bucket_count,
+                ],
+            )
+        dimensions = {}
+        for row in q.execute().fetchall():
+            dimensions[row[t.c.name]] = Dimension(
+                id=row[t.c.id],
+                name=row[t.c.name],
+                index_uri=row[t.c.index_uri],
+                db_type=row[t.c.db_type],
+                partitioning=row[t.c.partitioning],
+                bucket_count=row[t.c.bucket_count],
+                )
+
+        t = self.hive_metadata.tables['node_metadata']
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.partition_dimension_id,
+                t.c.name,
+                t.c.uri,
+                t.c.read_only,
+                t.c.weight,
+                t.c.capacity,
+                ],
+            order_by=[t.c.id],
+            )
+        nodes = {}
+        for row in q.execute().fetchall():
+            weight = row[t.c.weight]
+            if weight is None:
+                weight = 1.0
+            node = Node(
+                id=row[t.c.id],
+                dimension_id=row[t.c.partition_dimension_id],
+                name=row[t.c.name],
+                uri=row[t.c.uri],
+                read_only=bool(row[t.c.read_only]),
+                weight=weight,
+                capacity=row[t.c.capacity],
+                )
+            nodes.setdefault(node.dimension_id, {})[node.id] = node
+
+        t = self.hive_metadata.tables['node_replica_metadata']
+        replicas = {}
+        q = sq.select(
+            [
+                t.c.node_id,
+                t.c.uri,
+                ],
+            order_by=[t.c.id],
+            )
+        for row in q.execute().fetchall():
+            replicas.setdefault(row[t.c.node_id], []).append(row[t.c.uri])
+        for by_id in nodes.values():
+            for node in by_id.values():
+                node.replicas = replicas.get(node.id, [])
+
+        t = self.hive_metadata.tables['resource_metadata']
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.dimension_id,
+                t.c.name,
+                t.c.db_type,
+                t.c.is_partitioning_resource,
+                ],
+            )
+        resources = {}
+        for row in q.execute().fetchall():
+            resources[row[t.c.name]] = Resource(
+                id=row[t.c.id],
+                dimension_id=row[t.c.dimension_id],
+                name=row[t.c.name],
+                db_type=row[t.c.db_type],
+                is_partitioning_resource=bool(
+                    row[t.c.is_partitioning_resource]),
+                )
+
+        t = self.hive_metadata.tables['secondary_index_metadata']
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.resource_id,
+                t.c.column_name,
+                t.c.db_type,
+                ],
+            )
+        secondary_indexes = {}
+        for row in q.execute().fetchall():
+            index = SecondaryIndex(
+                id=row[t.c.id],
+                resource_id=row[t.c.resource_id],
+                column_name=row[t.c.column_name],
+                db_type=row[t.c.db_type],
+                )
+            secondary_indexes[(index.resource_id, index.column_name)] = (
+                index)
+
+        t = self.hive_metadata.tables['bucket_metadata']
+        q = sq.select(
+            [
+                t.c.partition_dimension_id,
+                t.c.bucket,
+                t.c.node_id,
+                ],
+            )
+        bucket_nodes = {}
+        for row in q.execute().fetchall():
+            bucket_nodes.setdefault(
+                row[t.c.partition_dimension_id], {},
+                )[row[t.c.bucket]] = row[t.c.node_id]
+
+        self._dimensions = dimensions
+        self._nodes = nodes
+        self._bucket_nodes = bucket_nodes
+        self._resources = resources
+        self._secondary_indexes = secondary_indexes
+        self._tables = {}
+
+    def refresh(self, force=False):
+        """
+        Reload the metadata if the hive revision has changed.
+
+        A failed check is only raised if C{force} is set or nothing
+        has been loaded yet; otherwise the cached copy is kept, and
+        checks back off.
+
+        @param force: check the revision now, regardless of when it
+        was last checked
+
+        @type force: bool
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if (not force
+                and self._next_check is not None
+                and now < self._next_check):
+                return
+            # other callers keep using the current copy until the
+            # check is done
+            self._next_check = now + self.poll_interval
+            generation = self._generation
+            old_revision = self._revision
+        finally:
+            self._lock.release()
+
+        try:
+            # read the revision before the data, so anything changed
+            # in between is caught by the next poll
+            (revision, read_only) = _get_semaphore(self.hive_metadata)
+            if revision != old_revision:
+                self._load()
+        except sq.exc.SQLAlchemyError:
+            self._lock.acquire()
+            try:
+                self._failures += 1
+                self._next_check = time.time() + min(
+                    self.poll_interval * 2 ** self._failures,
+                    self.max_backoff,
+                    )
+            finally:
+                self._lock.release()
+            if force or not self._loaded:
+                raise
+            return
+
+        self._lock.acquire()
+        try:
+            self._read_only = read_only
+            self._failures = 0
+            self._loaded = True
+            if generation == self._generation:
+                self._revision = revision
+        finally:
+            self._lock.release()
+
+    def is_read_only(self):
+        """
+        Is the hive read-only, as of the last check of its revision?
+
+        Only reads memory while the background thread started with
+        L{start} is running.
+
+        @rtype: bool
+        """
+        if self._thread is None:
+            self.refresh()
+        return self._read_only
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(max(self._next_check - time.time(), 0))
+            if self._stopped.isSet():
+                break
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving what we have; try again next time
+                pass
+
+    def start(self):
+        """
+        Check the revision every C{poll_interval} seconds on a
+        background thread, instead of on lookups.
+
+        Call once when a long-running process starts; until then,
+        lookups do the checking.
+        """
+        if self._thread is not None:
+            return
+        self.refresh(force=True)
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='snakepit-hive-cache',
+            )
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _lookup(self, fn):
+        self.refresh()
+        found = fn()
+        if found is None:
+            self._flight.do('refresh', self._force_refresh)
+            found = fn()
+        return found
+
+    def _force_refresh(self):
+        self.refresh(force=True)
+
+    def get_dimension(self, dimension_name):
+        """
+        Get dimension called C{dimension_name}.
+
+        @rtype: Dimension or None
+        """
+        return self._lookup(
+            lambda: self._dimensions.get(dimension_name))
+
+    def get_dimension_by_id(self, dimension_id):
+        """
+        Get dimension with C{dimension_id}.
+
+        @rtype: Dimension or None
+        """
+        def find():
+            for dimension in self._dimensions.values():
+                if dimension.id == dimension_id:
+                    return dimension
+        return self._lookup(find)
+
+    def get_resource(self, resource_name):
+        """
+        Get resource called C{resource_name}.
+
+        @rtype: Resource or None
+        """
+        return self._lookup(
+            lambda: self._resources.get(resource_name))
+
+    def get_secondary_index(self, resource, column_name):
+        """
+        Get secondary index on C{column_name} of C{resource}.
+
+        @type resource: Resource
+
+        @rtype: SecondaryIndex or None
+        """
+        return self._lookup(
+            lambda: self._secondary_indexes.get(
+                (resource.id, column_name)))
+
+    def get_node(self, dimension, node_id):
+        """
+        Get node with C{node_id} in C{dimension}.
+
+        @type dimension: Dimension
+
+        @rtype: Node or None
+        """
+        return self._lookup(
+            lambda: self._nodes.get(dimension.id, {}).get(node_id))
+
+    def get_node_by_name(self, dimension, node_name):
+        """
+        Get node called C{node_name} in C{dimension}.
+
+        @type dimension: Dimension
+
+        @rtype: Node or None
+        """
+        def find():
+            for node in self._nodes.get(dimension.id, {}).values():
+                if node.name == node_name:
+                    return node
+        return self._lookup(find)
+
+    def get_bucket_node(self, dimension, bucket):
+        """
+        Get id of the node storing C{bucket} of C{dimension}.
+
+        @type dimension: Dimension
+
+        @type bucket: int
+
+        @return: node id, or C{None} if the bucket has no node yet
+
+        @rtype: int or None
+        """
+        self.refresh()
+        found = self._bucket_nodes.get(dimension.id, {}).get(bucket)
+        if found is None:
+            self._flight.do(
+                ('buckets', dimension.id),
+                lambda: self.reload_bucket_nodes(dimension),
+                )
+            found = self._bucket_nodes.get(dimension.id, {}).get(bucket)
+        return found
+
+    def reload_bucket_nodes(self, dimension):
+        """
+        Reload the nodes of the buckets of C{dimension}.
+
+        Giving a bucket its first node does not bump the hive
+        revision, so other processes only learn of it from this.
+
+        @type dimension: Dimension
+        """
+        t = self.hive_metadata.tables['bucket_metadata']
+        q = sq.select(
+            [
+                t.c.bucket,
+                t.c.node_id,
+                ],
+            t.c.partition_dimension_id==dimension.id,
+            )
+        nodes = {}
+        for row in q.execute().fetchall():
+            nodes[row[t.c.bucket]] = row[t.c.node_id]
+        self._lock.acquire()
+        try:
+            bucket_nodes = dict(self._bucket_nodes)
+            bucket_nodes[dimension.id] = nodes
+            self._bucket_nodes = bucket_nodes
+        finally:
+            self._lock.release()
+
+    def get_bucket_nodes(self, dimension):
+        """
+        Get the nodes of all buckets of C{dimension} that have one.
+
+        @type dimension: Dimension
+
+        @return: dict mapping buckets to node ids
+
+        @rtype: dict
+        """
+        self.refresh()
+        return dict(self._bucket_nodes.get(dimension.id, {}))
+
+    def get_nodes(self, dimension):
+        """
+        Get all nodes in C{dimension}, ordered by id.
+
+        @type dimension: Dimension
+
+        @rtype: list of Node
+        """
+        nodes = self._lookup(
+            lambda: self._nodes.get(dimension.id) or None)
+        if nodes is None:
+            return []
+        return [nodes[k] for k in sorted(nodes.keys())]
+
+    def _get_table(self, key, dimension, make_table):
+        table = self._tables.get(key)
+        if table is None:
+            directory_metadata = sq.MetaData()
+            directory_metadata.bind = engines.get_engine(
+                dimension.index_uri)
+            table = make_table(directory_metadata)
+            self._tables[key] = table
+        return table
+
+    def get_primary_table(self, dimension):
+        """
+        Get the primary index table of C{dimension}.
+
+        The table is bound to a shared, pooled engine for the
+        directory database, and kept until the hive metadata changes.
+
+        @type dimension: Dimension
+
+        @rtype: sqlalchemy.Table
+        """
+        return self._get_table(
+            key=('primary', dimension.id),
+            dimension=dimension,
+            make_table=lambda directory_metadata: (
+                directory.get_primary_table(
+                    directory_metadata=directory_metadata,
+                    dimension_name=dimension.name,
+                    db_type=dimension.db_type,
+                    )),
+            )
+
+    def in_hive_database(self, dimension):
+        """
+        Is the directory of C{dimension} stored in the hive database?
+
+        @type dimension: Dimension
+
+        @rtype: bool
+        """
+        url = sq.engine.url.make_url(dimension.index_uri)
+        if (url.drivername == 'sqlite'
+            and url.database in [None, '', ':memory:']):
+            # every in-memory connection is a database of its own
+            return False
+        return url == self.hive_metadata.bind.url
+
+    def get_primary_statements(self, dimension):
+        """
+        Get the compiled routing statements for the primary index
+        table of C{dimension}.
+
+        Compiled once, and kept as long as the table. When the
+        directory is in the hive database, the statements include a
+        lookup joined with C{node_metadata}.
+
+        @type dimension: Dimension
+
+        @rtype: snakepit.directory.PrimaryStatements
+        """
+        key = ('primary_statements', dimension.id)
+        statements = self._tables.get(key)
+        if statements is None:
+            t_primary = self.get_primary_table(dimension)
+            node_table = None
+            if self.in_hive_database(dimension):
+                node_table = t_primary.metadata.tables.get('node_metadata')
+                if node_table is None:
+                    node_table = hive.metadata.tables[
+                        'node_metadata'].tometadata(t_primary.metadata)
+            statements = directory.PrimaryStatements(
+                t_primary,
+                node_table=node_table,
+                dimension_id=dimension.id,
+                tombstone_table=self.get_tombstone_table(dimension),
+                )
+            self._tables[key] = statements
+        return statements
+
+    def get_tombstone_table(self, dimension):
+        """
+        Get the table of values unassigned from the primary index of
+        C{dimension}.
+
+        @type dimension: Dimension
+
+        @rtype: sqlalchemy.Table
+        """
+        t_primary = self.get_primary_table(dimension)
+        return directory.get_tombstone_table(
+            directory_metadata=t_primary.metadata,
+            dimension_name=dimension.name,
+            db_type=dimension.db_type,
+            )
+
+    def get_range_table(self, dimension):
+        """
+        Get the table of ranges of C{dimension}.
+
+        @type dimension: Dimension
+
+        @rtype: sqlalchemy.Table
+        """
+        return self._get_table(
+            key=('range', dimension.id),
+            dimension=dimension,
+            make_table=lambda directory_metadata: (
+                directory.get_range_table(
+                    directory_metadata=directory_metadata,
+                    dimension_name=dimension.name,
+                    db_type=dimension.db_type,
+                    )),
+            )
+
+    def get_ranges(self, dimension):
+        """
+        Get the ranges of C{dimension}, partitioned by range.
+
+        Loaded whole from the range table, and kept until the hive
+        revision changes.
+
+        @type dimension: Dimension
+
+        @rtype: snakepit.ranges.RangeMap
+        """
+        self.refresh()
+        key = ('ranges', dimension.id)
+        range_map = self._tables.get(key)
+        if range_map is None:
+            range_map = self._flight.do(
+                key, lambda: self._load_ranges(dimension, key))
+        return range_map
+
+    def _load_ranges(self, dimension, key):
+        t = self.get_range_table(dimension)
+        q = sq.select(
+            [
+                t.c.low,
+                t.c.high,
+                t.c.node,
+                ],
+            order_by=[t.c.low],
+            )
+        range_map = ranges.RangeMap([
+                ranges.Range(
+                    low=row[t.c.low],
+                    high=row[t.c.high],
+                    node_id=row[t.c.node],
+                    )
+                for row in q.execute().fetchall()
+                ])
+        self._tables[key] = range_map
+        return range_map
+
+    def get_resource_table(self, dimension, resource):
+        """
+        Get the resource index table of C{resource}, in the directory
+        of C{dimension}.
+
+        @type dimension: Dimension
+
+        @type resource: Resource
+
+        @rtype: sqlalchemy.Table
+        """
+        return self._get_table(
+            key=('resource', resource.id),
+            dimension=dimension,
+            make_table=lambda directory_metadata: (
+                directory.get_resource_table(
+                    directory_metadata=directory_metadata,
+                    resource_name=resource.name,
+                    db_type=resource.db_type,
+                    dimension_db_type=dimension.db_type,
+                    )),
+            )
+
+    def get_secondary_table(self, dimension, resource, secondary_index):
+        """
+        Get the table of C{secondary_index} of C{resource}, in the
+        directory of C{dimension}.
+
+        @type dimension: Dimension
+
+        @type resource: Resource
+
+        @type secondary_index: SecondaryIndex
+
+        @rtype: sqlalchemy.Table
+        """
+        return self._get_table(
+            key=('secondary', secondary_index.id),
+            dimension=dimension,
+            make_table=lambda directory_metadata: (
+                directory.get_secondary_table(
+                    directory_metadata=directory_metadata,
+                    resource_name=resource.name,
+                    column_name=secondary_index.column_name,
+                    db_type=secondary_index.db_type,
+                    resource_db_type=resource.db_type,
+                    )),
+            )
+
+    def _load_statistics(self):
+        t = self.hive_metadata.tables['node_statistics']
+        q = sq.select(
+            [
+                t.c.node_id,
+                t.c.record_count,
+                t.c.latency,
+                ],
+            )
+        try:
+            rows = q.execute().fetchall()
+        except sq.exc.DBAPIError:
+            if t.exists():
+                raise
+            # hive from before statistics, see snakepit-upgrade-hive;
+            # place records as if the nodes were empty
+            rows = []
+        statistics = {}
+        for row in rows:
+            statistics[row[t.c.node_id]] = NodeStatistics(
+                node_id=row[t.c.node_id],
+                record_count=row[t.c.record_count],
+                latency=row[t.c.latency],
+                )
+        self._statistics = statistics
+
+    def invalidate_statistics(self):
+        """
+        Reload the statistics on next access.
+        """
+        self._lock.acquire()
+        try:
+            self._statistics_loaded = None
+        finally:
+            self._lock.release()
+
+    def get_statistics(self, node):
+        """
+        Get load statistics of C{node}.
+
+        Statistics are reloaded from the hive at most every
+        C{statistics_interval} seconds. Nodes without collected
+        statistics look empty.
+
+        @type node: Node
+
+        @rtype: NodeStatistics
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if (self._statistics_loaded is None
+                or now - self._statistics_loaded
+                >= self.statistics_interval):
+                self._load_statistics()
+                self._statistics_loaded = now
+            stat = self._statistics.get(node.id)
+            if stat is None:
+                stat = NodeStatistics(node_id=node.id)
+                self._statistics[node.id] = stat
+            return stat
+        finally:
+            self._lock.release()
+
+    def add_records(self, node, count=1):
+        """
+        Count C{count} records assigned to C{node} by this process,
+        until the next reload of the statistics.
+
+        @type node: Node
+        """
+        stat = self.get_statistics(node)
+        self._lock.acquire()
+        try:
+            stat.record_count += count
+        finally:
+            self._lock.release()
+
+class DirectoryCache(object):
+    """
+    Bounded LRU cache of directory lookups.
+
+    Maps keys, typically C{(index_uri, dimension_name, value)}, to
+    node ids, or other directory lookup results. Entries expire after
+    C{ttl} seconds. Lookups that found nothing can be cached too, with
+    the result C{None}, and expire after C{negative_ttl} seconds.
+
+    A lookup of the directory that may race with changes to the same
+    key takes a token with L{begin} before asking, and passes it to
+    L{put}; if the key was changed or evicted in the meantime, the
+    result is dropped instead of overwriting the newer entry.
+
+    @ivar hits: lookups answered from the cache
+
+    @ivar misses: lookups not found in the cache, or expired
+
+    @ivar evictions: entries dropped to stay within C{max_entries}
+    """
+
+    def __init__(
+        self,
+        max_entries=10000,
+        ttl=300.0,
+        negative_ttl=5.0,
+        clock=time.time,
+        ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._lookups = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up C{key}.
+
+        @return: tuple of whether C{key} was found, and the cached
+        node id, C{None} for a cached miss
+
+        @rtype: tuple of (bool, int or None)
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < self.clock():
+                self.misses += 1
+                return (False, None)
+            # reinsert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return (True, entry[0])
+        finally:
+            self._lock.release()
+
+    def begin(self, key):
+        """
+        Start looking up C{key} in the directory.
+
+        Only the latest lookup of a key may store its result; starting
+        another one, or changing or evicting the key, cancels it.
+
+        @return: token to pass to L{put} with the result
+        """
+        token = object()
+        self._lock.acquire()
+        try:
+            self._lookups[key] = token
+        finally:
+            self._lock.release()
+        return token
+
+    def put(self, key, node_id, token=None):
+        """
+        Remember that C{key} is stored on C{node_id}, or that it does
+        not exist if C{node_id} is C{None}.
+
+        @param token: from L{begin}, when C{node_id} is the result of
+        a lookup; C{None} when it is known to be current, for example
+        right after changing the directory, which also cancels
+        lookups in progress
+        """
+        if node_id is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        self._lock.acquire()
+        try:
+            if token is not None and self._lookups.get(key) is not token:
+                # changed since the lookup started; keep the newer
+                return
+            self._lookups.pop(key, None)
+            self._entries.pop(key, None)
+            if ttl <= 0:
+                return
+            self._entries[key] = (node_id, self.clock() + ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def evict(self, key):
+        """
+        Forget C{key}, and cancel lookups of it in progress.
+        """
+        self._lock.acquire()
+        try:
+            self._lookups.pop(key, None)
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Forget everything.
+        """
+        self._lock.acquire()
+        try:
+            self._lookups.clear()
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Get counters for tuning the cache size and TTLs.
+
+        @rtype: dict
+        """
+        return dict(
+            entries=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            )
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def get_cache(hive_metadata):
+    """
+    Get the metadata cache for C{hive_metadata}.
+
+    The cache lives as long as the C{hive_metadata} object itself.
+
+    @rtype: HiveMetadataCache
+    """
+    _caches_lock.acquire()
+    try:
+        cache = _caches.get(hive_metadata)
+        if cache is None:
+            cache = HiveMetadataCache(hive_metadata)
+            _caches[hive_metadata] = cache
+        return cache
+    finally:
+        _caches_lock.release()
@@ -0,0 +1,236 @@
+"""
+Follow changes to the primary index of a dimension.
+
+Every row of C{hive_primary_DIMENSION} carries the time it was
+written in C{last_updated}, and L{snakepit.connect.unassign_node}
+leaves a row in C{hive_tombstone_DIMENSION} for every value it
+removes. Reading both from a point in time tells what has changed
+since, using the indexes on C{last_updated}.
+
+Consumers remember the C{last_updated} of the last change they
+handled, and pass it as C{since} to resume. C{last_updated} is
+stamped by the writer before its transaction commits, so a row can
+become visible after rows with later stamps; to not miss those,
+changes from C{overlap} seconds before C{since} are delivered again.
+The overlap must cover the longest write transaction and the clock
+skew between writers. Applying a change must be idempotent.
+
+Changes are ordered by C{last_updated}, then by value. Tombstones of
+values that are assigned again are left out, so the last change of a
+value always tells its current state. Fencing a value for
+L{snakepit.migration} is a change too, with C{read_only} set.
+"""
+
+import datetime
+import heapq
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect
+
+DEFAULT_BATCH_SIZE = 1000
+
+DEFAULT_OVERLAP = 10.0
+
+class Change(object):
+    """
+    A value assigned to, or unassigned from, a node.
+
+    @ivar id: the dimension value
+
+    @ivar node: id of the node
+
+    @type node: int
+
+    @ivar last_updated: when the change was made
+
+    @type last_updated: datetime.datetime
+
+    @ivar deleted: whether the value was unassigned
+
+    @type deleted: bool
+
+    @ivar read_only: whether the value is fenced off from writers
+    while it is migrated
+
+    @type read_only: bool
+    """
+
+    def __init__(
+        self,
+        id,
+        node,
+        last_updated,
+        deleted=False,
+        read_only=False,
+        ):
+        self.id = id
+        self.node = node
+        self.last_updated = last_updated
+        self.deleted = deleted
+        self.read_only = read_only
+
+    def __repr__(self):
+        if self.deleted:
+            return '<Change %r deleted from %d at %s>' % (
+                self.id, self.node, self.last_updated)
+        return '<Change %r on %d at %s>' % (
+            self.id, self.node, self.last_updated)
+
+def _stream(q, table, since, batch_size, deleted):
+    q = q.order_by(table.c.last_updated, table.c.id)
+    if since is not None:
+        q = q.where(table.c.last_updated >= since)
+    res = q.execute()
+    try:
+        while True:
+            rows = res.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield (row[0], row[1], deleted, row[2], bool(row[3]))
+    finally:
+        res.close()
+
+def iter_changes(
+    hive_metadata,
+    dimension_name,
+    since=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    overlap=DEFAULT_OVERLAP,
+    ):
+    """
+    Get changes to the primary index of C{dimension_name} made at or
+    after C{since}, less C{overlap}.
+
+    The directory is read as it is now: a value assigned and later
+    reassigned shows up once, with its current node.
+
+    @param since: C{last_updated} of the last change already handled,
+    or C{None} for all of the directory
+
+    @type since: datetime.datetime or None
+
+    @param overlap: seconds before C{since} to deliver again
+
+    @type overlap: float
+
+    @return: iterator of lists of at most C{batch_size} changes,
+    ordered by C{last_updated} and value
+
+    @rtype: iterator of lists of Change
+    """
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    if since is not None:
+        since = since - datetime.timedelta(seconds=overlap)
+    t_primary = c.get_primary_table(dimension)
+    t_tombstone = c.get_tombstone_table(dimension)
+    streams = [
+        _stream(
+            q=sq.select(
+                [
+                    t_primary.c.last_updated,
+                    t_primary.c.id,
+                    t_primary.c.node,
+                    t_primary.c.read_only,
+                    ],
+                ),
+            table=t_primary,
+            since=since,
+            batch_size=batch_size,
+            deleted=False,
+            ),
+        _stream(
+            # the row of a value assigned again is newer
+            q=sq.select(
+                [
+                    t_tombstone.c.last_updated,
+                    t_tombstone.c.id,
+                    t_tombstone.c.node,
+                    sq.literal(False),
+                    ],
+                t_primary.c.id==None,
+                from_obj=[
+                    t_tombstone.outerjoin(
+                        t_primary,
+                        t_primary.c.id==t_tombstone.c.id,
+                        ),
+                    ],
+                ),
+            table=t_tombstone,
+            since=since,
+            batch_size=batch_size,
+            deleted=True,
+            ),
+        ]
+    batch = []
+    for (last_updated, id_, deleted, node, read_only) in heapq.merge(
+        *streams):
+        batch.append(
+            Change(
+                id=id_,
+                node=node,
+                last_updated=last_updated,
+                deleted=deleted,
+                read_only=read_only,
+                ),
+            )
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def evict_changed(
+    hive_metadata,
+    dimension_name,
+    since,
+    overlap=DEFAULT_OVERLAP,
+    ):
+    """
+    Drop values of C{dimension_name} changed at or after C{since},
+    less C{overlap}, from the directory cache, if enabled with
+    L{snakepit.connect.configure_directory_cache}.
+
+    Call this periodically to see changes made by other processes
+    sooner than the cache TTL.
+
+    @return: the C{since} to pass next time
+
+    @rtype: datetime.datetime or None
+    """
+    dimension = connect._get_dimension(hive_metadata, dimension_name)
+    for batch in iter_changes(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        since=since,
+        overlap=overlap,
+        ):
+        dir_cache = connect.directory_cache
+        if dir_cache is not None:
+            for change in batch:
+                dir_cache.evict(
+                    connect._directory_cache_key(dimension, change.id))
+        since = batch[-1].last_updated
+    return since
+
+def purge_tombstones(hive_metadata, dimension_name, before):
+    """
+    Forget values unassigned from C{dimension_name} before C{before}.
+
+    Consumers that have not caught up with C{before} by then miss
+    those changes, and have to start over from the beginning.
+
+    @type before: datetime.datetime
+
+    @return: number of tombstones removed
+
+    @rtype: int
+    """
+    dimension = connect._get_dimension(hive_metadata, dimension_name)
+    t = cache.get_cache(hive_metadata).get_tombstone_table(dimension)
+    res = t.delete(t.c.last_updated < before).execute()
+    return res.rowcount
@@ -1,6 +1,10 @@
 import optparse
+import sys
 
-from snakepit import create, connect, directory
+import sqlalchemy as sq
+
+from snakepit import create, connect, directory, statistics, upgrade, snapshot
+from snakepit import hive, cache, migration
 
 def create_hive():
     parser = optparse.OptionParser(
@@ -21,6 +25,17 @@ def create_dimension():
     parser = optparse.OptionParser(
         usage='%prog HIVE_URI DIMENSION_NAME DB_TYPE [DIRECTORY_URI]',
         )
+    parser.add_option(
+        '--buckets',
+        type='int',
+        metavar='COUNT',
+        help='hash values into COUNT buckets, instead of a directory',
+        )
+    parser.add_option(
+        '--ranges',
+        action='store_true',
+        help='store ranges of values on nodes, instead of a directory',
+        )
     (opts, args) = parser.parse_args()
     try:
         (hive_uri, dimension_name, db_type, directory_uri) = args
@@ -34,12 +49,29 @@ def create_dimension():
     if db_type not in directory.DB_TYPES:
         parser.error('Unknown DB_TYPE: %r' % db_type)
 
-    directory_metadata = create.create_primary_index(
-        directory_uri=directory_uri,
-        dimension_name=dimension_name,
-        db_type=db_type,
-        )
-    directory_metadata.bind.dispose()
+    if opts.buckets is not None and opts.ranges:
+        parser.error('--buckets and --ranges are mutually exclusive')
+
+    if opts.ranges:
+        partitioning = hive.RANGE
+        directory_metadata = create.create_range_index(
+            directory_uri=directory_uri,
+            dimension_name=dimension_name,
+            db_type=db_type,
+            )
+        directory_metadata.bind.dispose()
+    elif opts.buckets is None:
+        partitioning = hive.DIRECTORY
+        directory_metadata = create.create_primary_index(
+            directory_uri=directory_uri,
+            dimension_name=dimension_name,
+            db_type=db_type,
+            )
+        directory_metadata.bind.dispose()
+    else:
+        if opts.buckets < 1:
+            parser.error('Bad bucket count: %r' % opts.buckets)
+        partitioning = hive.BUCKET
 
     hive_metadata = connect.get_hive(hive_uri)
     create.create_dimension(
@@ -47,14 +79,37 @@ def create_dimension():
         dimension_name=dimension_name,
         directory_uri=directory_uri,
         db_type=db_type,
+        partitioning=partitioning,
+        bucket_count=opts.buckets,
         )
     hive_metadata.bind.dispose()
 
 
+def _add_node_options(parser):
+    parser.add_option(
+        '--weight',
+        type='float',
+        help='share of new records relative to other nodes',
+        )
+    parser.add_option(
+        '--capacity',
+        type='int',
+        metavar='COUNT',
+        help='place at most COUNT records on the node',
+        )
+
+
 def create_node():
     parser = optparse.OptionParser(
         usage='%prog HIVE_URI DIMENSION_NAME NODE_NAME NODE_URI',
         )
+    parser.add_option(
+        '--read-only',
+        action='store_true',
+        default=False,
+        help='place no new records on the node',
+        )
+    _add_node_options(parser)
     (opts, args) = parser.parse_args()
     try:
         (hive_uri, dimension_name, node_name, node_uri) = args
@@ -62,15 +117,542 @@ def create_node():
         parser.error('missing arguments')
 
     hive_metadata = connect.get_hive(hive_uri)
-    create.create_node(
-        hive_metadata,
-        dimension_name,
-        node_name,
-        node_uri,
+    dimension = cache.get_cache(hive_metadata).get_dimension(dimension_name)
+    if dimension is None:
+        hive_metadata.bind.dispose()
+        parser.error('Unknown dimension: %r' % dimension_name)
+    try:
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension.id,
+            node_name=node_name,
+            node_uri=node_uri,
+            read_only=opts.read_only,
+            weight=opts.weight,
+            capacity=opts.capacity,
+            )
+    except ValueError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def create_replica():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME NODE_NAME REPLICA_URI',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, node_name, replica_uri) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        create.create_replica(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            node_name=node_name,
+            replica_uri=replica_uri,
+            )
+    except create.ReplicaExistsError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def update_node():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME NODE_NAME',
+        )
+    parser.add_option(
+        '--read-only',
+        dest='read_only',
+        action='store_true',
+        help='place no new records on the node',
+        )
+    parser.add_option(
+        '--writable',
+        dest='read_only',
+        action='store_false',
+        help='place new records on the node again',
+        )
+    _add_node_options(parser)
+    parser.add_option(
+        '--no-capacity',
+        action='store_true',
+        default=False,
+        help='remove the limit set with --capacity',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, node_name) = args
+    except ValueError:
+        parser.error('missing arguments')
+    if opts.capacity is not None and opts.no_capacity:
+        parser.error('--capacity and --no-capacity are mutually exclusive')
+
+    kw = {}
+    if opts.read_only is not None:
+        kw['read_only'] = opts.read_only
+    if opts.weight is not None:
+        kw['weight'] = opts.weight
+    if opts.capacity is not None:
+        kw['capacity'] = opts.capacity
+    if opts.no_capacity:
+        kw['capacity'] = None
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        create.update_node(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            node_name=node_name,
+            **kw
+            )
+    except ValueError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def collect_statistics():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        statistics.collect(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            )
+    except connect.UnsupportedPartitioningError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def create_resource():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME RESOURCE_NAME DB_TYPE',
+        )
+    parser.add_option(
+        '--partitioning',
+        action='store_true',
+        default=False,
+        help='resource ids are values of the partition dimension',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, resource_name, db_type) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    if db_type not in directory.DB_TYPES:
+        parser.error('Unknown DB_TYPE: %r' % db_type)
+
+    hive_metadata = connect.get_hive(hive_uri)
+    create.create_resource(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        resource_name=resource_name,
+        db_type=db_type,
+        is_partitioning_resource=opts.partitioning,
+        )
+    hive_metadata.bind.dispose()
+
+
+def create_secondary():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI RESOURCE_NAME COLUMN_NAME DB_TYPE',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, resource_name, column_name, db_type) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    if db_type not in directory.DB_TYPES:
+        parser.error('Unknown DB_TYPE: %r' % db_type)
+
+    hive_metadata = connect.get_hive(hive_uri)
+    create.create_secondary_index(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name=column_name,
+        db_type=db_type,
+        )
+    hive_metadata.bind.dispose()
+
+
+def migrate_directory():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME',
+        )
+    parser.add_option(
+        '--skip-key',
+        action='store_true',
+        default=False,
+        help='do not add the unique index on id, it exists already',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    def report(message):
+        print >>sys.stderr, message
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        upgrade.add_tombstone_table(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            report=report,
+            )
+        if not opts.skip_key:
+            upgrade.add_directory_key(
+                hive_metadata=hive_metadata,
+                dimension_name=dimension_name,
+                report=report,
+                )
+    except upgrade.DuplicateIdsError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def snapshot_directory():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME PATH',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, path) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        count = snapshot.write_snapshot(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            path=path,
+            )
+    except snapshot.UnsupportedDimensionTypeError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+    print >>sys.stderr, '%s: %d ids' % (path, count)
+
+
+def move_bucket():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME BUCKET NODE_NAME',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, bucket, node_name) = args
+    except ValueError:
+        parser.error('missing arguments')
+    try:
+        bucket = int(bucket)
+    except ValueError:
+        parser.error('Bad bucket: %r' % bucket)
+
+    hive_metadata = connect.get_hive(hive_uri)
+    try:
+        create.move_bucket(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            bucket=bucket,
+            node_name=node_name,
+            )
+    except ValueError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def set_read_only():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI',
+        )
+    parser.add_option(
+        '--off',
+        action='store_true',
+        default=False,
+        help='make the hive writable again',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri,) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    hive_metadata = connect.get_hive(hive_uri)
+    create.set_read_only(
+        hive_metadata=hive_metadata,
+        read_only=not opts.off,
+        )
+    hive_metadata.bind.dispose()
+
+
+def upgrade_hive():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri,) = args
+    except ValueError:
+        parser.error('missing arguments')
+
+    def report(message):
+        print >>sys.stderr, message
+
+    hive_metadata = connect.get_hive(hive_uri)
+    upgrade.upgrade_hive(
+        hive_metadata=hive_metadata,
+        report=report,
         )
     hive_metadata.bind.dispose()
 
 
-# TODO
-# create-resource HIVE_URI RESOURCE_NAME
-# create-secondary HIVE_URI RESOURCE_NAME COLUMN_NAME
+def _parse_value(parser, dimension, value):
+    # command line arguments are strings, compare like the database
+    type_ = directory.DB_TYPES[dimension.db_type]
+    try:
+        if issubclass(type_, sq.Integer):
+            return int(value)
+        if issubclass(type_, sq.Float):
+            return float(value)
+    except ValueError:
+        parser.error('Bad %s value: %r' % (dimension.db_type, value))
+    return value
+
+def _get_range_dimension(parser, hive_metadata, dimension_name):
+    dimension = cache.get_cache(hive_metadata).get_dimension(dimension_name)
+    if dimension is None:
+        hive_metadata.bind.dispose()
+        parser.error('Unknown dimension: %r' % dimension_name)
+    return dimension
+
+def add_range():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME NODE_NAME LOW [HIGH]',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, node_name, low, high) = args
+    except ValueError:
+        try:
+            (hive_uri, dimension_name, node_name, low) = args
+        except ValueError:
+            parser.error('missing arguments')
+        high = None
+
+    hive_metadata = connect.get_hive(hive_uri)
+    dimension = _get_range_dimension(parser, hive_metadata, dimension_name)
+    low = _parse_value(parser, dimension, low)
+    if high is not None:
+        high = _parse_value(parser, dimension, high)
+    try:
+        create.add_range(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            low=low,
+            high=high,
+            node_name=node_name,
+            )
+    except (ValueError, create.RangeOverlapError), e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def split_range():
+    parser = optparse.OptionParser(
+        usage='%prog HIVE_URI DIMENSION_NAME AT [NODE_NAME]',
+        )
+    (opts, args) = parser.parse_args()
+    try:
+        (hive_uri, dimension_name, at, node_name) = args
+    except ValueError:
+        try:
+            (hive_uri, dimension_name, at) = args
+        except ValueError:
+            parser.error('missing arguments')
+        node_name = None
+
+    hive_metadata = connect.get_hive(hive_uri)
+    dimension = _get_range_dimension(parser, hive_metadata, dimension_name)
+    at = _parse_value(parser, dimension, at)
+    try:
+        create.split_range(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            at=at,
+            node_name=node_name,
+            )
+    except ValueError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
+
+
+def move_records():
+    parser = optparse.OptionParser(
+        usage=(
+            '%prog HIVE_URI DIMENSION_NAME SOURCE_NODE TARGET_NODE'
+            + ' [VALUE..]\n'
+            + '       %prog --resume=PATH HIVE_URI'),
+        )
+    parser.add_option(
+        '--table',
+        dest='tables',
+        action='append',
+        default=[],
+        metavar='TABLE.COLUMN',
+        help='move rows of node table TABLE by dimension value in COLUMN',
+        )
+    parser.add_option(
+        '--split',
+        action='store_true',
+        default=False,
+        help='move the upper half of the values on SOURCE_NODE',
+        )
+    parser.add_option(
+        '--checkpoint',
+        metavar='PATH',
+        help='record progress in PATH',
+        )
+    parser.add_option(
+        '--resume',
+        metavar='PATH',
+        help='continue the migration recorded in PATH',
+        )
+    parser.add_option(
+        '--batch-size',
+        type='int',
+        default=migration.DEFAULT_BATCH_SIZE,
+        metavar='COUNT',
+        help='move COUNT values at a time',
+        )
+    parser.add_option(
+        '--max-rate',
+        type='float',
+        metavar='RATE',
+        help='move at most RATE values per second',
+        )
+    parser.add_option(
+        '--fence-wait',
+        type='float',
+        default=migration.DEFAULT_FENCE_WAIT,
+        metavar='SECONDS',
+        help='let writers finish for SECONDS after fencing a batch',
+        )
+    parser.add_option(
+        '--cache-ttl',
+        type='float',
+        default=migration.DEFAULT_CACHE_TTL,
+        metavar='SECONDS',
+        help='delete moved records from the source SECONDS later',
+        )
+    parser.add_option(
+        '--no-wait',
+        dest='wait',
+        action='store_false',
+        default=True,
+        help=('return without waiting to delete moved records from'
+              + ' the source, --resume deletes them later'),
+        )
+    (opts, args) = parser.parse_args()
+    if opts.batch_size < 1:
+        parser.error('Bad batch size: %r' % opts.batch_size)
+    if not opts.wait and opts.checkpoint is None and opts.resume is None:
+        parser.error('--no-wait needs --checkpoint')
+
+    def report(message):
+        print >>sys.stderr, message
+
+    if opts.resume is not None:
+        try:
+            (hive_uri,) = args
+        except ValueError:
+            parser.error('missing arguments')
+        hive_metadata = connect.get_hive(hive_uri)
+        try:
+            migration.resume(
+                hive_metadata=hive_metadata,
+                checkpoint=opts.resume,
+                batch_size=opts.batch_size,
+                max_rate=opts.max_rate,
+                report=report,
+                fence_wait=opts.fence_wait,
+                cache_ttl=opts.cache_ttl,
+                wait=opts.wait,
+                )
+        except migration.BadCheckpointError, e:
+            raise SystemExit(str(e))
+        finally:
+            hive_metadata.bind.dispose()
+        return
+
+    if len(args) < 4:
+        parser.error('missing arguments')
+    (hive_uri, dimension_name, source_name, target_name) = args[:4]
+    values = args[4:]
+    if opts.split == bool(values):
+        parser.error('give either --split or values to move')
+    if not opts.tables:
+        parser.error('give at least one --table')
+    tables = []
+    for spec in opts.tables:
+        try:
+            (table_name, column_name) = spec.split('.')
+        except ValueError:
+            parser.error('Bad table: %r' % spec)
+        tables.append((table_name, column_name))
+
+    hive_metadata = connect.get_hive(hive_uri)
+    kw = dict(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        source_name=source_name,
+        target_name=target_name,
+        tables=tables,
+        checkpoint=opts.checkpoint,
+        batch_size=opts.batch_size,
+        max_rate=opts.max_rate,
+        report=report,
+        fence_wait=opts.fence_wait,
+        cache_ttl=opts.cache_ttl,
+        wait=opts.wait,
+        )
+    try:
+        if opts.split:
+            migration.split_node(**kw)
+        else:
+            dimension = cache.get_cache(hive_metadata).get_dimension(
+                dimension_name)
+            if dimension is None:
+                parser.error('Unknown dimension: %r' % dimension_name)
+            migration.move_values(
+                dimension_values=[
+                    _parse_value(parser, dimension, value)
+                    for value in values
+                    ],
+                **kw
+                )
+    except connect.UnsupportedPartitioningError, e:
+        raise SystemExit(str(e))
+    finally:
+        hive_metadata.bind.dispose()
@@ -1,8 +1,8 @@
 import datetime
-import random
 import sqlalchemy as sq
 
-from snakepit import hive, directory
+from snakepit import hive, cache, engines, placement, buckets, reads
+from snakepit import singleflight
 
 class NoSuchDimensionError(Exception):
     """No such dimension"""
@@ -16,12 +16,24 @@ class NoSuchIdError(Exception):
     def __str__(self):
         return ': '.join([self.__doc__]+list(self.args))
 
+class IdReadOnlyError(Exception):
+    """Id is read-only"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
 class NoSuchNodeError(Exception):
     """No such node"""
 
     def __str__(self):
         return ': '.join([self.__doc__]+list(self.args))
 
+class UnsupportedPartitioningError(Exception):
+    """Not possible with the partitioning of the dimension"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
 def get_hive(hive_uri):
     """
     Open hive at C{hive_uri} and return metadata.
@@ -45,7 +57,204 @@ def get_hive(hive_uri):
         table.tometadata(hive_metadata)
     return hive_metadata
 
-def get_engine(hive_metadata, dimension_name, dimension_value):
+directory_cache = None
+
+def configure_directory_cache(
+    max_entries=10000,
+    ttl=300.0,
+    negative_ttl=5.0,
+    ):
+    """
+    Cache directory lookups in this process.
+
+    Once a value is assigned to a node, that assignment rarely
+    changes, so the routing functions can remember it instead of
+    asking the directory every time. Changes made through
+    L{assign_node} and L{unassign_node} in this process update the
+    cache; changes made elsewhere are seen after C{ttl} seconds, or
+    sooner with L{snakepit.changes.evict_changed}. Values fenced by a
+    migration are not cached.
+
+    @param max_entries: maximum number of values to remember, least
+    recently used ones are dropped first
+
+    @type max_entries: int
+
+    @param ttl: seconds to remember a value's node
+
+    @type ttl: float
+
+    @param negative_ttl: seconds to remember that a value is not in
+    the directory, 0 to not remember
+
+    @type negative_ttl: float
+
+    @return: the new cache, for inspecting its counters
+
+    @rtype: snakepit.cache.DirectoryCache
+    """
+    global directory_cache
+    directory_cache = cache.DirectoryCache(
+        max_entries=max_entries,
+        ttl=ttl,
+        negative_ttl=negative_ttl,
+        )
+    return directory_cache
+
+def disable_directory_cache():
+    """
+    Stop caching directory lookups.
+    """
+    global directory_cache
+    directory_cache = None
+
+def _directory_cache_key(dimension, dimension_value):
+    return (dimension.index_uri, dimension.name, dimension_value)
+
+snapshots = {}
+
+def use_snapshot(hive_metadata, dimension_name, snapshot):
+    """
+    Look up values of C{dimension_name} in C{snapshot} before asking
+    the directory.
+
+    Values not in the snapshot are looked up from the directory as
+    usual. Replaces any snapshot used for the dimension before; close
+    the old one yourself.
+
+    A snapshot with a C{follow} method, like
+    L{snakepit.snapshot.Snapshot}, is told to follow the changes to
+    the directory, so it can stop answering for values changed since
+    it was taken.
+
+    @param snapshot: snapshot of the primary index of the dimension,
+    a L{snakepit.replica.DirectoryReplica}, or anything with a
+    compatible C{lookup} method
+
+    @type snapshot: snakepit.snapshot.Snapshot
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    follow = getattr(snapshot, 'follow', None)
+    if follow is not None:
+        follow(hive_metadata, dimension_name)
+    snapshots[(dimension.index_uri, dimension.name)] = snapshot
+
+def drop_snapshot(hive_metadata, dimension_name):
+    """
+    Stop using a snapshot for C{dimension_name}.
+
+    @return: the snapshot that was used, if any
+
+    @rtype: snakepit.snapshot.Snapshot or None
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    return snapshots.pop((dimension.index_uri, dimension.name), None)
+
+def _get_dimension(hive_metadata, dimension_name):
+    dimension = cache.get_cache(hive_metadata).get_dimension(
+        dimension_name)
+    if dimension is None:
+        raise NoSuchDimensionError(repr(dimension_name))
+    return dimension
+
+class HiveReadOnlyError(Exception):
+    """Hive is read-only"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def check_writable(hive_metadata):
+    """
+    Make sure the hive is not read-only for maintenance.
+
+    The flag in C{semaphore_metadata} is read with the cached hive
+    revision, see L{snakepit.cache}, so this usually costs no query.
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    if cache.get_cache(hive_metadata).is_read_only():
+        raise HiveReadOnlyError()
+
+# concurrent lookups of the same value share one directory query
+_lookups = singleflight.SingleFlight()
+
+def _lookup_node(hive_metadata, dimension, dimension_value):
+    # returns node id, None if dimension_value is not in the
+    # directory, node uri, None if not known yet, and whether the
+    # value is read-only; fenced values are never cached, so a hit
+    # is writable
+    key = _directory_cache_key(dimension, dimension_value)
+    dir_cache = directory_cache
+    if dir_cache is not None:
+        (hit, node_id) = dir_cache.get(key)
+        if hit:
+            return (node_id, None, False)
+
+    snapshot = snapshots.get((dimension.index_uri, dimension.name))
+    if snapshot is not None:
+        node_id = snapshot.lookup(dimension_value)
+        if node_id is not None:
+            return (node_id, None, False)
+
+    def query():
+        return _query_node(
+            hive_metadata=hive_metadata,
+            dimension=dimension,
+            dimension_value=dimension_value,
+            key=key,
+            )
+    return _lookups.do(key, query)
+
+def _query_node(hive_metadata, dimension, dimension_value, key):
+    dir_cache = directory_cache
+    token = None
+    if dir_cache is not None:
+        # an assign or unassign finishing while we ask wins
+        token = dir_cache.begin(key)
+    statements = cache.get_cache(hive_metadata).get_primary_statements(
+        dimension)
+    node_id = None
+    node_uri = None
+    read_only = None
+    if statements.lookup_node is not None:
+        # directory is in the hive database, get the node with the
+        # same query
+        res = statements.lookup_node.execute(
+            b_id=dimension_value).fetchone()
+        if res is not None:
+            (node_id, read_only, node_uri) = res
+    else:
+        res = statements.lookup.execute(b_id=dimension_value).fetchone()
+        if res is not None:
+            (node_id, read_only) = res
+
+    if dir_cache is not None:
+        if read_only:
+            # ask again until the migration is done with it
+            dir_cache.evict(key)
+        else:
+            dir_cache.put(key, node_id, token)
+    return (node_id, node_uri, read_only)
+
+class NodeUnavailableError(Exception):
+    """Node is unavailable"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+read_selection = reads.RoundRobinSelection()
+
+def configure_reads(selection):
+    """
+    Choose how replicas are picked for reads.
+
+    @param selection: one of the strategies in L{snakepit.reads}, or
+    anything with a compatible C{pick} method
+    """
+    global read_selection
+    read_selection = selection
+
+def get_engine(hive_metadata, dimension_name, dimension_value, write=True):
     """
     Get node ID of hive node that stores C{dimension_value} for
     C{dimension_name}.
@@ -63,76 +272,335 @@ def get_engine(hive_metadata, dimension_name, dimension_value):
     @type dimension_value: something matching assumptions set by
     partition_dimension_metadata.db_type
 
-    @return: engine connected the the node
+    @param write: C{False} to read from a replica of the node, if it
+    has replicas up, see L{snakepit.reads}; writes are refused while
+    the value is being migrated, see L{snakepit.migration}
+
+    @type write: bool
+
+    @return: engine connected the the node, shared with other
+    callers; do not dispose of it
 
     @rtype: sqlalchemy.engine.Engine
+
+    @raise NodeUnavailableError: the circuit of the node is open,
+    see L{snakepit.health}, and there is no replica to read from
+
+    @raise IdReadOnlyError: C{write} is true, and the value is
+    read-only while it is migrated; try again later
     """
 
-    t = hive_metadata.tables['partition_dimension_metadata']
-    q = sq.select(
-        [
-            t.c.id,
-            t.c.index_uri,
-            ],
-        t.c.name==dimension_name,
-        limit=1,
+    dimension = _get_dimension(hive_metadata, dimension_name)
+
+    read_only = False
+    if dimension.partitioning == hive.BUCKET:
+        node_id = cache.get_cache(hive_metadata).get_bucket_node(
+            dimension,
+            buckets.bucket_of(dimension_value, dimension.bucket_count),
+            )
+        node_uri = None
+    elif dimension.partitioning == hive.RANGE:
+        found = cache.get_cache(hive_metadata).get_ranges(
+            dimension).find(dimension_value)
+        node_id = None
+        if found is not None:
+            node_id = found.node_id
+        node_uri = None
+    else:
+        (node_id, node_uri, read_only) = _lookup_node(
+            hive_metadata, dimension, dimension_value)
+    if node_id is None:
+        raise NoSuchIdError(
+            'dimension %r, dimension_value %r'
+            % (dimension_name, dimension_value),
+            )
+    if write and read_only:
+        raise IdReadOnlyError(
+            'dimension %r, dimension_value %r'
+            % (dimension_name, dimension_value),
+            )
+
+    if node_uri is None or not write:
+        node = cache.get_cache(hive_metadata).get_node(dimension, node_id)
+        if node is None:
+            raise NoSuchNodeError(
+                'dimension %r, node_id %d' % (dimension_name, node_id))
+        if write:
+            node_uri = node.uri
+        else:
+            node_uri = reads.choose(node, read_selection)
+
+    if not engines.allow(node_uri):
+        raise NodeUnavailableError(
+            'dimension %r, node_id %d' % (dimension_name, node_id))
+    return engines.get_engine(node_uri)
+
+def get_connection(
+    hive_metadata,
+    dimension_name,
+    dimension_value,
+    write=True,
+    ):
+    """
+    Check out a connection to the node that stores C{dimension_value}
+    for C{dimension_name}.
+
+    See L{get_engine} for parameters.
+
+    @return: a pooled connection; caller is responsible for returning
+    it to the pool with C{close()}
+
+    @rtype: sqlalchemy.engine.Connection
+    """
+    node_engine = get_engine(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension_value=dimension_value,
+        write=write,
         )
-    res = q.execute().fetchone()
-    if res is None:
-        raise NoSuchDimensionError(repr(dimension_name))
-    partition_id = res[t.c.id]
-    index_uri = res[t.c.index_uri]
+    return node_engine.connect()
 
-    directory_metadata = sq.MetaData()
-    directory_metadata.bind = sq.create_engine(
-        index_uri,
-        strategy='threadlocal',
+BULK_CHUNK_SIZE = 500
+
+def _chunks(values, size):
+    for i in xrange(0, len(values), size):
+        yield values[i:i+size]
+
+def _unique(values):
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+def _group_by_engine(
+    hive_metadata,
+    dimension_name,
+    dimension,
+    node_ids,
+    write,
+    ):
+    c = cache.get_cache(hive_metadata)
+    engine_of = {}
+    by_engine = {}
+    for value, node_id in node_ids:
+        node_engine = engine_of.get(node_id)
+        if node_engine is None:
+            node = c.get_node(dimension, node_id)
+            if node is None:
+                raise NoSuchNodeError(
+                    'dimension %r, node_id %d' % (dimension_name, node_id))
+            if write:
+                node_uri = node.uri
+            else:
+                node_uri = reads.choose(node, read_selection)
+            if not engines.allow(node_uri):
+                raise NodeUnavailableError(
+                    'dimension %r, node_id %d' % (dimension_name, node_id))
+            node_engine = engines.get_engine(node_uri)
+            engine_of[node_id] = node_engine
+        by_engine.setdefault(node_engine, []).append(value)
+    return by_engine
+
+def _get_engines_by_bucket(
+    hive_metadata,
+    dimension_name,
+    dimension,
+    dimension_values,
+    write,
+    ):
+    c = cache.get_cache(hive_metadata)
+    bucket_of = {}
+    for value in dimension_values:
+        bucket_of[value] = buckets.bucket_of(value, dimension.bucket_count)
+    bucket_nodes = c.get_bucket_nodes(dimension)
+    if [bucket for bucket in bucket_of.values()
+        if bucket not in bucket_nodes]:
+        # maybe assigned by someone else since
+        c.reload_bucket_nodes(dimension)
+        bucket_nodes = c.get_bucket_nodes(dimension)
+
+    node_ids = []
+    missing = set()
+    for value in dimension_values:
+        node_id = bucket_nodes.get(bucket_of[value])
+        if node_id is None:
+            missing.add(value)
+        else:
+            node_ids.append((value, node_id))
+    by_engine = _group_by_engine(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension=dimension,
+        node_ids=node_ids,
+        write=write,
         )
-    try:
-        t_primary = directory.get_primary_table(
-            directory_metadata=directory_metadata,
+    return (by_engine, missing)
+
+def _get_engines_by_range(
+    hive_metadata,
+    dimension_name,
+    dimension,
+    dimension_values,
+    write,
+    ):
+    range_map = cache.get_cache(hive_metadata).get_ranges(dimension)
+    node_ids = []
+    missing = set()
+    for value in dimension_values:
+        found = range_map.find(value)
+        if found is None:
+            missing.add(value)
+        else:
+            node_ids.append((value, found.node_id))
+    by_engine = _group_by_engine(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension=dimension,
+        node_ids=node_ids,
+        write=write,
+        )
+    return (by_engine, missing)
+
+def get_engines_bulk(
+    hive_metadata,
+    dimension_name,
+    dimension_values,
+    write=True,
+    ):
+    """
+    Get engines for the nodes storing all of C{dimension_values}.
+
+    The directory is queried with one C{IN (...)} query per
+    C{BULK_CHUNK_SIZE} values, instead of once per value.
+
+    @param hive_metadata: metadata for the hive db, bound to an engine
+
+    @type hive_metadata: sqlalchemy.MetaData
+
+    @param dimension_name: name of the dimension
+
+    @type dimension_name: str
+
+    @param dimension_values: values for this dimension
+
+    @type dimension_values: iterable
+
+    @param write: see L{get_engine}
+
+    @type write: bool
+
+    @return: tuple of a dict mapping engines (shared, do not dispose)
+    to lists of values stored on that node, and a set of the values
+    that are not in the directory
+
+    @rtype: tuple of (dict, set)
+
+    @raise NodeUnavailableError: the circuit of one of the nodes is
+    open, see L{snakepit.health}, and there is no replica to read from
+
+    @raise IdReadOnlyError: C{write} is true, and some of the values
+    are read-only while they are migrated; try again later
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    dimension_values = _unique(dimension_values)
+    if dimension.partitioning == hive.BUCKET:
+        return _get_engines_by_bucket(
+            hive_metadata=hive_metadata,
             dimension_name=dimension_name,
-            db_type='INTEGER',
+            dimension=dimension,
+            dimension_values=dimension_values,
+            write=write,
             )
+    if dimension.partitioning == hive.RANGE:
+        return _get_engines_by_range(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension=dimension,
+            dimension_values=dimension_values,
+            write=write,
+            )
+    t_primary = cache.get_cache(hive_metadata).get_primary_table(
+        dimension)
+
+    dir_cache = directory_cache
+    found = {}
+    if dir_cache is None:
+        uncached = dimension_values
+    else:
+        uncached = []
+        for value in dimension_values:
+            (hit, node_id) = dir_cache.get(
+                _directory_cache_key(dimension, value))
+            if hit:
+                found[value] = node_id
+            else:
+                uncached.append(value)
+
+    snapshot = snapshots.get((dimension.index_uri, dimension.name))
+    if snapshot is not None:
+        not_in_snapshot = []
+        for value in uncached:
+            node_id = snapshot.lookup(value)
+            if node_id is None:
+                not_in_snapshot.append(value)
+            else:
+                found[value] = node_id
+        uncached = not_in_snapshot
+
+    tokens = {}
+    if dir_cache is not None:
+        for value in uncached:
+            tokens[value] = dir_cache.begin(
+                _directory_cache_key(dimension, value))
+
+    fenced = set()
+    for chunk in _chunks(uncached, BULK_CHUNK_SIZE):
         q = sq.select(
             [
+                t_primary.c.id,
                 t_primary.c.node,
+                t_primary.c.read_only,
                 ],
-            t_primary.c.id==dimension_value,
-            limit=1,
+            t_primary.c.id.in_(chunk),
             )
-        res = q.execute().fetchone()
-        if res is None:
-            raise NoSuchIdError(
-                'dimension %r, dimension_value %r'
-                % (dimension_name, dimension_value),
-                )
-        node_id = res[t_primary.c.node]
-    finally:
-        directory_metadata.bind.dispose()
-
-    t = hive_metadata.tables['node_metadata']
-    q = sq.select(
-        [
-            t.c.uri,
-            ],
-        sq.and_(
-            t.c.id==node_id,
-            t.c.partition_dimension_id==partition_id,
-            ),
-        limit=1,
-        )
-    res = q.execute().fetchone()
-    if res is None:
-        raise NoSuchNodeError(
-            'dimension %r, node_id %d' % (dimension_name, node_id))
-    node_uri = res[t.c.uri]
+        for row in q.execute().fetchall():
+            found[row[t_primary.c.id]] = row[t_primary.c.node]
+            if row[t_primary.c.read_only]:
+                fenced.add(row[t_primary.c.id])
 
-    node_engine = sq.create_engine(
-        node_uri,
-        strategy='threadlocal',
+    if dir_cache is not None:
+        for value in uncached:
+            key = _directory_cache_key(dimension, value)
+            if value in fenced:
+                dir_cache.evict(key)
+            else:
+                dir_cache.put(key, found.get(value), tokens[value])
+    if write and fenced:
+        raise IdReadOnlyError(
+            'dimension %r, dimension_values %r'
+            % (dimension_name, sorted(fenced)),
+            )
+
+    node_ids = []
+    missing = set()
+    for value in dimension_values:
+        node_id = found.get(value)
+        if node_id is None:
+            missing.add(value)
+        else:
+            node_ids.append((value, node_id))
+
+    by_engine = _group_by_engine(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension=dimension,
+        node_ids=node_ids,
+        write=write,
         )
-    return node_engine
+    return (by_engine, missing)
 
 class NoNodesForDimensionError(Exception):
     """No nodes found for dimension"""
@@ -140,21 +608,102 @@ class NoNodesForDimensionError(Exception):
     def __str__(self):
         return ': '.join([self.__doc__]+list(self.args))
 
-def _pick_node(hive_metadata, dimension_name, partition_id):
-    t = hive_metadata.tables['node_metadata']
-    q = sq.select(
-        [
-            t.c.id,
-            ],
-        t.c.partition_dimension_id==partition_id,
+class NoWritableNodesError(NoNodesForDimensionError):
+    """All nodes of dimension are read-only, full or unavailable"""
+
+def get_nodes(hive_metadata, dimension_name):
+    """
+    Get all nodes of C{dimension_name}.
+
+    @param hive_metadata: metadata for the hive db, bound to an engine
+
+    @type hive_metadata: sqlalchemy.MetaData
+
+    @param dimension_name: name of the dimension
+
+    @type dimension_name: str
+
+    @return: nodes, ordered by id
+
+    @rtype: list of snakepit.cache.Node
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    return cache.get_cache(hive_metadata).get_nodes(dimension)
+
+placement_strategy = placement.RandomPlacement()
+
+def configure_placement(strategy):
+    """
+    Choose how nodes are picked for new records.
+
+    @param strategy: one of the strategies in L{snakepit.placement},
+    or anything with a compatible C{pick} method
+    """
+    global placement_strategy
+    placement_strategy = strategy
+
+def _pick_node(hive_metadata, dimension_name, dimension, assigned):
+    # assigned counts the records picked for each node id so far, not
+    # committed yet
+    c = cache.get_cache(hive_metadata)
+    nodes = c.get_nodes(dimension)
+    if not nodes:
+        raise NoNodesForDimensionError(repr(dimension_name))
+    def get_statistics(node):
+        stat = c.get_statistics(node)
+        count = assigned.get(node.id)
+        if not count:
+            return stat
+        return cache.NodeStatistics(
+            node_id=stat.node_id,
+            record_count=stat.record_count + count,
+            latency=stat.latency,
+            )
+    nodes = [node for node in nodes if engines.is_available(node.uri)]
+    nodes = placement.writable(nodes, get_statistics)
+    if not nodes:
+        raise NoWritableNodesError(repr(dimension_name))
+    node = placement_strategy.pick(nodes, get_statistics)
+    assigned[node.id] = assigned.get(node.id, 0) + 1
+    return node.id
+
+def _add_records(hive_metadata, dimension, assigned):
+    # count committed assignments
+    c = cache.get_cache(hive_metadata)
+    for node_id, count in assigned.items():
+        node = c.get_node(dimension, node_id)
+        if node is not None:
+            c.add_records(node, count)
+
+def _assign_bucket(hive_metadata, dimension_name, dimension, bucket):
+    c = cache.get_cache(hive_metadata)
+    node_id = c.get_bucket_node(dimension, bucket)
+    if node_id is not None:
+        return node_id
+
+    assigned = {}
+    node_id = _pick_node(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension=dimension,
+        assigned=assigned,
         )
-    res = q.execute().fetchall()
+    t = hive_metadata.tables['bucket_metadata']
     try:
-        res = random.choice(res)
-    except IndexError:
-        raise NoNodesForDimensionError(repr(dimension_name))
-    node_id = res[t.c.id]
-    return node_id
+        t.insert().execute(
+            partition_dimension_id=dimension.id,
+            bucket=bucket,
+            node_id=node_id,
+            )
+    except sq.exc.IntegrityError:
+        # someone else assigned it at the same time; theirs won
+        pass
+    else:
+        _add_records(hive_metadata, dimension, assigned)
+    # no revision bump, which would reload all the hive metadata
+    # everywhere; others find the bucket when they miss it
+    c.reload_bucket_nodes(dimension)
+    return c.get_bucket_node(dimension, bucket)
 
 def assign_node(hive_metadata, dimension_name, dimension_value):
     """
@@ -173,48 +722,50 @@ def assign_node(hive_metadata, dimension_name, dimension_value):
     @type dimension_value: something matching assumptions set by
     partition_dimension_metadata.db_type
 
-    @return: engine connected to node storing C{dimension_value}
+    @return: engine connected to node storing C{dimension_value},
+    shared with other callers; do not dispose of it
 
     @rtype: sqlalchemy.engine.Engine
+
+    @raise NoWritableNodesError: every node is read-only, full or
+    unavailable
+
+    @raise HiveReadOnlyError: the hive is read-only
+
+    @raise IdReadOnlyError: the value is assigned already, and
+    read-only while it is migrated
     """
-    t = hive_metadata.tables['partition_dimension_metadata']
-    q = sq.select(
-        [
-            t.c.id,
-            t.c.index_uri,
-            ],
-        t.c.name==dimension_name,
-        limit=1,
-        )
-    res = q.execute().fetchone()
-    if res is None:
-        raise NoSuchDimensionError(repr(dimension_name))
-    partition_id = res[t.c.id]
-    index_uri = res[t.c.index_uri]
+    check_writable(hive_metadata)
+    dimension = _get_dimension(hive_metadata, dimension_name)
 
-    directory_metadata = sq.MetaData()
-    directory_metadata.bind = sq.create_engine(
-        index_uri,
-        strategy='threadlocal',
-        )
-    t_primary = directory.get_primary_table(
-        directory_metadata=directory_metadata,
-        dimension_name=dimension_name,
-        db_type='INTEGER',
-        )
+    if dimension.partitioning != hive.DIRECTORY:
+        by_engine = assign_nodes_bulk(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_values=[dimension_value],
+            )
+        (node_engine,) = by_engine.keys()
+        return node_engine
+
+    c = cache.get_cache(hive_metadata)
+    t_primary = c.get_primary_table(dimension)
+    statements = c.get_primary_statements(dimension)
 
     def primary_index_get_or_insert(conn):
-        q = sq.select(
-            [t_primary.c.node],
-            t_primary.c.id==dimension_value,
-            bind=conn,
-            for_update=True,
-            )
-        res = q.execute().fetchone()
+        assigned = {}
+        res = conn.execute(
+            statements.lookup_for_update,
+            b_id=dimension_value,
+            ).fetchone()
         if res is not None:
             # it's already in there, we're done!
-            node_id = res[t_primary.c.node]
-            return node_id
+            (node_id, read_only) = res
+            if read_only:
+                raise IdReadOnlyError(
+                    'dimension %r, dimension_value %r'
+                    % (dimension_name, dimension_value),
+                    )
+            return (node_id, assigned)
 
         # node not assigned yet, insert while inside this transaction
         # so the above for_update will hold it locked for us. ugh
@@ -222,48 +773,186 @@ def assign_node(hive_metadata, dimension_name, dimension_value):
         node_id = _pick_node(
             hive_metadata=hive_metadata,
             dimension_name=dimension_name,
-            partition_id=partition_id,
+            dimension=dimension,
+            assigned=assigned,
             )
-        q = sq.insert(
-            t_primary,
-            {
-                t_primary.c.id: dimension_value,
-                t_primary.c.node: node_id,
-                t_primary.c.secondary_index_count: 0,
-                t_primary.c.last_updated: datetime.datetime.now(),
-                t_primary.c.read_only: False,
-                },
-            )        # important to do this within the transaction
-        conn.execute(q)
-        return node_id
+        # important to do this within the transaction
+        conn.execute(
+            statements.insert,
+            id=dimension_value,
+            node=node_id,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        return (node_id, assigned)
 
     try:
-        node_id = directory_metadata.bind.transaction(
+        (node_id, assigned) = t_primary.bind.transaction(
             primary_index_get_or_insert)
-    finally:
-        directory_metadata.bind.dispose()
-
-    t = hive_metadata.tables['node_metadata']
-    q = sq.select(
-        [
-            t.c.uri,
-            ],
-        t.c.id==node_id,
-        limit=1,
-        )
-    res = q.execute().fetchone()
-    if res is None:
+    except sq.exc.IntegrityError:
+        # someone else assigned it at the same time; theirs won
+        (node_id, assigned) = t_primary.bind.transaction(
+            primary_index_get_or_insert)
+    _add_records(hive_metadata, dimension, assigned)
+    dir_cache = directory_cache
+    if dir_cache is not None:
+        dir_cache.put(
+            _directory_cache_key(dimension, dimension_value),
+            node_id,
+            )
+
+    node = cache.get_cache(hive_metadata).get_node(dimension, node_id)
+    if node is None:
         raise RuntimeError(
             'Node disappeared from under us: just added node_id=%r to'
             ' partition dimension %r' % (node_id, dimension_name))
-    node_uri = res[t.c.uri]
 
-    node_engine = sq.create_engine(
-        node_uri,
-        strategy='threadlocal',
-        )
-    return node_engine
+    return engines.get_engine(node.uri)
+
+def assign_nodes_bulk(hive_metadata, dimension_name, dimension_values):
+    """
+    Assign nodes for many values of the dimension, in one transaction.
+
+    Values that already have a node keep it. Existing assignments are
+    found with one C{IN (...)} query per C{BULK_CHUNK_SIZE} values,
+    and the new ones are inserted with one C{executemany} per chunk.
+
+    @param hive_metadata: metadata for the hive db, bound to an engine
+
+    @type hive_metadata: sqlalchemy.MetaData
+
+    @param dimension_name: name of the dimension
+
+    @type dimension_name: str
+
+    @param dimension_values: values for this dimension
+
+    @type dimension_values: iterable
+
+    @return: dict mapping engines (shared, do not dispose) to lists of
+    values stored on that node
+
+    @rtype: dict
+
+    @raise HiveReadOnlyError: the hive is read-only
+
+    @raise IdReadOnlyError: one of the values is assigned already,
+    and read-only while it is migrated
+    """
+    check_writable(hive_metadata)
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    dimension_values = _unique(dimension_values)
+    if dimension.partitioning == hive.BUCKET:
+        node_ids = []
+        for value in dimension_values:
+            node_id = _assign_bucket(
+                hive_metadata=hive_metadata,
+                dimension_name=dimension_name,
+                dimension=dimension,
+                bucket=buckets.bucket_of(value, dimension.bucket_count),
+                )
+            node_ids.append((value, node_id))
+        return _group_by_engine(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension=dimension,
+            node_ids=node_ids,
+            write=True,
+            )
+    if dimension.partitioning == hive.RANGE:
+        # the ranges decide, there is nothing to record
+        (by_engine, missing) = _get_engines_by_range(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension=dimension,
+            dimension_values=dimension_values,
+            write=True,
+            )
+        if missing:
+            raise NoSuchIdError(
+                'dimension %r, dimension_value %r'
+                % (dimension_name, sorted(missing)[0]),
+                )
+        return by_engine
 
+    c = cache.get_cache(hive_metadata)
+    t_primary = c.get_primary_table(dimension)
+    statements = c.get_primary_statements(dimension)
+
+    def primary_index_get_or_insert_many(conn):
+        found = {}
+        fenced = []
+        for chunk in _chunks(dimension_values, BULK_CHUNK_SIZE):
+            q = sq.select(
+                [
+                    t_primary.c.id,
+                    t_primary.c.node,
+                    t_primary.c.read_only,
+                    ],
+                t_primary.c.id.in_(chunk),
+                bind=conn,
+                for_update=True,
+                )
+            for row in q.execute().fetchall():
+                found[row[t_primary.c.id]] = row[t_primary.c.node]
+                if row[t_primary.c.read_only]:
+                    fenced.append(row[t_primary.c.id])
+        if fenced:
+            raise IdReadOnlyError(
+                'dimension %r, dimension_value %r'
+                % (dimension_name, sorted(fenced)[0]),
+                )
+
+        node_ids = []
+        new = []
+        assigned = {}
+        now = datetime.datetime.now()
+        for value in dimension_values:
+            node_id = found.get(value)
+            if node_id is None:
+                node_id = _pick_node(
+                    hive_metadata=hive_metadata,
+                    dimension_name=dimension_name,
+                    dimension=dimension,
+                    assigned=assigned,
+                    )
+                new.append(
+                    dict(
+                        id=value,
+                        node=node_id,
+                        secondary_index_count=0,
+                        last_updated=now,
+                        read_only=False,
+                        ),
+                    )
+            node_ids.append((value, node_id))
+
+        for chunk in _chunks(new, BULK_CHUNK_SIZE):
+            conn.execute(statements.insert, chunk)
+        return (node_ids, assigned)
+
+    try:
+        (node_ids, assigned) = t_primary.bind.transaction(
+            primary_index_get_or_insert_many)
+    except sq.exc.IntegrityError:
+        # someone else assigned some of them at the same time; theirs
+        # won
+        (node_ids, assigned) = t_primary.bind.transaction(
+            primary_index_get_or_insert_many)
+    # only what was committed
+    _add_records(hive_metadata, dimension, assigned)
+    dir_cache = directory_cache
+    if dir_cache is not None:
+        for (value, node_id) in node_ids:
+            dir_cache.put(_directory_cache_key(dimension, value), node_id)
+    return _group_by_engine(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        dimension=dimension,
+        node_ids=node_ids,
+        write=True,
+        )
 
 class NoSuchNodeForDimensionValueError(Exception):
     """Node not found for dimension value"""
@@ -299,65 +988,98 @@ def unassign_node(
     @param node_name: name of the node to remove
 
     @type node_name: str
+
+    @raise UnsupportedPartitioningError: the dimension is partitioned
+    by bucket, and has no per-value assignments
+
+    @raise HiveReadOnlyError: the hive is read-only
     """
-    t = hive_metadata.tables['partition_dimension_metadata']
-    q = sq.select(
-        [
-            t.c.id,
-            t.c.index_uri,
-            ],
-        t.c.name==dimension_name,
-        limit=1,
-        )
-    res = q.execute().fetchone()
-    if res is None:
-        raise NoSuchDimensionError(repr(dimension_name))
-    partition_id = res[t.c.id]
-    index_uri = res[t.c.index_uri]
-
-    t = hive_metadata.tables['node_metadata']
-    q = sq.select(
-        [
-            t.c.id,
-            ],
-        sq.and_(
-            t.c.partition_dimension_id==partition_id,
-            t.c.name==node_name,
-            ),
-        )
-    res = q.execute().fetchone()
-    if not res:
+    check_writable(hive_metadata)
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    if dimension.partitioning != hive.DIRECTORY:
+        raise UnsupportedPartitioningError(
+            'dimension %r, partitioning %s'
+            % (dimension_name, dimension.partitioning))
+
+    node = cache.get_cache(hive_metadata).get_node_by_name(
+        dimension, node_name)
+    if node is None:
         raise NoNodesForDimensionError(repr(dimension_name))
-    node_id = res[t.c.id]
+    node_id = node.id
 
-    directory_metadata = sq.MetaData()
-    directory_metadata.bind = sq.create_engine(
-        index_uri,
-        strategy='threadlocal',
-        )
-    try:
-        t_primary = directory.get_primary_table(
-            directory_metadata=directory_metadata,
-            dimension_name=dimension_name,
-            db_type='INTEGER',
+    c = cache.get_cache(hive_metadata)
+    t_primary = c.get_primary_table(dimension)
+    statements = c.get_primary_statements(dimension)
+
+    def primary_index_delete(conn):
+        # TODO secondary_index_count==0?
+        # TODO read_only==False?
+        res = conn.execute(
+            statements.delete,
+            b_id=dimension_value,
+            b_node=node_id,
             )
-        q = t_primary.delete(
-            sq.and_(
-                t_primary.c.id==dimension_value,
-                t_primary.c.node==node_id,
-                # TODO t_primary.c.secondary_index_count==0?
-                # TODO t_primary.c.read_only==False?
+        if res.rowcount > 0:
+            # leave a trace for snakepit.changes
+            conn.execute(
+                statements.insert_tombstone,
+                id=dimension_value,
+                node=node_id,
+                last_updated=datetime.datetime.now(),
+                )
+        return res.rowcount
+
+    rowcount = t_primary.bind.transaction(primary_index_delete)
+    dir_cache = directory_cache
+    if dir_cache is not None:
+        dir_cache.evict(_directory_cache_key(dimension, dimension_value))
+    if rowcount < 1:
+        raise NoSuchNodeForDimensionValueError(
+            'dimension %r value %r, node name %r'
+            % (
+                dimension_name,
+                dimension_value,
+                node_name,
                 ),
             )
-        res = q.execute()
-        if res.rowcount < 1:
-            raise NoSuchNodeForDimensionValueError(
-                'dimension %r value %r, node name %r'
-                % (
-                    dimension_name,
-                    dimension_value,
-                    node_name,
-                    ),
-                )
-    finally:
-        directory_metadata.bind.dispose()
+
+def get_engines_for_range(hive_metadata, dimension_name, low, high):
+    """
+    Get engines for the nodes storing values of C{dimension_name}
+    from C{low} up to, but not including, C{high}.
+
+    Only the nodes with values in the interval are returned, so a
+    query over the interval needs to run on those only.
+
+    @param high: end of the interval, C{None} for unbounded
+
+    @return: dict mapping engines (shared, do not dispose) to lists
+    of the C{(low, high)} parts of the interval on that node, in
+    order
+
+    @rtype: dict
+
+    @raise UnsupportedPartitioningError: the dimension is not
+    partitioned by range
+
+    @raise ValueError: the interval is empty
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    if dimension.partitioning != hive.RANGE:
+        raise UnsupportedPartitioningError(
+            'dimension %r, partitioning %s'
+            % (dimension_name, dimension.partitioning))
+    if high is not None and not low < high:
+        raise ValueError('Empty range: [%r, %r)' % (low, high))
+    c = cache.get_cache(hive_metadata)
+    by_engine = {}
+    for (found, piece_low, piece_high) in c.get_ranges(dimension).covering(
+        low, high):
+        node = c.get_node(dimension, found.node_id)
+        if node is None:
+            raise NoSuchNodeError(
+                'dimension %r, node_id %d'
+                % (dimension_name, found.node_id))
+        node_engine = engines.get_engine(node.uri)
+        by_engine.setdefault(node_engine, []).append((piece_low, piece_high))
+    return by_engine
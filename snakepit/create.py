@@ -2,6 +2,10 @@ import sqlalchemy as sq
 
 from snakepit import directory
 from snakepit import connect
+from snakepit import cache
+from snakepit import engines
+from snakepit import secondary
+from snakepit import hive
 
 def create_hive(hive_uri):
     """
@@ -15,8 +19,47 @@ def create_hive(hive_uri):
     """
     hive_metadata = connect.get_hive(hive_uri)
     hive_metadata.create_all()
+    t = hive_metadata.tables['semaphore_metadata']
+    q = sq.select(
+        [sq.func.count('*').label('count')],
+        from_obj=[t],
+        )
+    res = q.execute().fetchone()
+    if res['count'] == 0:
+        t.insert().execute(
+            read_only=False,
+            revision=0,
+            )
     return hive_metadata
 
+def bump_revision(hive_metadata):
+    """
+    Increment the metadata revision of the hive.
+
+    Call this after changing dimensions or nodes, so that
+    processes caching the hive metadata notice the change.
+    """
+    cache.bump_revision(hive_metadata)
+
+def set_read_only(hive_metadata, read_only):
+    """
+    Make the hive read-only for maintenance, or writable again.
+
+    Processes notice within their poll interval of the hive
+    revision, see L{snakepit.cache.HiveMetadataCache}.
+
+    @type read_only: bool
+    """
+    t = hive_metadata.tables['semaphore_metadata']
+    r = t.update(values={t.c.read_only: read_only}).execute()
+    if r.rowcount < 1:
+        # hive created before revisions were tracked
+        t.insert().execute(
+            read_only=read_only,
+            revision=0,
+            )
+    cache.get_cache(hive_metadata).invalidate()
+
 def create_primary_index(
     directory_uri,
     dimension_name,
@@ -35,7 +78,39 @@ def create_primary_index(
         directory_uri,
         strategy='threadlocal',
         )
-    table = directory.get_primary_table(
+    directory.get_primary_table(
+        directory_metadata=directory_metadata,
+        dimension_name=dimension_name,
+        db_type=db_type,
+        )
+    directory.get_tombstone_table(
+        directory_metadata=directory_metadata,
+        dimension_name=dimension_name,
+        db_type=db_type,
+        )
+    directory_metadata.create_all()
+    return directory_metadata
+
+def create_range_index(
+    directory_uri,
+    dimension_name,
+    db_type,
+    ):
+    """
+    Create a range table for C{dimension_name} at C{directory_uri},
+    for a dimension partitioned by range.
+
+    @param db_type: partition dimension key data type, one of
+    C{snakepit.directory.DB_TYPES} keys
+
+    @type db_type: str
+    """
+    directory_metadata = sq.MetaData()
+    directory_metadata.bind = sq.create_engine(
+        directory_uri,
+        strategy='threadlocal',
+        )
+    directory.get_range_table(
         directory_metadata=directory_metadata,
         dimension_name=dimension_name,
         db_type=db_type,
@@ -55,12 +130,27 @@ def create_dimension(
     dimension_name,
     directory_uri,
     db_type,
+    partitioning=hive.DIRECTORY,
+    bucket_count=None,
     ):
     """
     Create a dimension with C{dimension_name} at C{hive_metadata},
     where the directory index is stored at C{directory_uri}.
 
-    Directory index must be set up before calling this function.
+    Directory index must be set up before calling this function; for
+    dimensions partitioned by range, the range table, see
+    L{create_range_index}. Dimensions partitioned by bucket have no
+    directory, and C{directory_uri} is only recorded.
+
+    @param partitioning: how values are mapped to nodes, one of
+    C{snakepit.hive.PARTITIONINGS}
+
+    @type partitioning: str
+
+    @param bucket_count: number of buckets, when partitioning by
+    bucket
+
+    @type bucket_count: int
 
     @return: id of created dimension
 
@@ -68,30 +158,32 @@ def create_dimension(
 
     @raise DimensionExistsError: a dimension with that name exists
     already in this hive
+
+    @raise HiveReadOnlyError: the hive is read-only
     """
+    connect.check_writable(hive_metadata)
+    if partitioning not in hive.PARTITIONINGS:
+        raise ValueError('Unknown partitioning: %r' % partitioning)
+    if partitioning == hive.BUCKET:
+        if not bucket_count > 0:
+            raise ValueError('Bad bucket count: %r' % bucket_count)
+    else:
+        bucket_count = None
     t = hive_metadata.tables['partition_dimension_metadata']
     try:
         r = t.insert().execute(
             name=dimension_name,
             index_uri=directory_uri,
             db_type=db_type,
+            partitioning=partitioning,
+            bucket_count=bucket_count,
             )
-    except sq.exceptions.SQLError, e:
-        # sqlalchemy 0.3.x is hiding details and not providing a
-        # db-independent abstraction for what the error actually
-        # was, so we need to resort to kludges
-
-        # only catch sq.exceptions.IntegrityError when it's safe
-        # to depend on sqlalchemy 0.4
-
-        # http://www.sqlalchemy.org/trac/ticket/706
-        if 'IntegrityError' in unicode(e):
-            raise DimensionExistsError(repr(dimension_name))
-        else:
-            raise
+    except sq.exc.IntegrityError:
+        raise DimensionExistsError(repr(dimension_name))
 
     (dimension_id,) = r.last_inserted_ids()
     r.close()
+    bump_revision(hive_metadata)
     return dimension_id
 
 class NodeExistsError(Exception):
@@ -100,7 +192,21 @@ class NodeExistsError(Exception):
     def __str__(self):
         return ': '.join([self.__doc__]+list(self.args))
 
-def create_node(hive_metadata, dimension_id, node_name, node_uri):
+def _check_node_values(weight, capacity):
+    if weight is not None and not weight >= 0:
+        raise ValueError('Bad weight: %r' % weight)
+    if capacity is not None and not capacity >= 0:
+        raise ValueError('Bad capacity: %r' % capacity)
+
+def create_node(
+    hive_metadata,
+    dimension_id,
+    node_name,
+    node_uri,
+    read_only=False,
+    weight=None,
+    capacity=None,
+    ):
     """
     Create a node with in dimension having C{dimension_id} with
     C{node_name} at C{hive_metadata}, where the records are stored at
@@ -108,6 +214,20 @@ def create_node(hive_metadata, dimension_id, node_name, node_uri):
 
     Node must be set up before calling this function.
 
+    @param read_only: place no new records on the node
+
+    @type read_only: bool
+
+    @param weight: share of new records relative to other nodes,
+    C{None} for 1.0
+
+    @type weight: float
+
+    @param capacity: most records to place on the node, C{None} for
+    no limit
+
+    @type capacity: int
+
     @return: id of created node
 
     @rtype: int
@@ -116,29 +236,448 @@ def create_node(hive_metadata, dimension_id, node_name, node_uri):
 
     @raise NodeExistsError: a node with that name exists
     already in this hive
+
+    @raise ValueError: weight or capacity is negative
+
+    @raise HiveReadOnlyError: the hive is read-only
     """
+    connect.check_writable(hive_metadata)
+    _check_node_values(weight=weight, capacity=capacity)
     t = hive_metadata.tables['node_metadata']
     try:
         r = t.insert().execute(
             partition_dimension_id=dimension_id,
             name=node_name,
             uri=node_uri,
-            read_only=False, # TODO
+            read_only=read_only,
+            weight=weight,
+            capacity=capacity,
             )
-    except sq.exceptions.SQLError, e:
-        # sqlalchemy 0.3.x is hiding details and not providing a
-        # db-independent abstraction for what the error actually
-        # was, so we need to resort to kludges
-
-        # only catch sq.exceptions.IntegrityError when it's safe
-        # to depend on sqlalchemy 0.4
-
-        # http://www.sqlalchemy.org/trac/ticket/706
-        if 'IntegrityError' in unicode(e):
-            raise NodeExistsError(repr(node_name))
-        else:
-            raise
+    except sq.exc.IntegrityError:
+        raise NodeExistsError(repr(node_name))
 
     (node_id,) = r.last_inserted_ids()
     r.close()
+    bump_revision(hive_metadata)
     return node_id
+
+UNCHANGED = object()
+
+def update_node(
+    hive_metadata,
+    dimension_name,
+    node_name,
+    read_only=UNCHANGED,
+    weight=UNCHANGED,
+    capacity=UNCHANGED,
+    ):
+    """
+    Change how new records are placed on node C{node_name} of
+    C{dimension_name}.
+
+    Arguments left as C{UNCHANGED} keep their current value; see
+    L{create_node} for their meaning. Records already on the node
+    stay there.
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise NoSuchNodeError: no such node found
+
+    @raise ValueError: weight or capacity is negative
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    values = {}
+    for name, value in [
+        ('read_only', read_only),
+        ('weight', weight),
+        ('capacity', capacity),
+        ]:
+        if value is not UNCHANGED:
+            values[name] = value
+    _check_node_values(
+        weight=values.get('weight'),
+        capacity=values.get('capacity'),
+        )
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    node = _get_node_by_name(hive_metadata, dimension, node_name)
+    if not values:
+        return
+    t = hive_metadata.tables['node_metadata']
+    t.update(t.c.id==node.id, values=values).execute()
+    bump_revision(hive_metadata)
+
+class ReplicaExistsError(Exception):
+    """Replica exists already"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def create_replica(hive_metadata, dimension_name, node_name, replica_uri):
+    """
+    Add a read replica at C{replica_uri} to node C{node_name} of
+    C{dimension_name}.
+
+    Replication itself must be set up before calling this function;
+    reads with C{write=False} go to the replica as soon as processes
+    notice the new hive revision.
+
+    @return: id of created replica
+
+    @rtype: int
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise NoSuchNodeError: no such node found
+
+    @raise ReplicaExistsError: the node has that replica already
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    dimension = cache.get_cache(hive_metadata).get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    node = _get_node_by_name(hive_metadata, dimension, node_name)
+
+    t = hive_metadata.tables['node_replica_metadata']
+    try:
+        r = t.insert().execute(
+            node_id=node.id,
+            uri=replica_uri,
+            )
+    except sq.exc.IntegrityError:
+        raise ReplicaExistsError(
+            '%r of node %r' % (replica_uri, node_name))
+
+    (replica_id,) = r.last_inserted_ids()
+    r.close()
+    bump_revision(hive_metadata)
+    return replica_id
+
+class ResourceExistsError(Exception):
+    """Resource exists already"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def create_resource(
+    hive_metadata,
+    dimension_name,
+    resource_name,
+    db_type,
+    is_partitioning_resource=False,
+    ):
+    """
+    Create a resource with C{resource_name} in dimension
+    C{dimension_name} at C{hive_metadata}.
+
+    Records of a partitioning resource are identified by the
+    dimension value itself. For other resources, a resource index
+    mapping resource ids to dimension values is created in the
+    directory of the dimension.
+
+    @param db_type: resource id data type, one of
+    C{snakepit.directory.DB_TYPES} keys
+
+    @type db_type: str
+
+    @return: id of created resource
+
+    @rtype: int
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise ResourceExistsError: a resource with that name exists
+    already in this hive
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+
+    if not is_partitioning_resource:
+        directory_metadata = sq.MetaData()
+        directory_metadata.bind = engines.get_engine(dimension.index_uri)
+        directory.get_resource_table(
+            directory_metadata=directory_metadata,
+            resource_name=resource_name,
+            db_type=db_type,
+            dimension_db_type=dimension.db_type,
+            )
+        directory_metadata.create_all()
+
+    t = hive_metadata.tables['resource_metadata']
+    try:
+        r = t.insert().execute(
+            dimension_id=dimension.id,
+            name=resource_name,
+            db_type=db_type,
+            is_partitioning_resource=is_partitioning_resource,
+            )
+    except sq.exc.IntegrityError:
+        raise ResourceExistsError(repr(resource_name))
+
+    (resource_id,) = r.last_inserted_ids()
+    r.close()
+    bump_revision(hive_metadata)
+    return resource_id
+
+class SecondaryIndexExistsError(Exception):
+    """Secondary index exists already"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def create_secondary_index(
+    hive_metadata,
+    resource_name,
+    column_name,
+    db_type,
+    ):
+    """
+    Create a secondary index on C{column_name} of resource
+    C{resource_name} at C{hive_metadata}, and its table in the
+    directory of the dimension.
+
+    @param db_type: indexed column data type, one of
+    C{snakepit.directory.DB_TYPES} keys
+
+    @type db_type: str
+
+    @return: id of created secondary index
+
+    @rtype: int
+
+    @raise NoSuchResourceError: no such resource found
+
+    @raise SecondaryIndexExistsError: the column is indexed already
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    c = cache.get_cache(hive_metadata)
+    resource = c.get_resource(resource_name)
+    if resource is None:
+        raise secondary.NoSuchResourceError(repr(resource_name))
+    dimension = c.get_dimension_by_id(resource.dimension_id)
+
+    directory_metadata = sq.MetaData()
+    directory_metadata.bind = engines.get_engine(dimension.index_uri)
+    directory.get_secondary_table(
+        directory_metadata=directory_metadata,
+        resource_name=resource_name,
+        column_name=column_name,
+        db_type=db_type,
+        resource_db_type=resource.db_type,
+        )
+    directory_metadata.create_all()
+
+    t = hive_metadata.tables['secondary_index_metadata']
+    try:
+        r = t.insert().execute(
+            resource_id=resource.id,
+            column_name=column_name,
+            db_type=db_type,
+            )
+    except sq.exc.IntegrityError:
+        raise SecondaryIndexExistsError(
+            '%r.%r' % (resource_name, column_name))
+
+    (secondary_index_id,) = r.last_inserted_ids()
+    r.close()
+    bump_revision(hive_metadata)
+    return secondary_index_id
+
+def move_bucket(hive_metadata, dimension_name, bucket, node_name):
+    """
+    Store C{bucket} of C{dimension_name} on node C{node_name} from
+    now on.
+
+    Routing changes as soon as processes notice the new hive
+    revision; copying the records in the bucket is up to the caller.
+
+    @type bucket: int
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise NoSuchNodeError: no such node found
+
+    @raise ValueError: the dimension is not partitioned by bucket, or
+    has no such bucket
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    if dimension.partitioning != hive.BUCKET:
+        raise ValueError(
+            'Dimension is not partitioned by bucket: %r' % dimension_name)
+    if not 0 <= bucket < dimension.bucket_count:
+        raise ValueError('Bad bucket: %r' % bucket)
+    node = c.get_node_by_name(dimension, node_name)
+    if node is None:
+        raise connect.NoSuchNodeError(
+            'dimension %r, node name %r' % (dimension_name, node_name))
+
+    t = hive_metadata.tables['bucket_metadata']
+    def update_or_insert(conn):
+        r = conn.execute(
+            t.update(
+                sq.and_(
+                    t.c.partition_dimension_id==dimension.id,
+                    t.c.bucket==bucket,
+                    ),
+                values={t.c.node_id: node.id},
+                ),
+            )
+        if r.rowcount < 1:
+            conn.execute(
+                t.insert(),
+                partition_dimension_id=dimension.id,
+                bucket=bucket,
+                node_id=node.id,
+                )
+    hive_metadata.bind.transaction(update_or_insert)
+    bump_revision(hive_metadata)
+
+class RangeOverlapError(Exception):
+    """Range overlaps existing ranges"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def _get_range_dimension(hive_metadata, dimension_name):
+    dimension = cache.get_cache(hive_metadata).get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    if dimension.partitioning != hive.RANGE:
+        raise ValueError(
+            'Dimension is not partitioned by range: %r' % dimension_name)
+    return dimension
+
+def _get_node_by_name(hive_metadata, dimension, node_name):
+    node = cache.get_cache(hive_metadata).get_node_by_name(
+        dimension, node_name)
+    if node is None:
+        raise connect.NoSuchNodeError(
+            'dimension %r, node name %r' % (dimension.name, node_name))
+    return node
+
+def add_range(hive_metadata, dimension_name, low, high, node_name):
+    """
+    Store values from C{low} up to, but not including, C{high} of
+    C{dimension_name} on node C{node_name}.
+
+    @param high: end of the range, C{None} for unbounded
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise NoSuchNodeError: no such node found
+
+    @raise RangeOverlapError: some of the values are in a range
+    already
+
+    @raise ValueError: the dimension is not partitioned by range, or
+    the range is empty
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    dimension = _get_range_dimension(hive_metadata, dimension_name)
+    if high is not None and not low < high:
+        raise ValueError('Empty range: [%r, %r)' % (low, high))
+    node = _get_node_by_name(hive_metadata, dimension, node_name)
+    t = cache.get_cache(hive_metadata).get_range_table(dimension)
+    # the cached ranges may be stale, ask the directory
+    overlapping = sq.or_(t.c.high==None, t.c.high>low)
+    if high is not None:
+        overlapping = sq.and_(overlapping, t.c.low<high)
+    def add(conn):
+        q = sq.select(
+            [t.c.low],
+            overlapping,
+            limit=1,
+            for_update=True,
+            )
+        if conn.execute(q).fetchone() is not None:
+            raise RangeOverlapError(
+                'dimension %r, range [%r, %r)'
+                % (dimension_name, low, high))
+        conn.execute(
+            t.insert(),
+            low=low,
+            high=high,
+            node=node.id,
+            )
+    t.bind.transaction(add)
+    bump_revision(hive_metadata)
+
+def split_range(hive_metadata, dimension_name, at, node_name=None):
+    """
+    Split the range of C{dimension_name} containing C{at} in two, the
+    second starting at C{at}.
+
+    The second part is stored on node C{node_name} from now on;
+    routing changes as soon as processes notice the new hive
+    revision, and copying the records is up to the caller.
+
+    @param node_name: node for the second part, C{None} to keep it on
+    the same node
+
+    @raise NoSuchDimensionError: no such dimension found
+
+    @raise NoSuchNodeError: no such node found
+
+    @raise ValueError: the dimension is not partitioned by range, or
+    C{at} is not inside a range
+
+    @raise HiveReadOnlyError: the hive is read-only
+    """
+    connect.check_writable(hive_metadata)
+    dimension = _get_range_dimension(hive_metadata, dimension_name)
+    node_id = None
+    if node_name is not None:
+        node_id = _get_node_by_name(hive_metadata, dimension, node_name).id
+
+    t = cache.get_cache(hive_metadata).get_range_table(dimension)
+    def split(conn):
+        # the cached ranges may be stale, ask the directory
+        q = sq.select(
+            [t.c.low, t.c.high, t.c.node],
+            sq.and_(
+                t.c.low<=at,
+                sq.or_(t.c.high==None, t.c.high>at),
+                ),
+            for_update=True,
+            )
+        found = conn.execute(q).fetchone()
+        if found is None or found[t.c.low] == at:
+            raise ValueError('Not inside a range: %r' % at)
+        conn.execute(
+            t.update(
+                t.c.low==found[t.c.low],
+                values={t.c.high: at},
+                ),
+            )
+        new_node_id = node_id
+        if new_node_id is None:
+            new_node_id = found[t.c.node]
+        conn.execute(
+            t.insert(),
+            low=at,
+            high=found[t.c.high],
+            node=new_node_id,
+            )
+    t.bind.transaction(split)
+    bump_revision(hive_metadata)
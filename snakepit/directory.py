@@ -40,22 +40,52 @@ hive_primary = sq.Table(
 hive_secondary = sq.Table(
     'hive_secondary_RESOURCE_COLUMN',
     metadata,
-    # TODO this should be whatever datatype
-    # secondary_index_metadata.db_type says, no uniqueness guarantee
-    sq.Column('id', sq.Integer,
-              nullable=True,
-              index=True,
-              ),
-    # TODO this should be whatever datatype resource_metadata.db_type
-    # says; this doesn't point to primary index but to the column
-    # named by secondary_index_metadata.column_name in the table named
-    # by resource_metadata.name
-    sq.Column('pkey', sq.Integer,
+    # the 'id' column is added dynamically, with type based on
+    # secondary_index_metadata.db_type, no uniqueness guarantee
+
+    # the 'pkey' column is added dynamically, with type based on
+    # resource_metadata.db_type; this doesn't point to primary index
+    # but to the column named by secondary_index_metadata.column_name
+    # in the table named by resource_metadata.name
+    )
+
+hive_resource = sq.Table(
+    'hive_resource_RESOURCE',
+    metadata,
+    # the 'id' column is added dynamically, with type based on
+    # resource_metadata.db_type
+
+    # the 'pkey' column is added dynamically, with type based on
+    # partition_dimension_metadata.db_type; it is the dimension value
+    # the resource is stored with
+    )
+
+hive_tombstone = sq.Table(
+    'hive_tombstone_DIMENSION',
+    metadata,
+    # not part of the HiveDB schema; remembers values unassigned from
+    # hive_primary_DIMENSION, so snakepit.changes can report them
+
+    # the 'id' column is added dynamically, like in hive_primary
+    sq.Column('node', sq.SmallInteger, nullable=False),
+    sq.Column('last_updated', sq.DateTime,
               nullable=False,
               index=True,
               ),
     )
 
+hive_range = sq.Table(
+    'hive_range_DIMENSION',
+    metadata,
+    # not part of the HiveDB schema; ranges of values of dimensions
+    # partitioned by range, and the nodes storing them
+
+    # the 'low' and 'high' columns are added dynamically, with type
+    # based on partition_dimension_metadata.db_type; 'high' is NULL
+    # for unbounded
+    sq.Column('node', sq.SmallInteger, nullable=False),
+    )
+
 def dynamic_table(table, directory_metadata, name):
     """
     Access C{table} under new C{directory_metadata} with new C{name}.
@@ -76,6 +106,9 @@ def get_primary_table(
     db_type,
     ):
     table_name = 'hive_primary_%s' % dimension_name
+    table = directory_metadata.tables.get(table_name, None)
+    if table is not None:
+        return table
     table = dynamic_table(
         table=metadata.tables['hive_primary_DIMENSION'],
         directory_metadata=directory_metadata,
@@ -86,7 +119,223 @@ def get_primary_table(
             'id',
             DB_TYPES[db_type],
             nullable=False,
+            # every lookup is by id; older directories get this key
+            # with snakepit-migrate-directory
+            primary_key=True,
+            ),
+        )
+    return table
+
+def get_tombstone_table(
+    directory_metadata,
+    dimension_name,
+    db_type,
+    ):
+    """
+    Get the table of values unassigned from the primary index of
+    C{dimension_name}.
+    """
+    table_name = 'hive_tombstone_%s' % dimension_name
+    table = directory_metadata.tables.get(table_name, None)
+    if table is not None:
+        return table
+    table = dynamic_table(
+        table=metadata.tables['hive_tombstone_DIMENSION'],
+        directory_metadata=directory_metadata,
+        name=table_name,
+        )
+    table.append_column(
+        sq.Column(
+            'id',
+            DB_TYPES[db_type],
+            nullable=False,
+            index=True,
+            ),
+        )
+    return table
+
+def get_range_table(
+    directory_metadata,
+    dimension_name,
+    db_type,
+    ):
+    """
+    Get the table of ranges of values of C{dimension_name}.
+    """
+    table_name = 'hive_range_%s' % dimension_name
+    table = directory_metadata.tables.get(table_name, None)
+    if table is not None:
+        return table
+    table = dynamic_table(
+        table=metadata.tables['hive_range_DIMENSION'],
+        directory_metadata=directory_metadata,
+        name=table_name,
+        )
+    table.append_column(
+        sq.Column(
+            'low',
+            DB_TYPES[db_type],
+            nullable=False,
+            primary_key=True,
+            ),
+        )
+    table.append_column(
+        sq.Column(
+            'high',
+            DB_TYPES[db_type],
+            ),
+        )
+    return table
+
+class PrimaryStatements(object):
+    """
+    The statements routing runs against a primary index table,
+    compiled once and executed with bound parameters.
+
+    C{lookup} and C{lookup_for_update} take C{b_id} and return the
+    C{node} and C{read_only} columns; C{delete} takes C{b_id} and
+    C{b_node}; C{insert} takes all the columns of the table, and can
+    be executed with a list of rows.
+
+    If C{tombstone_table} is given, C{insert_tombstone} takes all of
+    its columns; otherwise it is C{None}.
+
+    If the directory is in the hive database, pass C{node_table} and
+    the C{dimension_id} of the table to get C{lookup_node}, which also
+    returns the C{uri} of the node in the same query, C{None} if the
+    node is missing or belongs to another dimension. Otherwise
+    C{lookup_node} is C{None}.
+    """
+
+    def __init__(
+        self,
+        table,
+        node_table=None,
+        dimension_id=None,
+        tombstone_table=None,
+        ):
+        engine = table.bind
+        b_id = sq.bindparam('b_id', type_=table.c.id.type)
+        self.lookup = sq.select(
+            [table.c.node, table.c.read_only],
+            table.c.id==b_id,
+            limit=1,
+            ).compile(bind=engine)
+        self.lookup_node = None
+        if node_table is not None:
+            self.lookup_node = sq.select(
+                [table.c.node, table.c.read_only, node_table.c.uri],
+                table.c.id==b_id,
+                from_obj=[
+                    table.outerjoin(
+                        node_table,
+                        sq.and_(
+                            node_table.c.id==table.c.node,
+                            node_table.c.partition_dimension_id
+                            ==dimension_id,
+                            ),
+                        ),
+                    ],
+                limit=1,
+                ).compile(bind=engine)
+        self.lookup_for_update = sq.select(
+            [table.c.node, table.c.read_only],
+            table.c.id==b_id,
+            for_update=True,
+            ).compile(bind=engine)
+        self.insert = table.insert().compile(
+            bind=engine,
+            column_keys=[c.key for c in table.columns],
+            )
+        self.delete = table.delete(
+            sq.and_(
+                table.c.id==b_id,
+                table.c.node==sq.bindparam(
+                    'b_node', type_=table.c.node.type),
+                ),
+            ).compile(bind=engine)
+        self.insert_tombstone = None
+        if tombstone_table is not None:
+            self.insert_tombstone = tombstone_table.insert().compile(
+                bind=engine,
+                column_keys=[c.key for c in tombstone_table.columns],
+                )
+
+def get_resource_table(
+    directory_metadata,
+    resource_name,
+    db_type,
+    dimension_db_type,
+    ):
+    """
+    Get the table mapping ids of resource C{resource_name} to values
+    of the partition dimension.
+
+    Only resources that are not partitioning resources need this;
+    for those, the resource id is the dimension value.
+    """
+    table_name = 'hive_resource_%s' % resource_name
+    table = directory_metadata.tables.get(table_name, None)
+    if table is not None:
+        return table
+    table = dynamic_table(
+        table=metadata.tables['hive_resource_RESOURCE'],
+        directory_metadata=directory_metadata,
+        name=table_name,
+        )
+    table.append_column(
+        sq.Column(
+            'id',
+            DB_TYPES[db_type],
+            nullable=False,
+            primary_key=True,
+            ),
+        )
+    table.append_column(
+        sq.Column(
+            'pkey',
+            DB_TYPES[dimension_db_type],
+            nullable=False,
+            index=True,
+            ),
+        )
+    return table
+
+def get_secondary_table(
+    directory_metadata,
+    resource_name,
+    column_name,
+    db_type,
+    resource_db_type,
+    ):
+    """
+    Get the table mapping values of C{column_name} to ids of resource
+    C{resource_name}.
+    """
+    table_name = 'hive_secondary_%s_%s' % (resource_name, column_name)
+    table = directory_metadata.tables.get(table_name, None)
+    if table is not None:
+        return table
+    table = dynamic_table(
+        table=metadata.tables['hive_secondary_RESOURCE_COLUMN'],
+        directory_metadata=directory_metadata,
+        name=table_name,
+        )
+    table.append_column(
+        sq.Column(
+            'id',
+            DB_TYPES[db_type],
+            nullable=False,
+            index=True,
+            ),
+        )
+    table.append_column(
+        sq.Column(
+            'pkey',
+            DB_TYPES[resource_db_type],
+            nullable=False,
+            index=True,
             ),
         )
-    #table.constraints.add(sq.UniqueConstraint('id', 'node'))
+    table.append_constraint(sq.UniqueConstraint('id', 'pkey'))
     return table
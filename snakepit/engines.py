@@ -0,0 +1,271 @@
+"""
+Process-wide registry of long-lived, pooled database engines.
+
+Creating an engine means creating a connection pool, and usually a
+fresh connection and authentication handshake on first use. Engines
+handed out by the routing functions are instead created once per
+database URI and shared by everyone in the process.
+
+Every engine tracks the health of its database, see
+L{snakepit.health}.
+"""
+
+import threading
+
+import sqlalchemy as sq
+
+from snakepit import health
+
+class EngineRegistry(object):
+    """
+    Shared engines, one per database URI.
+
+    @ivar pool_size: number of connections kept open per engine
+
+    @ivar max_overflow: number of connections allowed on top of
+    C{pool_size} when the pool is exhausted
+
+    @ivar pool_recycle: seconds after which a pooled connection is
+    reopened, -1 for never
+
+    @ivar health_options: keyword arguments for the
+    L{snakepit.health.NodeHealth} of new engines
+    """
+
+    def __init__(self, pool_size=5, max_overflow=10, pool_recycle=3600):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.health_options = {}
+        self._lock = threading.Lock()
+        self._engines = {}
+        self._health = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _create_engine(self, uri):
+        node_health = health.NodeHealth(uri, **self.health_options)
+        self._health[uri] = node_health
+        kwargs = dict(
+            strategy='threadlocal',
+            pool_recycle=self.pool_recycle,
+            proxy=health.HealthProxy(node_health),
+            creator=health.make_creator(node_health, uri),
+            )
+        url = sq.engine.url.make_url(uri)
+        if url.drivername == 'sqlite':
+            # sqlite connects cheaply, and the default pool of a
+            # connection per thread closes connections still in use
+            # once more threads than its size have connected; a
+            # memory database is gone with its connection, though
+            if url.database and url.database != ':memory:':
+                kwargs.update(poolclass=sq.pool.NullPool)
+        else:
+            kwargs.update(
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                )
+        return sq.create_engine(uri, **kwargs)
+
+    def get_engine(self, uri):
+        """
+        Get the shared engine for C{uri}, creating it if needed.
+
+        The engine is owned by the registry; callers must not dispose
+        of it.
+
+        @type uri: str
+
+        @rtype: sqlalchemy.engine.Engine
+        """
+        engine = self._engines.get(uri)
+        if engine is not None:
+            return engine
+        self._lock.acquire()
+        try:
+            engine = self._engines.get(uri)
+            if engine is None:
+                engine = self._create_engine(uri)
+                self._engines[uri] = engine
+            return engine
+        finally:
+            self._lock.release()
+
+    def get_health(self, uri):
+        """
+        Get the health of the database at C{uri}.
+
+        @return: health, or C{None} if no engine has been created for
+        C{uri}
+
+        @rtype: snakepit.health.NodeHealth or None
+        """
+        return self._health.get(uri)
+
+    def is_available(self, uri):
+        """
+        Is the circuit of the database at C{uri} closed, or ready to
+        be tried again?
+
+        @rtype: bool
+        """
+        node_health = self._health.get(uri)
+        return node_health is None or node_health.is_available()
+
+    def allow(self, uri):
+        """
+        May a request be sent to the database at C{uri} now?
+
+        See L{snakepit.health.NodeHealth.allow}.
+
+        @rtype: bool
+        """
+        node_health = self._health.get(uri)
+        return node_health is None or node_health.allow()
+
+    def probe(self):
+        """
+        Try every database with an open circuit that is ready to be
+        tried again, closing or reopening the circuit.
+        """
+        for uri, node_health in self._health.items():
+            if node_health.state == health.CLOSED:
+                continue
+            if not node_health.allow():
+                continue
+            engine = self._engines.get(uri)
+            if engine is None:
+                continue
+            try:
+                engine.execute('SELECT 1').close()
+            except Exception:
+                # recorded by the engine
+                pass
+
+    def _run(self, interval):
+        while not self._stopped.isSet():
+            self._stopped.wait(interval)
+            if self._stopped.isSet():
+                break
+            self.probe()
+
+    def start_probing(self, interval=1.0):
+        """
+        Run L{probe} every C{interval} seconds on a background
+        thread.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval,),
+            name='snakepit-probe',
+            )
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop_probing(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def dispose(self):
+        """
+        Dispose of all engines and forget them, and their health.
+        """
+        self._lock.acquire()
+        try:
+            engines = self._engines.values()
+            self._engines = {}
+            self._health = {}
+        finally:
+            self._lock.release()
+        for engine in engines:
+            engine.dispose()
+
+registry = EngineRegistry()
+
+def configure(
+    pool_size=None,
+    max_overflow=None,
+    pool_recycle=None,
+    health_options=None,
+    ):
+    """
+    Set pool options for engines created from now on.
+
+    Engines that already exist keep their pools; call L{shutdown}
+    first to have every engine recreated with the new options.
+
+    @param health_options: keyword arguments for
+    L{snakepit.health.NodeHealth}, like C{error_threshold} and
+    C{open_time}
+
+    @type health_options: dict
+    """
+    if pool_size is not None:
+        registry.pool_size = pool_size
+    if max_overflow is not None:
+        registry.max_overflow = max_overflow
+    if pool_recycle is not None:
+        registry.pool_recycle = pool_recycle
+    if health_options is not None:
+        registry.health_options = dict(health_options)
+
+def get_engine(uri):
+    """
+    Get the shared engine for C{uri}.
+
+    @rtype: sqlalchemy.engine.Engine
+    """
+    return registry.get_engine(uri)
+
+def get_health(uri):
+    """
+    Get the health of the database at C{uri}.
+
+    @rtype: snakepit.health.NodeHealth or None
+    """
+    return registry.get_health(uri)
+
+def is_available(uri):
+    """
+    Is the database at C{uri} not known to be down?
+
+    @rtype: bool
+    """
+    return registry.is_available(uri)
+
+def allow(uri):
+    """
+    May a request be sent to the database at C{uri} now?
+
+    @rtype: bool
+    """
+    return registry.allow(uri)
+
+def start_probing(interval=1.0):
+    """
+    Probe databases with open circuits every C{interval} seconds, on
+    a background thread.
+    """
+    registry.start_probing(interval)
+
+def stop_probing():
+    """
+    Stop probing databases with open circuits.
+    """
+    registry.stop_probing()
+
+def shutdown():
+    """
+    Dispose of every shared engine, closing all pooled connections.
+
+    Call this on process exit, or after forking.
+    """
+    registry.dispose()
@@ -0,0 +1,227 @@
+"""
+Non-blocking routing calls, for event loop based servers.
+
+The routing functions in L{snakepit.connect} talk to the hive and the
+directory with blocking queries. The functions here run them on a
+dedicated pool of threads instead, and return immediately. They share
+the metadata cache, directory cache and node engines with the
+blocking API.
+
+Completion is reported through the returned
+C{multiprocessing.pool.AsyncResult}, and optionally through
+C{callback} and C{errback}. Those are called in a pool thread; hand
+the result over to the event loop with whatever it offers for that,
+e.g. C{reactor.callFromThread} in Twisted.
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from snakepit import connect
+
+DEFAULT_MAX_WORKERS = 16
+
+class RoutingExecutor(object):
+    """
+    A pool of threads running routing calls.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = ThreadPool(max_workers)
+
+    def submit(self, fn, args=(), kwargs={}, callback=None, errback=None):
+        """
+        Run C{fn(*args, **kwargs)} in the pool.
+
+        @param callback: called with the return value of C{fn}
+
+        @param errback: called with the exception raised by C{fn}
+
+        @rtype: multiprocessing.pool.AsyncResult
+        """
+        def run():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                if errback is not None:
+                    errback(e)
+                raise
+            return result
+        return self._pool.apply_async(run, callback=callback)
+
+    def shutdown(self):
+        """
+        Wait for queued calls to finish, and stop the threads.
+        """
+        self._pool.close()
+        self._pool.join()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Get the shared executor, starting it if needed.
+
+    @rtype: RoutingExecutor
+    """
+    global _executor
+    _executor_lock.acquire()
+    try:
+        if _executor is None:
+            _executor = RoutingExecutor()
+        return _executor
+    finally:
+        _executor_lock.release()
+
+def configure(max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Replace the shared executor with one of C{max_workers} threads.
+
+    Calls already submitted finish on the old executor.
+    """
+    global _executor
+    _executor_lock.acquire()
+    try:
+        old = _executor
+        _executor = RoutingExecutor(max_workers=max_workers)
+    finally:
+        _executor_lock.release()
+    if old is not None:
+        old.shutdown()
+
+def shutdown():
+    """
+    Stop the shared executor, after queued calls finish.
+    """
+    global _executor
+    _executor_lock.acquire()
+    try:
+        old = _executor
+        _executor = None
+    finally:
+        _executor_lock.release()
+    if old is not None:
+        old.shutdown()
+
+def get_engine_async(
+    hive_metadata,
+    dimension_name,
+    dimension_value,
+    write=True,
+    callback=None,
+    errback=None,
+    ):
+    """
+    Non-blocking L{snakepit.connect.get_engine}.
+
+    @rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().submit(
+        connect.get_engine,
+        kwargs=dict(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_value=dimension_value,
+            write=write,
+            ),
+        callback=callback,
+        errback=errback,
+        )
+
+def assign_node_async(
+    hive_metadata,
+    dimension_name,
+    dimension_value,
+    callback=None,
+    errback=None,
+    ):
+    """
+    Non-blocking L{snakepit.connect.assign_node}.
+
+    @rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().submit(
+        connect.assign_node,
+        kwargs=dict(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_value=dimension_value,
+            ),
+        callback=callback,
+        errback=errback,
+        )
+
+def unassign_node_async(
+    hive_metadata,
+    dimension_name,
+    dimension_value,
+    node_name,
+    callback=None,
+    errback=None,
+    ):
+    """
+    Non-blocking L{snakepit.connect.unassign_node}.
+
+    @rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().submit(
+        connect.unassign_node,
+        kwargs=dict(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_value=dimension_value,
+            node_name=node_name,
+            ),
+        callback=callback,
+        errback=errback,
+        )
+
+def get_engines_bulk_async(
+    hive_metadata,
+    dimension_name,
+    dimension_values,
+    write=True,
+    callback=None,
+    errback=None,
+    ):
+    """
+    Non-blocking L{snakepit.connect.get_engines_bulk}.
+
+    @rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().submit(
+        connect.get_engines_bulk,
+        kwargs=dict(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_values=list(dimension_values),
+            write=write,
+            ),
+        callback=callback,
+        errback=errback,
+        )
+
+def assign_nodes_bulk_async(
+    hive_metadata,
+    dimension_name,
+    dimension_values,
+    callback=None,
+    errback=None,
+    ):
+    """
+    Non-blocking L{snakepit.connect.assign_nodes_bulk}.
+
+    @rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().submit(
+        connect.assign_nodes_bulk,
+        kwargs=dict(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            dimension_values=list(dimension_values),
+            ),
+        callback=callback,
+        errback=errback,
+        )
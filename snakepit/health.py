@@ -0,0 +1,276 @@
+"""
+Health of node databases, and circuit breakers to stop using the
+unhealthy ones.
+
+The engines of L{snakepit.engines} record the outcome and latency of
+every connect and statement in a L{NodeHealth}. When too many recent
+requests to a database failed, or were too slow, its circuit opens:
+routing fails fast with L{snakepit.connect.NodeUnavailableError}
+instead of making callers wait for timeouts, reads go to replicas,
+and no new records are placed on the node.
+
+After C{open_time} seconds one request is let through to try the
+database again, and its outcome closes or reopens the circuit; the
+outcomes of other requests still in flight are ignored. The
+engine registry can also probe open circuits in the background, see
+L{snakepit.engines.start_probing}.
+"""
+
+import collections
+import threading
+import time
+
+import sqlalchemy as sq
+from sqlalchemy import interfaces
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# errors saying the database is in trouble, as opposed to errors in
+# the statement, the schema or the data; DBAPI errors count only when
+# the dialect says the connection was lost
+FAILURES = (
+    sq.exc.DisconnectionError,
+    sq.exc.TimeoutError,
+    )
+
+def is_failure(e):
+    """
+    Does C{e} say the database is in trouble?
+
+    @type e: Exception
+
+    @rtype: bool
+    """
+    if isinstance(e, FAILURES):
+        return True
+    if isinstance(e, sq.exc.DBAPIError):
+        return bool(e.connection_invalidated)
+    return False
+
+class NodeHealth(object):
+    """
+    Recent outcomes of requests to one database, and its circuit.
+
+    @ivar state: one of C{CLOSED}, C{OPEN} and C{HALF_OPEN}
+
+    @ivar window: number of recent requests remembered
+
+    @ivar min_requests: requests needed in the window before the
+    circuit can open
+
+    @ivar error_threshold: share of failed requests that opens the
+    circuit
+
+    @ivar slow_threshold: seconds; the circuit opens when the 90th
+    percentile of latency is over this, C{None} to ignore latency
+
+    @ivar open_time: seconds until a request is let through to try an
+    open circuit again
+    """
+
+    def __init__(
+        self,
+        uri,
+        window=100,
+        min_requests=10,
+        error_threshold=0.5,
+        slow_threshold=None,
+        open_time=10.0,
+        ):
+        self.uri = uri
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.slow_threshold = slow_threshold
+        self.open_time = open_time
+        self.state = CLOSED
+        self._changed = None
+        self._trial = None
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque()
+
+    def __repr__(self):
+        return '<NodeHealth %r %s>' % (self.uri, self.state)
+
+    def _open(self, now):
+        self.state = OPEN
+        self._changed = now
+        self._trial = None
+
+    def _unhealthy(self):
+        if len(self._outcomes) < self.min_requests:
+            return False
+        if self._error_rate() >= self.error_threshold:
+            return True
+        if self.slow_threshold is not None:
+            slow = self._latency_percentile(90)
+            if slow is not None and slow > self.slow_threshold:
+                return True
+        return False
+
+    def record(self, ok, latency=None):
+        """
+        Remember the outcome of a request.
+
+        While the circuit is half-open, only the outcome of the trial
+        request, made by the thread L{allow} let through, counts.
+
+        @param ok: whether the request succeeded
+
+        @type ok: bool
+
+        @param latency: seconds the request took, if it succeeded
+
+        @type latency: float
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self.state == HALF_OPEN:
+                if threading.currentThread() is not self._trial:
+                    # sent before the circuit opened, or by a caller
+                    # that got the engine some other way
+                    return
+                # the trial request decides
+                if ok:
+                    self.state = CLOSED
+                    self._changed = now
+                    self._trial = None
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            self._outcomes.append((ok, latency))
+            while len(self._outcomes) > self.window:
+                self._outcomes.popleft()
+            if self.state == CLOSED and self._unhealthy():
+                self._open(now)
+        finally:
+            self._lock.release()
+
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        failed = len([ok for (ok, latency) in self._outcomes if not ok])
+        return float(failed) / len(self._outcomes)
+
+    def error_rate(self):
+        """
+        Share of the remembered requests that failed.
+
+        @rtype: float
+        """
+        self._lock.acquire()
+        try:
+            return self._error_rate()
+        finally:
+            self._lock.release()
+
+    def _latency_percentile(self, percent):
+        latencies = sorted([
+                latency for (ok, latency) in self._outcomes
+                if ok and latency is not None
+                ])
+        if not latencies:
+            return None
+        i = min(len(latencies) - 1, int(len(latencies) * percent / 100.0))
+        return latencies[i]
+
+    def latency_percentile(self, percent):
+        """
+        Latency of the remembered successful requests, at
+        C{percent}.
+
+        @return: seconds, C{None} if nothing was measured
+
+        @rtype: float or None
+        """
+        self._lock.acquire()
+        try:
+            return self._latency_percentile(percent)
+        finally:
+            self._lock.release()
+
+    def is_available(self):
+        """
+        Could a request be sent now?
+
+        Unlike L{allow}, this does not let the trial request through.
+
+        @rtype: bool
+        """
+        if self.state == CLOSED:
+            return True
+        return time.time() - self._changed >= self.open_time
+
+    def allow(self):
+        """
+        May a request be sent now?
+
+        Once C{open_time} has passed, the first caller asking an open
+        circuit is let through as the trial request, and must send it
+        from the same thread.
+
+        @rtype: bool
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return True
+            if now - self._changed < self.open_time:
+                return False
+            # also retry when the last trial request never reported
+            self.state = HALF_OPEN
+            self._changed = now
+            self._trial = threading.currentThread()
+            return True
+        finally:
+            self._lock.release()
+
+class HealthProxy(interfaces.ConnectionProxy):
+    """
+    Record the outcome and latency of every statement run through an
+    engine.
+
+    Statements failing for reasons of their own, like a missing table
+    or a duplicate key, still mean the database answered.
+    """
+
+    def __init__(self, health):
+        self.health = health
+
+    def execute(self, conn, execute, clauseelement, *multiparams, **params):
+        start = time.time()
+        try:
+            result = execute(clauseelement, *multiparams, **params)
+        except Exception, e:
+            self.health.record(not is_failure(e))
+            raise
+        self.health.record(True, time.time() - start)
+        return result
+
+def make_creator(health, uri):
+    """
+    Make the function connecting to the database at C{uri}, for the
+    C{creator} argument of C{sqlalchemy.create_engine}.
+
+    Connects like the default one, and also records failures to
+    connect in C{health}; those never reach L{HealthProxy}.
+    """
+    url = sq.engine.url.make_url(uri)
+    dialect_cls = url.get_dialect()
+    dbapi = dialect_cls.dbapi()
+    dialect = dialect_cls(dbapi=dbapi)
+    (cargs, cparams) = dialect.create_connect_args(url)
+    def connect():
+        try:
+            return dbapi.connect(*cargs, **cparams)
+        except Exception, e:
+            health.record(False)
+            raise sq.exc.DBAPIError.instance(None, None, e)
+    return connect
@@ -2,6 +2,14 @@ import sqlalchemy as sq
 
 metadata = sq.MetaData()
 
+# ways of mapping values of a dimension to nodes, see
+# partition_dimension_metadata.partitioning
+DIRECTORY = 'directory'
+BUCKET = 'bucket'
+RANGE = 'range'
+
+PARTITIONINGS = [DIRECTORY, BUCKET, RANGE]
+
 semaphore_metadata = sq.Table(
     'semaphore_metadata',
     metadata,
@@ -22,6 +30,10 @@ node_metadata = sq.Table(
     sq.Column('uri', sq.String(255), nullable=False),
     # this is int in HiveConfigurationSchema.java
     sq.Column('read_only', sq.Boolean),
+    # share of new records relative to other nodes, NULL for 1.0
+    sq.Column('weight', sq.Float),
+    # most records to place on the node, NULL for no limit
+    sq.Column('capacity', sq.Integer),
 
     # TODO what's the scope of the name? I guess you could
     # say name is hostname, and same machine can serve two
@@ -30,6 +42,36 @@ node_metadata = sq.Table(
     sq.UniqueConstraint('partition_dimension_id', 'name'),
     )
 
+node_replica_metadata = sq.Table(
+    'node_replica_metadata',
+    metadata,
+    # not part of the HiveDB schema; read replicas of nodes, used by
+    # snakepit.connect.get_engine with write=False
+    sq.Column('id', sq.Integer, primary_key=True),
+    sq.Column('node_id', sq.Integer,
+              sq.ForeignKey('node_metadata.id'),
+              nullable=False,
+              ),
+    sq.Column('uri', sq.String(255), nullable=False),
+
+    sq.UniqueConstraint('node_id', 'uri'),
+    )
+
+node_statistics = sq.Table(
+    'node_statistics',
+    metadata,
+    # not part of the HiveDB schema; load statistics for placing new
+    # records, refreshed periodically by snakepit.statistics
+    sq.Column('node_id', sq.Integer,
+              sq.ForeignKey('node_metadata.id'),
+              primary_key=True,
+              ),
+    sq.Column('record_count', sq.Integer, nullable=False),
+    # seconds, NULL if the node could not be reached
+    sq.Column('latency', sq.Float),
+    sq.Column('last_updated', sq.DateTime, nullable=False),
+    )
+
 partition_dimension_metadata = sq.Table(
     'partition_dimension_metadata',
     metadata,
@@ -37,6 +79,32 @@ partition_dimension_metadata = sq.Table(
     sq.Column('name', sq.String(64), nullable=False, unique=True),
     sq.Column('index_uri', sq.String(255), nullable=False),
     sq.Column('db_type', sq.String(64), nullable=False),
+    # not part of the HiveDB schema; NULL or 'directory' to look up
+    # every value in the directory at index_uri, 'bucket' to hash
+    # values into bucket_count buckets listed in bucket_metadata,
+    # 'range' to look values up in a table of ranges at index_uri
+    sq.Column('partitioning', sq.String(32)),
+    sq.Column('bucket_count', sq.Integer),
+    )
+
+bucket_metadata = sq.Table(
+    'bucket_metadata',
+    metadata,
+    # not part of the HiveDB schema; which node stores each bucket of
+    # dimensions partitioned by bucket
+    sq.Column('partition_dimension_id', sq.Integer,
+              sq.ForeignKey('partition_dimension_metadata.id'),
+              primary_key=True,
+              autoincrement=False,
+              ),
+    sq.Column('bucket', sq.Integer,
+              primary_key=True,
+              autoincrement=False,
+              ),
+    sq.Column('node_id', sq.Integer,
+              sq.ForeignKey('node_metadata.id'),
+              nullable=False,
+              ),
     )
 
 secondary_index_metadata = sq.Table(
@@ -0,0 +1,177 @@
+"""
+Ordered, streaming merge of result sets from all nodes of a
+dimension.
+
+Each node sorts its own rows with C{ORDER BY}; the sorted cursors are
+then merged lazily, reading rows from each node in batches. Memory
+use depends on the number of nodes and the batch size, not on how
+many rows the nodes hold.
+"""
+
+import heapq
+import itertools
+import operator
+
+import sqlalchemy as sq
+
+from snakepit import connect, engines
+
+DEFAULT_BATCH_SIZE = 100
+
+class _Reversed(object):
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _node_rows(engine, statement, params, batch_size):
+    conn = engine.connect()
+    try:
+        if params:
+            res = conn.execute(statement, params)
+        else:
+            res = conn.execute(statement)
+        try:
+            while True:
+                rows = res.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            res.close()
+    finally:
+        conn.close()
+
+def merge_iter(
+    hive_metadata,
+    dimension_name,
+    statement,
+    key,
+    params=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    reverse=False,
+    ):
+    """
+    Run C{statement} on every node of C{dimension_name} and merge the
+    results in order.
+
+    C{statement} must return rows sorted by C{key} on every node, for
+    example with an C{ORDER BY} on the same column.
+
+    @param statement: an SQLAlchemy statement or SQL string, not bound
+    to any engine
+
+    @param key: name of the column to merge by, or a function
+    returning the sort key of a row
+
+    @type key: str or callable
+
+    @param params: bind parameters for C{statement}
+
+    @type params: dict
+
+    @param batch_size: how many rows to fetch from a node at a time
+
+    @type batch_size: int
+
+    @param reverse: whether rows are sorted in descending order
+
+    @type reverse: bool
+
+    @return: rows from all nodes, in order; close the iterator to
+    release the node connections early
+
+    @rtype: iterator
+    """
+    if not callable(key):
+        key = operator.itemgetter(key)
+    if reverse:
+        sort_key = lambda row: _Reversed(key(row))
+    else:
+        sort_key = key
+
+    nodes = connect.get_nodes(hive_metadata, dimension_name)
+    streams = []
+    try:
+        heap = []
+        for node in nodes:
+            stream = _node_rows(
+                engine=engines.get_engine(node.uri),
+                statement=statement,
+                params=params,
+                batch_size=batch_size,
+                )
+            streams.append(stream)
+            for row in stream:
+                # index breaks ties, so rows are never compared
+                heap.append((sort_key(row), len(streams)-1, row))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            (k, i, row) = heap[0]
+            yield row
+            try:
+                row = streams[i].next()
+            except StopIteration:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (sort_key(row), i, row))
+    finally:
+        for stream in streams:
+            stream.close()
+
+def page(
+    hive_metadata,
+    dimension_name,
+    statement,
+    key,
+    limit,
+    offset=0,
+    params=None,
+    reverse=False,
+    ):
+    """
+    Get one page of the ordered, merged results from all nodes of
+    C{dimension_name}.
+
+    If C{statement} is an SQLAlchemy C{Select}, each node is asked for
+    at most C{offset+limit} rows. For deep pages, prefer narrowing
+    C{statement} with a C{WHERE} on the last key seen over a large
+    C{offset}.
+
+    See L{merge_iter} for the other parameters.
+
+    @param limit: maximum number of rows to return
+
+    @type limit: int
+
+    @param offset: number of rows to skip
+
+    @type offset: int
+
+    @rtype: list
+    """
+    wanted = offset + limit
+    if isinstance(statement, sq.sql.expression.Select):
+        statement = statement.limit(wanted)
+    rows = merge_iter(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        statement=statement,
+        key=key,
+        params=params,
+        batch_size=min(max(wanted, 1), DEFAULT_BATCH_SIZE),
+        reverse=reverse,
+        )
+    try:
+        return list(itertools.islice(rows, offset, wanted))
+    finally:
+        rows.close()
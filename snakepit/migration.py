@@ -0,0 +1,536 @@
+"""
+Move records of a dimension from one node to another, online.
+
+Values are moved in batches. For each batch, the directory rows are
+marked C{read_only} to fence off writers, see
+L{snakepit.connect.get_engine}, and writers that were routed before
+get C{fence_wait} seconds to finish. Then the rows of the dependent
+tables are copied to the target node, and the directory rows are
+pointed at the target in one statement.
+
+Fenced values are never cached, and the fence is a change in
+L{snakepit.changes}: snapshots and replicas used for routing drop
+the values when they next poll, and processes with a directory cache
+should call L{snakepit.changes.evict_changed} as often. C{fence_wait}
+must cover that interval too.
+
+Reads keep working all along, from the source until the directory
+changes and from the target after. Other processes may still route
+reads to the source from their directory caches, snapshots and
+replicas, so the copies on the source node are only deleted
+C{cache_ttl} seconds later, once none of those can still be valid.
+
+The library does not know the schema of the nodes, so the caller
+names the node tables holding records, and the column in each
+holding the dimension value.
+
+Each batch is fenced while the one before it is copied, so the wait
+for writers overlaps with the copying.
+
+Progress is written to a checkpoint file after every batch; the
+values to move are written once, next to it. If a migration dies,
+L{resume} picks it up from the last finished batch; every step of a
+batch is safe to repeat. L{resume} also deletes the records still
+waiting to be deleted from the source, so a migration need not wait
+for them. Only dimensions partitioned by directory can be migrated.
+"""
+
+import cPickle as pickle
+import datetime
+import os
+import time
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect, engines, hive
+
+DEFAULT_BATCH_SIZE = 1000
+
+DEFAULT_FENCE_WAIT = 5.0
+
+# the default ttl of snakepit.connect.configure_directory_cache
+DEFAULT_CACHE_TTL = 300.0
+
+CHECKPOINT_VERSION = 2
+
+class BadCheckpointError(Exception):
+    """Not a migration checkpoint"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def _ignore(message):
+    pass
+
+def _write_checkpoint(path, state):
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def _read_checkpoint(path):
+    f = open(path, 'rb')
+    try:
+        try:
+            state = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            raise BadCheckpointError(repr(path))
+    finally:
+        f.close()
+    if (not isinstance(state, dict)
+        or state.get('version') != CHECKPOINT_VERSION):
+        raise BadCheckpointError(repr(path))
+    return state
+
+def _values_path(checkpoint):
+    return '%s.values' % checkpoint
+
+def _read_values(checkpoint):
+    path = _values_path(checkpoint)
+    f = open(path, 'rb')
+    try:
+        try:
+            values = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            raise BadCheckpointError(repr(path))
+    finally:
+        f.close()
+    if not isinstance(values, list):
+        raise BadCheckpointError(repr(path))
+    return values
+
+def _get_node(hive_metadata, dimension, node_name):
+    node = cache.get_cache(hive_metadata).get_node_by_name(
+        dimension, node_name)
+    if node is None:
+        raise connect.NoSuchNodeError(
+            'dimension %r, node name %r' % (dimension.name, node_name))
+    return node
+
+def _get_dimension(hive_metadata, dimension_name):
+    dimension = connect._get_dimension(hive_metadata, dimension_name)
+    if dimension.partitioning != hive.DIRECTORY:
+        raise connect.UnsupportedPartitioningError(
+            'dimension %r, partitioning %s'
+            % (dimension_name, dimension.partitioning))
+    return dimension
+
+def _reflect(engine, tables):
+    metadata = sq.MetaData(bind=engine)
+    return [
+        (sq.Table(table_name, metadata, autoload=True), column_name)
+        for (table_name, column_name) in tables
+        ]
+
+def _ids_on(t_primary, batch, node_id):
+    q = sq.select(
+        [t_primary.c.id],
+        sq.and_(
+            t_primary.c.id.in_(batch),
+            t_primary.c.node==node_id,
+            ),
+        )
+    return [row[0] for row in q.execute().fetchall()]
+
+def _batches(t_primary, source, state, values, batch_size):
+    # yields batches of values, and the position after each
+    if state['low'] is None:
+        done = state['done']
+        while done < len(values):
+            batch = values[done:done+batch_size]
+            done += len(batch)
+            yield (batch, done)
+        return
+    # splitting: every value on the source from low up, in order
+    after = state['after']
+    while True:
+        where = sq.and_(
+            t_primary.c.node==source.id,
+            t_primary.c.id>=state['low'],
+            )
+        if after is not None:
+            where = sq.and_(where, t_primary.c.id>after)
+        q = sq.select(
+            [t_primary.c.id],
+            where,
+            order_by=[t_primary.c.id],
+            limit=batch_size,
+            )
+        batch = [row[0] for row in q.execute().fetchall()]
+        if not batch:
+            return
+        after = batch[-1]
+        yield (batch, after)
+
+def _fence(t_primary, source, batch):
+    # fence off writers until the records are on the target
+    res = t_primary.update(
+        sq.and_(
+            t_primary.c.id.in_(batch),
+            t_primary.c.node==source.id,
+            t_primary.c.read_only==False,
+            ),
+        # seen by followers of snakepit.changes
+        values={
+            t_primary.c.read_only: True,
+            t_primary.c.last_updated: datetime.datetime.now(),
+            },
+        ).execute()
+    return res.rowcount
+
+def _move_batch(t_primary, source, target, source_tables, target_tables,
+                batch, fence_wait):
+    moving = _ids_on(t_primary, batch, source.id)
+    if moving:
+        if _fence(t_primary, source, moving):
+            # assigned to the source since the batch was fenced
+            time.sleep(fence_wait)
+
+        for ((src, column_name), (dst, _)) in zip(
+            source_tables, target_tables):
+            rows = sq.select(
+                [src],
+                src.c[column_name].in_(moving),
+                ).execute().fetchall()
+            def copy(conn):
+                # leftovers of an earlier attempt
+                conn.execute(dst.delete(dst.c[column_name].in_(moving)))
+                if rows:
+                    conn.execute(dst.insert(), [dict(row) for row in rows])
+            dst.bind.transaction(copy)
+
+        t_primary.update(
+            sq.and_(
+                t_primary.c.id.in_(moving),
+                t_primary.c.node==source.id,
+                ),
+            values={
+                t_primary.c.node: target.id,
+                t_primary.c.read_only: False,
+                t_primary.c.last_updated: datetime.datetime.now(),
+                },
+            ).execute()
+
+    # includes values moved by an attempt that died before this step
+    moved = _ids_on(t_primary, batch, target.id)
+    return (moving, moved)
+
+def _delete_due(source_tables, pending, now):
+    # pending is a list of (due, values), oldest first
+    while pending and pending[0][0] <= now:
+        (due, values) = pending.pop(0)
+        for (src, column_name) in source_tables:
+            src.delete(src.c[column_name].in_(values)).execute()
+
+def _run(hive_metadata, state, values, checkpoint, batch_size, max_rate,
+         report, fence_wait, cache_ttl, wait):
+    if not wait and checkpoint is None:
+        raise ValueError(
+            'Need a checkpoint to delete moved records later')
+    dimension = _get_dimension(hive_metadata, state['dimension_name'])
+    source = _get_node(hive_metadata, dimension, state['source_name'])
+    target = _get_node(hive_metadata, dimension, state['target_name'])
+    c = cache.get_cache(hive_metadata)
+    t_primary = c.get_primary_table(dimension)
+    source_tables = _reflect(engines.get_engine(source.uri), state['tables'])
+    target_tables = _reflect(engines.get_engine(target.uri), state['tables'])
+    dir_cache = connect.directory_cache
+
+    pending = state['pending']
+    count = 0
+    start = time.time()
+    batches = _batches(t_primary, source, state, values, batch_size)
+    current = next(batches, None)
+    if current is not None:
+        _fence(t_primary, source, current[0])
+        fenced = time.time()
+    while current is not None:
+        (batch, position) = current
+        following = next(batches, None)
+        if following is not None:
+            # writers of the next batch finish while this one is copied
+            _fence(t_primary, source, following[0])
+            following_fenced = time.time()
+        if dir_cache is not None:
+            for value in batch:
+                dir_cache.evict(connect._directory_cache_key(dimension, value))
+        # writers routed before the fence finish their writes
+        ahead = fenced + fence_wait - time.time()
+        if ahead > 0:
+            time.sleep(ahead)
+
+        (moving, moved) = _move_batch(
+            t_primary=t_primary,
+            source=source,
+            target=target,
+            source_tables=source_tables,
+            target_tables=target_tables,
+            batch=batch,
+            fence_wait=fence_wait,
+            )
+        if dir_cache is not None:
+            for value in moving:
+                dir_cache.evict(connect._directory_cache_key(dimension, value))
+        if moved:
+            pending.append((time.time() + cache_ttl, moved))
+        _delete_due(source_tables, pending, time.time())
+        c.add_records(source, -len(moving))
+        c.add_records(target, len(moving))
+        count += len(moving)
+        state['done'] += len(batch)
+        if state['low'] is not None:
+            state['after'] = position
+        if checkpoint is not None:
+            _write_checkpoint(checkpoint, state)
+        report(
+            '%s: %d/%d values done'
+            % (dimension.name, state['done'], state['total']))
+
+        if max_rate:
+            # values per second
+            ahead = float(count) / max_rate - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+        if following is not None:
+            fenced = following_fenced
+        current = following
+
+    while pending and wait:
+        ahead = pending[0][0] - time.time()
+        if ahead > 0:
+            report(
+                '%s: deleting moved records from the source in %d seconds'
+                % (dimension.name, ahead))
+            time.sleep(ahead)
+        _delete_due(source_tables, pending, time.time())
+        if checkpoint is not None:
+            _write_checkpoint(checkpoint, state)
+    return count
+
+def _start(hive_metadata, state, values, checkpoint, **kw):
+    if checkpoint is not None:
+        if values is not None:
+            _write_checkpoint(_values_path(checkpoint), values)
+        _write_checkpoint(checkpoint, state)
+    return _run(
+        hive_metadata=hive_metadata,
+        state=state,
+        values=values,
+        checkpoint=checkpoint,
+        **kw
+        )
+
+def _new_state(dimension_name, source_name, target_name, tables, total,
+               low=None):
+    return dict(
+        version=CHECKPOINT_VERSION,
+        dimension_name=dimension_name,
+        source_name=source_name,
+        target_name=target_name,
+        tables=[tuple(t) for t in tables],
+        total=total,
+        done=0,
+        # for splits, values on the source from low up, after the
+        # last one done
+        low=low,
+        after=None,
+        pending=[],
+        )
+
+def move_values(
+    hive_metadata,
+    dimension_name,
+    dimension_values,
+    source_name,
+    target_name,
+    tables,
+    checkpoint=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_rate=None,
+    report=_ignore,
+    fence_wait=DEFAULT_FENCE_WAIT,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    wait=True,
+    ):
+    """
+    Move the records of C{dimension_values} from node C{source_name}
+    to node C{target_name}.
+
+    Values not on the source node are skipped. Writers routed with
+    L{snakepit.connect.get_engine} are refused while the C{read_only}
+    flag of their directory row is set; others are expected to leave
+    the records alone.
+
+    @param tables: node tables holding records, and the column in
+    each holding the dimension value
+
+    @type tables: list of (str, str)
+
+    @param checkpoint: path of a file to record progress in, for
+    L{resume}; C{None} for no checkpoints. The values are written
+    to the same path with C{.values} added.
+
+    @type checkpoint: str
+
+    @param batch_size: values moved at a time
+
+    @type batch_size: int
+
+    @param max_rate: most values moved per second, C{None} for no
+    limit
+
+    @type max_rate: float
+
+    @param report: called with a progress message after each batch
+
+    @type report: callable
+
+    @param fence_wait: seconds writers routed before a batch was
+    fenced have to finish writing
+
+    @type fence_wait: float
+
+    @param cache_ttl: seconds until routes cached by other processes
+    expire, after which the moved records are deleted from the source;
+    at least the C{ttl} of their directory caches
+
+    @type cache_ttl: float
+
+    @param wait: C{False} to return without waiting to delete the
+    last moved records from the source; L{resume} deletes them later.
+    Needs a C{checkpoint}.
+
+    @type wait: bool
+
+    @return: number of values moved
+
+    @rtype: int
+
+    @raise UnsupportedPartitioningError: the dimension is not
+    partitioned by directory
+    """
+    values = list(dimension_values)
+    return _start(
+        hive_metadata=hive_metadata,
+        state=_new_state(
+            dimension_name=dimension_name,
+            source_name=source_name,
+            target_name=target_name,
+            tables=tables,
+            total=len(values),
+            ),
+        values=values,
+        checkpoint=checkpoint,
+        batch_size=batch_size,
+        max_rate=max_rate,
+        report=report,
+        fence_wait=fence_wait,
+        cache_ttl=cache_ttl,
+        wait=wait,
+        )
+
+def split_node(
+    hive_metadata,
+    dimension_name,
+    source_name,
+    target_name,
+    tables,
+    checkpoint=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_rate=None,
+    report=_ignore,
+    fence_wait=DEFAULT_FENCE_WAIT,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    wait=True,
+    ):
+    """
+    Move the upper half of the values on node C{source_name}, by
+    value, to node C{target_name}.
+
+    The values are read from the directory a batch at a time. See
+    L{move_values} for parameters.
+
+    @return: number of values moved
+
+    @rtype: int
+    """
+    dimension = _get_dimension(hive_metadata, dimension_name)
+    source = _get_node(hive_metadata, dimension, source_name)
+    t_primary = cache.get_cache(hive_metadata).get_primary_table(dimension)
+    on_source = t_primary.c.node==source.id
+    count = sq.select(
+        [sq.func.count(t_primary.c.id)],
+        on_source,
+        ).execute().scalar()
+    low = sq.select(
+        [t_primary.c.id],
+        on_source,
+        order_by=[t_primary.c.id],
+        offset=count//2,
+        limit=1,
+        ).execute().scalar()
+    if low is None:
+        return 0
+    return _start(
+        hive_metadata=hive_metadata,
+        state=_new_state(
+            dimension_name=dimension_name,
+            source_name=source_name,
+            target_name=target_name,
+            tables=tables,
+            total=count - count//2,
+            low=low,
+            ),
+        values=None,
+        checkpoint=checkpoint,
+        batch_size=batch_size,
+        max_rate=max_rate,
+        report=report,
+        fence_wait=fence_wait,
+        cache_ttl=cache_ttl,
+        wait=wait,
+        )
+
+def resume(
+    hive_metadata,
+    checkpoint,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_rate=None,
+    report=_ignore,
+    fence_wait=DEFAULT_FENCE_WAIT,
+    cache_ttl=DEFAULT_CACHE_TTL,
+    wait=True,
+    ):
+    """
+    Continue the migration recorded in C{checkpoint}, after the last
+    finished batch. Records already moved and waiting to be deleted
+    from the source are deleted when their time comes.
+
+    See L{move_values} for parameters.
+
+    @return: number of values moved
+
+    @rtype: int
+
+    @raise BadCheckpointError: C{checkpoint} is not a migration
+    checkpoint
+    """
+    state = _read_checkpoint(checkpoint)
+    values = None
+    if state['low'] is None:
+        values = _read_values(checkpoint)
+    return _run(
+        hive_metadata=hive_metadata,
+        state=state,
+        values=values,
+        checkpoint=checkpoint,
+        batch_size=batch_size,
+        max_rate=max_rate,
+        report=report,
+        fence_wait=fence_wait,
+        cache_ttl=cache_ttl,
+        wait=wait,
+        )
@@ -0,0 +1,120 @@
+"""
+Strategies for choosing the node that stores a new record.
+
+A strategy has a C{pick(nodes, get_statistics)} method, where
+C{nodes} is a non-empty list of L{snakepit.cache.Node} and
+C{get_statistics} returns the cached L{snakepit.cache.NodeStatistics}
+of a node. Picking happens in memory; statistics are collected
+separately, see L{snakepit.statistics}.
+
+Strategies only see the nodes accepting new records, see
+L{writable}, and favor nodes in proportion to their C{weight}.
+"""
+
+import random
+
+def writable(nodes, get_statistics):
+    """
+    Get the nodes that accept new records: not read-only, with a
+    positive weight, and with fewer records than their capacity.
+
+    @rtype: list of snakepit.cache.Node
+    """
+    found = []
+    for node in nodes:
+        if node.read_only or node.weight <= 0:
+            continue
+        if (node.capacity is not None
+            and get_statistics(node).record_count >= node.capacity):
+            continue
+        found.append(node)
+    return found
+
+def _weighted_choice(nodes, weights):
+    total = sum(weights)
+    if total <= 0:
+        return random.choice(nodes)
+    x = random.uniform(0, total)
+    for node, weight in zip(nodes, weights):
+        x -= weight
+        if x < 0:
+            return node
+    return nodes[-1]
+
+class RandomPlacement(object):
+    """
+    Pick any node, with probability in proportion to its weight.
+    """
+
+    def pick(self, nodes, get_statistics):
+        return _weighted_choice(nodes, [node.weight for node in nodes])
+
+class LeastRecordsPlacement(object):
+    """
+    Pick the node with the fewest records for its weight, so new
+    nodes catch up.
+    """
+
+    def pick(self, nodes, get_statistics):
+        loads = [
+            get_statistics(node).record_count / float(node.weight)
+            for node in nodes
+            ]
+        least = min(loads)
+        candidates = [
+            node for node, load in zip(nodes, loads)
+            if load == least
+            ]
+        return random.choice(candidates)
+
+def _inverse_record_count(node, stat):
+    return node.weight / (1 + stat.record_count)
+
+class WeightedPlacement(object):
+    """
+    Pick randomly, in proportion to C{weight(node, statistics)}.
+
+    The default weight favors nodes with fewer records, but unlike
+    L{LeastRecordsPlacement} spreads a burst of new records over all
+    nodes.
+    """
+
+    def __init__(self, weight=_inverse_record_count):
+        self.weight = weight
+
+    def pick(self, nodes, get_statistics):
+        weights = [
+            max(0.0, self.weight(node, get_statistics(node)))
+            for node in nodes
+            ]
+        return _weighted_choice(nodes, weights)
+
+class PowerOfTwoPlacement(object):
+    """
+    Pick two nodes at random, and take the less loaded one.
+
+    Load is measured by C{metric}, either C{'record_count'} or
+    C{'latency'}, divided by the weight of the node. Choosing between
+    two random nodes avoids herding every new record onto the one node
+    that looked best when the statistics were collected.
+    """
+
+    def __init__(self, metric='latency'):
+        if metric not in ['record_count', 'latency']:
+            raise ValueError('Unknown metric: %r' % metric)
+        self.metric = metric
+
+    def _load(self, node, get_statistics):
+        value = getattr(get_statistics(node), self.metric)
+        if value is None:
+            # never measured, assume idle
+            return 0
+        return value / float(node.weight)
+
+    def pick(self, nodes, get_statistics):
+        if len(nodes) == 1:
+            return nodes[0]
+        (a, b) = random.sample(nodes, 2)
+        if self._load(b, get_statistics) < self._load(a, get_statistics):
+            return b
+        return a
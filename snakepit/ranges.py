@@ -0,0 +1,96 @@
+"""
+Range partitioning: map intervals of values to nodes.
+
+A dimension created with C{partitioning=snakepit.hive.RANGE} keeps a
+table of C{[low, high)} ranges and their nodes in the database at
+its C{index_uri}, instead of a directory of every value. The table is
+small, and cached whole as a L{RangeMap}, so finding the node of a
+value is a binary search in memory. Ranges are added with
+L{snakepit.create.add_range} and split with
+L{snakepit.create.split_range}.
+"""
+
+import bisect
+
+class Range(object):
+    """
+    Values from C{low} up to, but not including, C{high} are stored
+    on node C{node_id}. A C{high} of C{None} is unbounded.
+    """
+
+    def __init__(self, low, high, node_id):
+        self.low = low
+        self.high = high
+        self.node_id = node_id
+
+    def __repr__(self):
+        return '<Range [%r, %r) on %d>' % (self.low, self.high, self.node_id)
+
+    def __contains__(self, value):
+        return self.low <= value and (self.high is None or value < self.high)
+
+class RangeMap(object):
+    """
+    Non-overlapping ranges, sorted for lookups by binary search.
+    """
+
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges, key=lambda r: r.low)
+        self._lows = [r.low for r in self.ranges]
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def find(self, value):
+        """
+        Get the range containing C{value}.
+
+        @rtype: Range or None
+        """
+        i = bisect.bisect_right(self._lows, value) - 1
+        if i < 0:
+            return None
+        found = self.ranges[i]
+        if value not in found:
+            return None
+        return found
+
+    def covering(self, low, high):
+        """
+        Get the ranges overlapping C{[low, high)}, and the part of
+        C{[low, high)} in each.
+
+        @param high: end of the interval, C{None} for unbounded
+
+        @return: list of tuples of range, and low and high of the
+        part of C{[low, high)} in it
+
+        @rtype: list of (Range, low, high)
+        """
+        pieces = []
+        i = max(0, bisect.bisect_right(self._lows, low) - 1)
+        for r in self.ranges[i:]:
+            if high is not None and r.low >= high:
+                break
+            if r.high is not None and r.high <= low:
+                continue
+            piece_low = max(low, r.low)
+            if r.high is None:
+                piece_high = high
+            elif high is None:
+                piece_high = r.high
+            else:
+                piece_high = min(high, r.high)
+            pieces.append((r, piece_low, piece_high))
+        return pieces
+
+    def overlaps(self, low, high):
+        """
+        Does C{[low, high)} overlap any of the ranges?
+
+        @rtype: bool
+        """
+        return bool(self.covering(low, high))
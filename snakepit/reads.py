@@ -0,0 +1,119 @@
+"""
+Strategies for choosing the copy of a node that serves a read.
+
+Nodes can have read replicas, see L{snakepit.create.create_replica}.
+L{snakepit.connect.get_engine} with C{write=False} picks one of them
+with the strategy set by L{snakepit.connect.configure_reads}, so read
+traffic spreads over the replicas without moving any data.
+
+A strategy has a C{pick(uris)} method, where C{uris} is a non-empty
+list of replica URIs that are not down. Replicas are down when their
+circuit is open, see L{snakepit.health}, or when marked down with
+L{mark_down}; when every replica of a node is down, reads go to the
+node itself.
+"""
+
+import random
+import threading
+import time
+
+from snakepit import engines
+
+DEFAULT_DOWN_TIME = 30.0
+
+class RoundRobinSelection(object):
+    """
+    Take the replicas in turn.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def pick(self, uris):
+        key = tuple(uris)
+        self._lock.acquire()
+        try:
+            i = self._next.get(key, 0)
+            self._next[key] = (i + 1) % len(uris)
+        finally:
+            self._lock.release()
+        return uris[i % len(uris)]
+
+def _outstanding(uri):
+    pool = engines.get_engine(uri).pool
+    checkedout = getattr(pool, 'checkedout', None)
+    if checkedout is None:
+        # pools without a count, like the one sqlite uses
+        return 0
+    return checkedout()
+
+class LeastOutstandingSelection(object):
+    """
+    Take the replica with the fewest connections checked out of its
+    pool, that is, with the fewest requests in progress from this
+    process.
+    """
+
+    def pick(self, uris):
+        counts = [_outstanding(uri) for uri in uris]
+        least = min(counts)
+        candidates = [
+            uri for uri, count in zip(uris, counts)
+            if count == least
+            ]
+        return random.choice(candidates)
+
+_down_lock = threading.Lock()
+_down = {}
+
+def mark_down(uri, seconds=DEFAULT_DOWN_TIME):
+    """
+    Send no reads to replica C{uri} for the next C{seconds}.
+    """
+    _down_lock.acquire()
+    try:
+        _down[uri] = time.time() + seconds
+    finally:
+        _down_lock.release()
+
+def mark_up(uri):
+    """
+    Send reads to replica C{uri} again.
+    """
+    _down_lock.acquire()
+    try:
+        _down.pop(uri, None)
+    finally:
+        _down_lock.release()
+
+def is_down(uri):
+    """
+    Is replica C{uri} marked down?
+
+    @rtype: bool
+    """
+    until = _down.get(uri)
+    return until is not None and time.time() < until
+
+def choose(node, selection):
+    """
+    Get the URI to read records of C{node} from.
+
+    @type node: snakepit.cache.Node
+
+    @param selection: strategy picking among the replicas that are
+    not marked down
+
+    @return: URI of a replica, or of the node if it has no replicas
+    up
+
+    @rtype: str
+    """
+    uris = [
+        uri for uri in node.replicas
+        if not is_down(uri) and engines.is_available(uri)
+        ]
+    if not uris:
+        return node.uri
+    return selection.pick(uris)
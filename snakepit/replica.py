@@ -0,0 +1,281 @@
+"""
+In-process replica of a primary index.
+
+The replica loads all of the directory of a dimension into two
+parallel typed arrays, sorted ids and node ids, taking 12 bytes per
+value on 64-bit platforms. After that it only follows
+L{snakepit.changes} newer than it has seen, optionally on a
+background thread, so lookups are done in memory and are at most
+about one refresh interval out of date.
+
+Use it for routing with L{snakepit.connect.use_snapshot}; values not
+in the replica are looked up from the directory as usual.
+
+Only dimensions with integer values can be replicated.
+"""
+
+import array
+import bisect
+import threading
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect, changes, snapshot
+
+# C long, 64 bits on the usual 64-bit platforms
+_ID_TYPE = 'l'
+_NODE_TYPE = 'i'
+
+class UnsupportedDimensionTypeError(Exception):
+    """Only dimensions with integer values can be replicated"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def _merge(ids, nodes, changes):
+    # build new arrays with the node ids in changes applied
+    new_ids = array.array(_ID_TYPE)
+    new_nodes = array.array(_NODE_TYPE)
+    i = 0
+    for value, node_id in sorted(changes.items()):
+        j = bisect.bisect_left(ids, value, i)
+        new_ids.extend(ids[i:j])
+        new_nodes.extend(nodes[i:j])
+        if node_id is not None:
+            new_ids.append(value)
+            new_nodes.append(node_id)
+        if j < len(ids) and ids[j] == value:
+            j += 1
+        i = j
+    new_ids.extend(ids[i:])
+    new_nodes.extend(nodes[i:])
+    return (new_ids, new_nodes)
+
+class DirectoryReplica(object):
+    """
+    The primary index of one dimension, kept in memory.
+
+    Rows changed since the last merge are kept in a dict, and merged
+    into the arrays once there are more than C{merge_threshold} of
+    them.
+
+    @ivar high_water_mark: newest C{last_updated} seen
+
+    @type high_water_mark: datetime.datetime or None
+    """
+
+    def __init__(
+        self,
+        hive_metadata,
+        dimension_name,
+        refresh_interval=5.0,
+        chunk_size=10000,
+        merge_threshold=10000,
+        overlap=changes.DEFAULT_OVERLAP,
+        ):
+        """
+        @param refresh_interval: seconds between refreshes on the
+        background thread
+
+        @type refresh_interval: float
+
+        @param chunk_size: rows fetched at a time
+
+        @type chunk_size: int
+
+        @param overlap: seconds before the high water mark to ask
+        for, see L{snakepit.changes}
+
+        @type overlap: float
+
+        @raise UnsupportedDimensionTypeError: values of the dimension
+        are not integers
+        """
+        self.hive_metadata = hive_metadata
+        self.dimension_name = dimension_name
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self.merge_threshold = merge_threshold
+        self.overlap = overlap
+        self.high_water_mark = None
+
+        dimension = cache.get_cache(hive_metadata).get_dimension(
+            dimension_name)
+        if dimension is None:
+            raise connect.NoSuchDimensionError(repr(dimension_name))
+        if dimension.db_type not in snapshot.INTEGER_DB_TYPES:
+            raise UnsupportedDimensionTypeError(
+                'dimension %r, db_type %s'
+                % (dimension_name, dimension.db_type))
+        self._dimension = dimension
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._arrays = (array.array(_ID_TYPE), array.array(_NODE_TYPE))
+        self._changes = {}
+
+    def _get_table(self):
+        return cache.get_cache(self.hive_metadata).get_primary_table(
+            self._dimension)
+
+    def _get_high_water_mark(self, t_primary):
+        q = sq.select([sq.func.max(t_primary.c.last_updated)])
+        return q.execute().scalar()
+
+    def load(self):
+        """
+        Load the whole directory, replacing what was loaded before.
+
+        @return: number of values loaded
+
+        @rtype: int
+        """
+        self._lock.acquire()
+        try:
+            t_primary = self._get_table()
+            # rows written while loading are newer than this, and
+            # are picked up by the next refresh
+            high_water_mark = self._get_high_water_mark(t_primary)
+            ids = array.array(_ID_TYPE)
+            nodes = array.array(_NODE_TYPE)
+            q = sq.select(
+                [
+                    t_primary.c.id,
+                    t_primary.c.node,
+                    ],
+                # fenced by a migration, ask the directory
+                t_primary.c.read_only==False,
+                order_by=[t_primary.c.id],
+                )
+            res = q.execute()
+            while True:
+                rows = res.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                ids.extend([row[0] for row in rows])
+                nodes.extend([row[1] for row in rows])
+            res.close()
+            self._arrays = (ids, nodes)
+            self._changes = {}
+            self.high_water_mark = high_water_mark
+            return len(ids)
+        finally:
+            self._lock.release()
+
+    def _apply(self, changes):
+        # called with the lock held
+        self._changes.update(changes)
+        if len(self._changes) > self.merge_threshold:
+            (ids, nodes) = self._arrays
+            self._arrays = _merge(ids, nodes, self._changes)
+            self._changes = {}
+
+    def refresh(self):
+        """
+        Fetch rows updated since the high water mark.
+
+        @return: number of rows fetched
+
+        @rtype: int
+        """
+        if self.high_water_mark is None:
+            return self.load()
+        self._lock.acquire()
+        try:
+            count = 0
+            high_water_mark = self.high_water_mark
+            for batch in changes.iter_changes(
+                hive_metadata=self.hive_metadata,
+                dimension_name=self.dimension_name,
+                since=self.high_water_mark,
+                overlap=self.overlap,
+                batch_size=self.chunk_size,
+                ):
+                updates = {}
+                for change in batch:
+                    if change.deleted or change.read_only:
+                        updates[change.id] = None
+                    else:
+                        updates[change.id] = change.node
+                self._apply(updates)
+                high_water_mark = max(
+                    high_water_mark, batch[-1].last_updated)
+                count += len(batch)
+            self.high_water_mark = high_water_mark
+            return count
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        changes = self._changes.items()
+        (ids, nodes) = self._arrays
+        count = len(ids)
+        for value, node_id in changes:
+            found = _contains(ids, value)
+            if node_id is None and found:
+                count -= 1
+            elif node_id is not None and not found:
+                count += 1
+        return count
+
+    def lookup(self, dimension_value):
+        """
+        Find the node of C{dimension_value}.
+
+        @return: node id, or C{None} if not in the replica
+
+        @rtype: int or None
+        """
+        if not isinstance(dimension_value, (int, long)):
+            return None
+        # merging replaces the arrays before the changes, so reading
+        # them in the opposite order sees every change in at least
+        # one of them
+        changes = self._changes
+        (ids, nodes) = self._arrays
+        if dimension_value in changes:
+            return changes[dimension_value]
+        i = bisect.bisect_left(ids, dimension_value)
+        if i == len(ids) or ids[i] != dimension_value:
+            return None
+        return nodes[i]
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.refresh_interval)
+            if self._stopped.isSet():
+                break
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving what we have; try again next time
+                pass
+
+    def start(self):
+        """
+        Load the directory, and keep refreshing it on a background
+        thread every C{refresh_interval} seconds.
+        """
+        if self.high_water_mark is None:
+            self.load()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='snakepit-replica-%s' % self.dimension_name,
+            )
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def _contains(ids, value):
+    i = bisect.bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
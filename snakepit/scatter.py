@@ -0,0 +1,309 @@
+"""
+Run the same statement on every node of a dimension, concurrently.
+"""
+
+import Queue
+import threading
+import time
+
+from snakepit import connect, engines
+
+DEFAULT_MAX_WORKERS = 8
+
+# most query threads alive in the process, counting those stuck on
+# abandoned queries
+MAX_THREADS = 64
+
+# seconds between checks whether a full result queue is still read
+_PUT_INTERVAL = 0.1
+
+_threads_lock = threading.Lock()
+_thread_count = 0
+
+class NodeTimeoutError(Exception):
+    """Node did not answer in time"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+class NoThreadError(Exception):
+    """No thread left to query node"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+class NodeResult(object):
+    """
+    Rows, or the error, from one node.
+
+    @ivar node: the node the result came from
+
+    @type node: snakepit.cache.Node
+
+    @ivar rows: rows received
+
+    @type rows: list
+
+    @ivar error: exception raised running the statement on the node,
+    or C{None}
+
+    @ivar final: whether this is the last result for this node; only
+    interesting when streaming
+
+    @type final: bool
+    """
+
+    def __init__(self, node, rows, error=None, final=True):
+        self.node = node
+        self.rows = rows
+        self.error = error
+        self.final = final
+
+    def __repr__(self):
+        if self.error is not None:
+            return '<NodeResult %r error=%r>' % (self.node, self.error)
+        return '<NodeResult %r rows=%d>' % (self.node, len(self.rows))
+
+class _Task(object):
+
+    def __init__(self, node):
+        self.node = node
+        self.started = None
+        self.abandoned = False
+
+def _put(results, closed, task, item):
+    # the queue is bounded; don't wait on a reader that is gone
+    while not (closed.isSet() or task.abandoned):
+        try:
+            results.put(item, timeout=_PUT_INTERVAL)
+        except Queue.Full:
+            continue
+        return
+
+def _run(task, statement, params, batch_size, results, closed):
+    engine = engines.get_engine(task.node.uri)
+    conn = engine.connect()
+    try:
+        if params:
+            res = conn.execute(statement, params)
+        else:
+            res = conn.execute(statement)
+        try:
+            if batch_size is None:
+                _put(results, closed, task, (task, res.fetchall(), None, True))
+            else:
+                while True:
+                    rows = res.fetchmany(batch_size)
+                    if not rows or task.abandoned or closed.isSet():
+                        break
+                    _put(results, closed, task, (task, rows, None, False))
+                _put(results, closed, task, (task, [], None, True))
+        finally:
+            res.close()
+    finally:
+        conn.close()
+
+def _worker(tasks, statement, params, batch_size, results, closed):
+    global _thread_count
+    try:
+        while not closed.isSet():
+            try:
+                task = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            task.started = time.time()
+            _put(results, closed, task, (task, None, None, False))
+            try:
+                _run(task, statement, params, batch_size, results, closed)
+            except Exception, e:
+                _put(results, closed, task, (task, [], e, True))
+            if task.abandoned:
+                # a replacement worker was started when this task timed
+                # out; stop here to keep the pool at its size
+                return
+    finally:
+        _threads_lock.acquire()
+        try:
+            _thread_count -= 1
+        finally:
+            _threads_lock.release()
+
+def _start_worker(*args):
+    global _thread_count
+    _threads_lock.acquire()
+    try:
+        if _thread_count >= MAX_THREADS:
+            return False
+        _thread_count += 1
+    finally:
+        _threads_lock.release()
+    t = threading.Thread(target=_worker, args=args)
+    t.setDaemon(True)
+    t.start()
+    return True
+
+def scatter_iter(
+    hive_metadata,
+    dimension_name,
+    statement,
+    params=None,
+    max_workers=DEFAULT_MAX_WORKERS,
+    timeout=None,
+    batch_size=None,
+    ):
+    """
+    Run C{statement} on every node of C{dimension_name}, yielding
+    results as they arrive.
+
+    At most C{max_workers} nodes are queried at the same time. A node
+    that takes longer than C{timeout} seconds from the start of its
+    query gets a L{NodeTimeoutError}; its query is abandoned, not
+    cancelled, and its thread replaced. Nodes whose circuit is open,
+    see L{snakepit.engines.allow}, are not queried and get a
+    L{snakepit.connect.NodeUnavailableError}.
+
+    No more than C{MAX_THREADS} threads query nodes at a time in the
+    process, counting those stuck on abandoned queries. Once a call
+    has no thread left, its remaining nodes get a L{NoThreadError}.
+
+    @param statement: an SQLAlchemy statement or SQL string, not bound
+    to any engine
+
+    @param params: bind parameters for C{statement}
+
+    @type params: dict
+
+    @param max_workers: how many nodes to query at once
+
+    @type max_workers: int
+
+    @param timeout: seconds to wait for each node, or C{None} to wait
+    forever
+
+    @type timeout: float
+
+    @param batch_size: stream rows in batches of this size instead of
+    waiting for each node to return all rows
+
+    @type batch_size: int
+
+    @return: iterator of results; without C{batch_size}, exactly one
+    per node, otherwise any number of batches per node with the last
+    one having C{final} set
+
+    @rtype: iterator of NodeResult
+    """
+    nodes = connect.get_nodes(hive_metadata, dimension_name)
+    tasks = Queue.Queue()
+    pending = 0
+    for node in nodes:
+        if not engines.allow(node.uri):
+            yield NodeResult(
+                node=node,
+                rows=[],
+                error=connect.NodeUnavailableError('node %r' % node.name),
+                )
+            continue
+        tasks.put(_Task(node))
+        pending += 1
+    if not pending:
+        return
+    results = Queue.Queue(maxsize=2*max_workers)
+    closed = threading.Event()
+    worker_args = (tasks, statement, params, batch_size, results, closed)
+    try:
+        workers = 0
+        for i in xrange(min(max_workers, pending)):
+            if _start_worker(*worker_args):
+                workers += 1
+
+        running = set()
+        while pending:
+            if not workers:
+                # nothing left to run the queued tasks
+                while True:
+                    try:
+                        task = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    pending -= 1
+                    yield NodeResult(
+                        node=task.node,
+                        rows=[],
+                        error=NoThreadError('node %r' % task.node.name),
+                        )
+                if not pending:
+                    break
+            wait = None
+            if timeout is not None and running:
+                deadline = min([t.started for t in running]) + timeout
+                wait = max(0, deadline - time.time())
+            try:
+                (task, rows, error, final) = results.get(timeout=wait)
+            except Queue.Empty:
+                now = time.time()
+                for task in list(running):
+                    if task.started + timeout <= now:
+                        task.abandoned = True
+                        running.remove(task)
+                        pending -= 1
+                        workers -= 1
+                        if _start_worker(*worker_args):
+                            workers += 1
+                        yield NodeResult(
+                            node=task.node,
+                            rows=[],
+                            error=NodeTimeoutError(
+                                'node %r after %s seconds'
+                                % (task.node.name, timeout)),
+                            )
+                continue
+
+            if task.abandoned:
+                continue
+            if rows is None:
+                # worker started this task
+                running.add(task)
+                continue
+            if final:
+                running.discard(task)
+                pending -= 1
+            yield NodeResult(
+                node=task.node,
+                rows=rows,
+                error=error,
+                final=final,
+                )
+    finally:
+        # workers still busy stop instead of waiting on us
+        closed.set()
+
+def scatter(
+    hive_metadata,
+    dimension_name,
+    statement,
+    params=None,
+    max_workers=DEFAULT_MAX_WORKERS,
+    timeout=None,
+    ):
+    """
+    Run C{statement} on every node of C{dimension_name}.
+
+    See L{scatter_iter} for parameters.
+
+    @return: one result per node, ordered by node id
+
+    @rtype: list of NodeResult
+    """
+    results = list(
+        scatter_iter(
+            hive_metadata=hive_metadata,
+            dimension_name=dimension_name,
+            statement=statement,
+            params=params,
+            max_workers=max_workers,
+            timeout=timeout,
+            ),
+        )
+    results.sort(key=lambda r: r.node.id)
+    return results
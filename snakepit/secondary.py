@@ -0,0 +1,393 @@
+"""
+Secondary indexes: find records by something else than the
+partition dimension value.
+
+Resolving a secondary key takes up to three hops, each done with one
+batched query per C{connect.BULK_CHUNK_SIZE} values::
+
+  hive_secondary_RESOURCE_COLUMN: secondary key -> resource id
+  hive_resource_RESOURCE:         resource id   -> dimension value
+  hive_primary_DIMENSION:         dimension value -> node
+
+The middle hop is skipped for partitioning resources, whose ids are
+dimension values. Lookups use the directory cache, if enabled with
+L{snakepit.connect.configure_directory_cache}.
+"""
+
+import itertools
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect
+
+class NoSuchResourceError(Exception):
+    """No such resource"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+class NoSuchSecondaryIndexError(Exception):
+    """No such secondary index"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def _get_resource(hive_metadata, resource_name):
+    c = cache.get_cache(hive_metadata)
+    resource = c.get_resource(resource_name)
+    if resource is None:
+        raise NoSuchResourceError(repr(resource_name))
+    dimension = c.get_dimension_by_id(resource.dimension_id)
+    return (dimension, resource)
+
+def _get_secondary_index(hive_metadata, resource_name, column_name):
+    (dimension, resource) = _get_resource(hive_metadata, resource_name)
+    secondary_index = cache.get_cache(hive_metadata).get_secondary_index(
+        resource, column_name)
+    if secondary_index is None:
+        raise NoSuchSecondaryIndexError(
+            '%r.%r' % (resource_name, column_name))
+    return (dimension, resource, secondary_index)
+
+def _resource_cache_key(dimension, resource, resource_id):
+    return (dimension.index_uri, 'resource', resource.name, resource_id)
+
+def _secondary_cache_key(dimension, resource, secondary_index, value):
+    return (
+        dimension.index_uri,
+        'secondary',
+        resource.name,
+        secondary_index.column_name,
+        value,
+        )
+
+def _cached_bulk_lookup(values, cache_key, query):
+    dir_cache = connect.directory_cache
+    found = {}
+    if dir_cache is None:
+        uncached = values
+    else:
+        uncached = []
+        for value in values:
+            (hit, result) = dir_cache.get(cache_key(value))
+            if not hit:
+                uncached.append(value)
+            elif result is not None:
+                found[value] = result
+
+    tokens = {}
+    if dir_cache is not None:
+        for value in uncached:
+            tokens[value] = dir_cache.begin(cache_key(value))
+
+    fetched = {}
+    for chunk in connect._chunks(uncached, connect.BULK_CHUNK_SIZE):
+        query(chunk, fetched)
+    found.update(fetched)
+
+    if dir_cache is not None:
+        for value in uncached:
+            dir_cache.put(
+                cache_key(value),
+                fetched.get(value),
+                tokens[value],
+                )
+    return found
+
+def _evict(keys):
+    dir_cache = connect.directory_cache
+    if dir_cache is not None:
+        for key in keys:
+            dir_cache.evict(key)
+
+def insert_resource_ids(hive_metadata, resource_name, resource_ids):
+    """
+    Record which dimension values resources are stored with.
+
+    @param resource_ids: pairs of resource id and dimension value
+
+    @type resource_ids: iterable of tuples
+
+    @raise NoSuchResourceError: no such resource found
+    """
+    (dimension, resource) = _get_resource(hive_metadata, resource_name)
+    if resource.is_partitioning_resource:
+        # the resource id is the dimension value, nothing to store
+        return
+    t = cache.get_cache(hive_metadata).get_resource_table(
+        dimension, resource)
+    rows = [
+        dict(id=resource_id, pkey=dimension_value)
+        for (resource_id, dimension_value) in resource_ids
+        ]
+    def insert_many(conn):
+        for chunk in connect._chunks(rows, connect.BULK_CHUNK_SIZE):
+            conn.execute(t.insert(), chunk)
+    t.bind.transaction(insert_many)
+    _evict(
+        [_resource_cache_key(dimension, resource, row['id'])
+         for row in rows])
+
+def delete_resource_ids(hive_metadata, resource_name, resource_ids):
+    """
+    Forget resources with C{resource_ids}.
+
+    @type resource_ids: iterable
+
+    @raise NoSuchResourceError: no such resource found
+    """
+    (dimension, resource) = _get_resource(hive_metadata, resource_name)
+    if resource.is_partitioning_resource:
+        return
+    t = cache.get_cache(hive_metadata).get_resource_table(
+        dimension, resource)
+    resource_ids = connect._unique(resource_ids)
+    def delete_many(conn):
+        for chunk in connect._chunks(resource_ids, connect.BULK_CHUNK_SIZE):
+            conn.execute(t.delete(t.c.id.in_(chunk)))
+    t.bind.transaction(delete_many)
+    _evict(
+        [_resource_cache_key(dimension, resource, resource_id)
+         for resource_id in resource_ids])
+
+def insert_secondary_keys(hive_metadata, resource_name, column_name, keys):
+    """
+    Add entries to the secondary index on C{column_name} of
+    C{resource_name}.
+
+    @param keys: pairs of column value and resource id
+
+    @type keys: iterable of tuples
+
+    @raise NoSuchResourceError: no such resource found
+
+    @raise NoSuchSecondaryIndexError: no such secondary index found
+    """
+    (dimension, resource, secondary_index) = _get_secondary_index(
+        hive_metadata, resource_name, column_name)
+    t = cache.get_cache(hive_metadata).get_secondary_table(
+        dimension, resource, secondary_index)
+    rows = [dict(id=value, pkey=resource_id) for (value, resource_id) in keys]
+    def insert_many(conn):
+        for chunk in connect._chunks(rows, connect.BULK_CHUNK_SIZE):
+            conn.execute(t.insert(), chunk)
+    t.bind.transaction(insert_many)
+    _evict(
+        [_secondary_cache_key(dimension, resource, secondary_index, row['id'])
+         for row in rows])
+
+def delete_secondary_keys(hive_metadata, resource_name, column_name, keys):
+    """
+    Remove entries from the secondary index on C{column_name} of
+    C{resource_name}.
+
+    @param keys: pairs of column value and resource id
+
+    @type keys: iterable of tuples
+
+    @raise NoSuchResourceError: no such resource found
+
+    @raise NoSuchSecondaryIndexError: no such secondary index found
+    """
+    (dimension, resource, secondary_index) = _get_secondary_index(
+        hive_metadata, resource_name, column_name)
+    t = cache.get_cache(hive_metadata).get_secondary_table(
+        dimension, resource, secondary_index)
+    rows = [
+        dict(b_id=value, b_pkey=resource_id)
+        for (value, resource_id) in keys
+        ]
+    q = t.delete(
+        sq.and_(
+            t.c.id==sq.bindparam('b_id'),
+            t.c.pkey==sq.bindparam('b_pkey'),
+            ),
+        )
+    def delete_many(conn):
+        for chunk in connect._chunks(rows, connect.BULK_CHUNK_SIZE):
+            conn.execute(q, chunk)
+    t.bind.transaction(delete_many)
+    _evict(
+        [_secondary_cache_key(
+                dimension, resource, secondary_index, row['b_id'])
+         for row in rows])
+
+def get_resource_ids_bulk(hive_metadata, resource_name, column_name, values):
+    """
+    Look up resource ids by values of the secondary index on
+    C{column_name} of C{resource_name}.
+
+    @type values: iterable
+
+    @return: dict mapping values that were found to lists of
+    resource ids
+
+    @rtype: dict
+
+    @raise NoSuchResourceError: no such resource found
+
+    @raise NoSuchSecondaryIndexError: no such secondary index found
+    """
+    (dimension, resource, secondary_index) = _get_secondary_index(
+        hive_metadata, resource_name, column_name)
+    t = cache.get_cache(hive_metadata).get_secondary_table(
+        dimension, resource, secondary_index)
+
+    def query(chunk, found):
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.pkey,
+                ],
+            t.c.id.in_(chunk),
+            order_by=[t.c.id, t.c.pkey],
+            )
+        lists = {}
+        for row in q.execute().fetchall():
+            lists.setdefault(row[t.c.id], []).append(row[t.c.pkey])
+        for value, resource_ids in lists.items():
+            found[value] = tuple(resource_ids)
+
+    found = _cached_bulk_lookup(
+        values=connect._unique(values),
+        cache_key=lambda value: _secondary_cache_key(
+            dimension, resource, secondary_index, value),
+        query=query,
+        )
+    return dict(
+        [(value, list(resource_ids))
+         for value, resource_ids in found.items()])
+
+def get_dimension_values_bulk(hive_metadata, resource_name, resource_ids):
+    """
+    Look up the dimension values that resources are stored with.
+
+    @type resource_ids: iterable
+
+    @return: dict mapping resource ids that were found to dimension
+    values
+
+    @rtype: dict
+
+    @raise NoSuchResourceError: no such resource found
+    """
+    (dimension, resource) = _get_resource(hive_metadata, resource_name)
+    resource_ids = connect._unique(resource_ids)
+    if resource.is_partitioning_resource:
+        return dict([(resource_id, resource_id)
+                     for resource_id in resource_ids])
+    t = cache.get_cache(hive_metadata).get_resource_table(
+        dimension, resource)
+
+    def query(chunk, found):
+        q = sq.select(
+            [
+                t.c.id,
+                t.c.pkey,
+                ],
+            t.c.id.in_(chunk),
+            )
+        for row in q.execute().fetchall():
+            found[row[t.c.id]] = row[t.c.pkey]
+
+    return _cached_bulk_lookup(
+        values=resource_ids,
+        cache_key=lambda resource_id: _resource_cache_key(
+            dimension, resource, resource_id),
+        query=query,
+        )
+
+def get_engines_by_secondary_bulk(
+    hive_metadata,
+    resource_name,
+    column_name,
+    values,
+    write=True,
+    ):
+    """
+    Get engines for the nodes storing records with the given values
+    of the secondary index on C{column_name} of C{resource_name}.
+
+    A value may belong to several records, on several nodes.
+
+    @type values: iterable
+
+    @param write: see L{snakepit.connect.get_engine}
+
+    @type write: bool
+
+    @return: tuple of a dict mapping engines (shared, do not dispose)
+    to lists of values with records on that node, and a set of the
+    values not found
+
+    @rtype: tuple of (dict, set)
+
+    @raise NoSuchResourceError: no such resource found
+
+    @raise NoSuchSecondaryIndexError: no such secondary index found
+    """
+    values = connect._unique(values)
+    (dimension, resource) = _get_resource(hive_metadata, resource_name)
+    resource_ids = get_resource_ids_bulk(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name=column_name,
+        values=values,
+        )
+    dimension_values = get_dimension_values_bulk(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        resource_ids=itertools.chain(*resource_ids.values()),
+        )
+    (by_engine, _) = connect.get_engines_bulk(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension.name,
+        dimension_values=dimension_values.values(),
+        write=write,
+        )
+    engine_of = {}
+    for engine, engine_values in by_engine.items():
+        for dimension_value in engine_values:
+            engine_of[dimension_value] = engine
+
+    result = {}
+    missing = set()
+    for value in values:
+        found = False
+        seen = set()
+        for resource_id in resource_ids.get(value, []):
+            dimension_value = dimension_values.get(resource_id)
+            engine = engine_of.get(dimension_value)
+            if engine is None or engine in seen:
+                continue
+            seen.add(engine)
+            result.setdefault(engine, []).append(value)
+            found = True
+        if not found:
+            missing.add(value)
+    return (result, missing)
+
+def get_engines_by_secondary(hive_metadata, resource_name, column_name, value):
+    """
+    Get engines for the nodes storing records with C{value} in
+    secondary index on C{column_name} of C{resource_name}.
+
+    @return: engines, shared with other callers; do not dispose of
+    them
+
+    @rtype: list of sqlalchemy.engine.Engine
+
+    @raise NoSuchIdError: value not found
+    """
+    (by_engine, missing) = get_engines_by_secondary_bulk(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name=column_name,
+        values=[value],
+        )
+    if missing:
+        raise connect.NoSuchIdError(
+            'resource %r, column %r, value %r'
+            % (resource_name, column_name, value),
+            )
+    return by_engine.keys()
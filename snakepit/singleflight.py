@@ -0,0 +1,71 @@
+"""
+Coalesce concurrent identical calls into one.
+
+When many threads miss a cache for the same key at once, for example
+right after a deploy or a cache flush, only the first one runs the
+query; the others wait for it and share its result, or its error.
+Calls are only shared while in flight, nothing is cached.
+"""
+
+import sys
+import threading
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight(object):
+    """
+    Run at most one call per key at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Call C{fn}, unless a call for C{key} is already in flight, in
+        which case wait for that one instead.
+
+        @return: what C{fn} returned
+
+        @raise: whatever C{fn} raised
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                call.waiters += 1
+                leader = False
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            try:
+                call.result = fn()
+            except:
+                call.error = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+        return call.result
@@ -0,0 +1,290 @@
+"""
+Read-only snapshots of a primary index, for lookups without asking
+the directory database.
+
+A snapshot file holds a header, the ids of the directory sorted as
+fixed-width 64-bit integers, and a parallel array of 32-bit node
+ids. Processes map the file into memory and find ids by binary
+search, so every process on a machine shares one page-cached copy.
+
+Only dimensions with integer values can be snapshotted. Values
+assigned after the snapshot was written are not in it, and are
+looked up from the directory as usual. Once used for routing, a
+snapshot follows L{snakepit.changes} since it was taken, and stops
+answering for values moved or unassigned since, so those are looked
+up from the directory too. Past C{max_changed} changed values, a
+snapshot stops answering altogether and sets C{stale}; write new
+snapshots regularly, and use them for dimensions whose assignments
+rarely change.
+"""
+
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect, changes
+
+MAGIC = 'SNAKESNP'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sIIQd')
+_ID = struct.Struct('<q')
+_NODE = struct.Struct('<i')
+
+INTEGER_DB_TYPES = ['BIGINT', 'INTEGER', 'SMALLINT', 'TINYINT']
+
+FETCH_SIZE = 10000
+
+DEFAULT_MAX_CHANGED = 100000
+
+class UnsupportedDimensionTypeError(Exception):
+    """Only dimensions with integer values can be snapshotted"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+class BadSnapshotError(Exception):
+    """Not a directory snapshot"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def write_snapshot(hive_metadata, dimension_name, path):
+    """
+    Write the primary index of C{dimension_name} to C{path}.
+
+    Rows are streamed from the directory in id order, and the file is
+    renamed into place when complete, so readers never see a partial
+    snapshot.
+
+    @return: number of ids written
+
+    @rtype: int
+
+    @raise UnsupportedDimensionTypeError: values of the dimension are
+    not integers
+    """
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    if dimension.db_type not in INTEGER_DB_TYPES:
+        raise UnsupportedDimensionTypeError(
+            'dimension %r, db_type %s' % (dimension_name, dimension.db_type))
+    t_primary = c.get_primary_table(dimension)
+
+    # everything assigned before this is in the snapshot
+    taken = time.time()
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    nodes_path = '%s.nodes' % tmp_path
+    count = 0
+    f = open(tmp_path, 'wb')
+    try:
+        nodes = open(nodes_path, 'w+b')
+        try:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, 0, 0.0))
+            q = sq.select(
+                [
+                    t_primary.c.id,
+                    t_primary.c.node,
+                    ],
+                # fenced by a migration, ask the directory
+                t_primary.c.read_only==False,
+                order_by=[t_primary.c.id],
+                )
+            res = q.execute()
+            while True:
+                rows = res.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                f.write(''.join([_ID.pack(row[0]) for row in rows]))
+                nodes.write(''.join([_NODE.pack(row[1]) for row in rows]))
+                count += len(rows)
+            res.close()
+
+            nodes.seek(0)
+            while True:
+                data = nodes.read(1024*1024)
+                if not data:
+                    break
+                f.write(data)
+        finally:
+            nodes.close()
+            os.unlink(nodes_path)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, count, taken))
+        f.close()
+        os.rename(tmp_path, path)
+    except:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return count
+
+class _IdView(object):
+    # the id array of a mapped snapshot, as a sequence for bisect
+
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return _ID.unpack_from(self.data, self.offset + i*_ID.size)[0]
+
+class Snapshot(object):
+    """
+    A directory snapshot, mapped into memory.
+
+    @ivar taken: when the snapshot was started
+
+    @type taken: datetime.datetime
+
+    @ivar stale: more values changed since the snapshot was taken
+    than it keeps track of; all lookups go to the directory, and a
+    new snapshot should be used instead
+
+    @type stale: bool
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise BadSnapshotError(repr(path))
+            self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, version, _, count, taken) = _HEADER.unpack_from(self._map)
+        if (magic != MAGIC
+            or version != VERSION
+            or size != _HEADER.size + count*(_ID.size+_NODE.size)):
+            self._map.close()
+            raise BadSnapshotError(repr(path))
+        self.taken = datetime.datetime.fromtimestamp(taken)
+        self._ids = _IdView(self._map, _HEADER.size, count)
+        self._nodes = _HEADER.size + count*_ID.size
+        self._lock = threading.Lock()
+        self._follow = None
+        self._since = None
+        self._checked = None
+        self._changed = set()
+        self.stale = False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def follow(
+        self,
+        hive_metadata,
+        dimension_name,
+        poll_interval=1.0,
+        overlap=changes.DEFAULT_OVERLAP,
+        max_changed=DEFAULT_MAX_CHANGED,
+        ):
+        """
+        Check the directory for changes made since the snapshot was
+        taken, at most every C{poll_interval} seconds, and stop
+        answering for the values changed.
+
+        One lookup at a time does the checking; lookups meanwhile use
+        the changes found by the last check.
+
+        Called by L{snakepit.connect.use_snapshot}.
+
+        @param poll_interval: seconds a moved or unassigned value may
+        still be found at its old node
+
+        @type poll_interval: float
+
+        @param overlap: see L{snakepit.changes.iter_changes}
+
+        @type overlap: float
+
+        @param max_changed: most changed values to keep track of,
+        after which the snapshot is C{stale}
+
+        @type max_changed: int
+        """
+        self._lock.acquire()
+        try:
+            self._follow = (hive_metadata, dimension_name)
+            self.poll_interval = poll_interval
+            self.overlap = overlap
+            self.max_changed = max_changed
+            self._since = self.taken
+            self._checked = None
+            self._changed = set()
+            self.stale = False
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        now = time.time()
+        if (self._checked is not None
+            and now - self._checked < self.poll_interval):
+            return
+        # until the first check, nobody knows what changed
+        if not self._lock.acquire(self._checked is None):
+            # somebody else is checking
+            return
+        try:
+            if (self._follow is None
+                or (self._checked is not None
+                    and now - self._checked < self.poll_interval)):
+                return
+            (hive_metadata, dimension_name) = self._follow
+            for batch in changes.iter_changes(
+                hive_metadata=hive_metadata,
+                dimension_name=dimension_name,
+                since=self._since,
+                overlap=self.overlap,
+                ):
+                for change in batch:
+                    self._changed.add(change.id)
+                self._since = batch[-1].last_updated
+                if len(self._changed) > self.max_changed:
+                    self.stale = True
+                    self._follow = None
+                    self._changed = set()
+                    break
+            self._checked = now
+        finally:
+            self._lock.release()
+
+    def lookup(self, dimension_value):
+        """
+        Find the node of C{dimension_value}.
+
+        @return: node id, or C{None} if not in the snapshot, or
+        changed since it was taken
+
+        @rtype: int or None
+        """
+        if not isinstance(dimension_value, (int, long)):
+            return None
+        if self._follow is not None:
+            self._refresh()
+            if dimension_value in self._changed:
+                return None
+        if self.stale:
+            return None
+        i = bisect.bisect_left(self._ids, dimension_value)
+        if i == len(self._ids) or self._ids[i] != dimension_value:
+            return None
+        return _NODE.unpack_from(self._map, self._nodes + i*_NODE.size)[0]
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,117 @@
+"""
+Collect per-node load statistics into the hive.
+
+Run L{collect} periodically, e.g. with C{snakepit-collect-statistics}
+from cron. Routing processes pick the statistics up from
+C{node_statistics} and use them to place new records, see
+L{snakepit.placement}.
+"""
+
+import datetime
+import time
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect, engines, hive
+
+def _measure_latency(node):
+    engine = engines.get_engine(node.uri)
+    start = time.time()
+    try:
+        engine.execute('SELECT 1').close()
+    except sq.exc.DBAPIError:
+        return None
+    return time.time() - start
+
+def _count_records(c, dimension):
+    t_primary = c.get_primary_table(dimension)
+    q = sq.select(
+        [
+            t_primary.c.node,
+            sq.func.count('*').label('count'),
+            ],
+        group_by=[t_primary.c.node],
+        )
+    counts = {}
+    for row in q.execute().fetchall():
+        counts[row[t_primary.c.node]] = row['count']
+    return counts
+
+def _count_buckets(hive_metadata, dimension):
+    t = hive_metadata.tables['bucket_metadata']
+    q = sq.select(
+        [
+            t.c.node_id,
+            sq.func.count('*').label('count'),
+            ],
+        t.c.partition_dimension_id==dimension.id,
+        group_by=[t.c.node_id],
+        )
+    counts = {}
+    for row in q.execute().fetchall():
+        counts[row[t.c.node_id]] = row['count']
+    return counts
+
+def collect(hive_metadata, dimension_name):
+    """
+    Count the records of every node of C{dimension_name}, measure the
+    round-trip time to each node, and store the results in
+    C{node_statistics}.
+
+    Records are counted in the directory. For dimensions partitioned
+    by bucket, which have no directory, the buckets of each node are
+    counted instead, since those are what new records are placed by.
+
+    @return: statistics that were stored
+
+    @rtype: list of snakepit.cache.NodeStatistics
+
+    @raise UnsupportedPartitioningError: the dimension is partitioned
+    by range, where nodes are not picked by load
+    """
+    nodes = connect.get_nodes(hive_metadata, dimension_name)
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension.partitioning == hive.BUCKET:
+        counts = _count_buckets(hive_metadata, dimension)
+    elif dimension.partitioning == hive.DIRECTORY:
+        counts = _count_records(c, dimension)
+    else:
+        raise connect.UnsupportedPartitioningError(
+            'dimension %r, partitioning %s'
+            % (dimension_name, dimension.partitioning))
+
+    stats = []
+    for node in nodes:
+        stats.append(
+            cache.NodeStatistics(
+                node_id=node.id,
+                record_count=counts.get(node.id, 0),
+                latency=_measure_latency(node),
+                ),
+            )
+
+    if not stats:
+        return stats
+
+    t = hive_metadata.tables['node_statistics']
+    now = datetime.datetime.now()
+    def replace(conn):
+        conn.execute(
+            t.delete(t.c.node_id.in_([stat.node_id for stat in stats])),
+            )
+        conn.execute(
+            t.insert(),
+            [
+                dict(
+                    node_id=stat.node_id,
+                    record_count=stat.record_count,
+                    latency=stat.latency,
+                    last_updated=now,
+                    )
+                for stat in stats
+                ],
+            )
+    hive_metadata.bind.transaction(replace)
+    c.invalidate_statistics()
+    return stats
@@ -0,0 +1,164 @@
+from nose.tools import eq_
+
+import os
+
+from snakepit import hive, create, connect, cache, buckets
+
+from snakepit.test.util import maketemp, assert_raises
+
+def make_hive(tmp, bucket_count=4):
+    hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+    hive_metadata = create.create_hive(hive_uri)
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri=hive_uri,
+        db_type='INTEGER',
+        partitioning=hive.BUCKET,
+        bucket_count=bucket_count,
+        )
+    for name in ['node1', 'node2']:
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri='sqlite:///%s' % os.path.join(tmp, '%s.db' % name),
+            )
+    return hive_metadata
+
+class BucketOf_Test(object):
+
+    def test_stable(self):
+        # must not change between releases, or values move
+        eq_(buckets.bucket_of(1, 1024), 951)
+        eq_(buckets.bucket_of(1L, 1024), 951)
+        eq_(buckets.bucket_of('frob', 1024), 225)
+        eq_(buckets.bucket_of(u'frob', 1024), 225)
+
+    def test_range(self):
+        for value in range(100):
+            assert 0 <= buckets.bucket_of(value, 7) < 7
+
+class Bucket_Routing_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(dimension.partitioning, hive.BUCKET)
+        eq_(dimension.bucket_count, 4)
+
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        assert connect.get_engine(hive_metadata, 'frob', 1) is node_engine
+        eq_(c.get_bucket_nodes(dimension).keys(), [buckets.bucket_of(1, 4)])
+
+        # everything in the same bucket is on the same node
+        same = [v for v in range(2, 100) if buckets.bucket_of(v, 4)
+                == buckets.bucket_of(1, 4)][0]
+        assert connect.get_engine(hive_metadata, 'frob', same) is node_engine
+
+        values = range(100)
+        by_engine = connect.assign_nodes_bulk(hive_metadata, 'frob', values)
+        eq_(sorted(sum(by_engine.values(), [])), values)
+        eq_(len(c.get_bucket_nodes(dimension)), 4)
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', values),
+            (by_engine, set()),
+            )
+        hive_metadata.bind.dispose()
+
+    def test_other_process(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        other_metadata = connect.get_hive(str(hive_metadata.bind.url))
+        c = cache.get_cache(other_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(c.get_bucket_nodes(dimension), {})
+
+        revision = cache.get_revision(hive_metadata)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        # a new bucket does not make everybody reload
+        eq_(cache.get_revision(hive_metadata), revision)
+        assert connect.get_engine(other_metadata, 'frob', 1) is node_engine
+        other_metadata.bind.dispose()
+        hive_metadata.bind.dispose()
+
+    def test_move_bucket(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        bucket = buckets.bucket_of(1, 4)
+        create.move_bucket(hive_metadata, 'frob', bucket, 'node2')
+        eq_(
+            str(connect.get_engine(hive_metadata, 'frob', 1).url),
+            'sqlite:///%s' % os.path.join(tmp, 'node2.db'),
+            )
+        create.move_bucket(hive_metadata, 'frob', bucket, 'node1')
+        eq_(
+            str(connect.get_engine(hive_metadata, 'frob', 1).url),
+            'sqlite:///%s' % os.path.join(tmp, 'node1.db'),
+            )
+        eq_(c.get_bucket_nodes(dimension).keys(), [bucket])
+
+        e = assert_raises(
+            ValueError,
+            create.move_bucket,
+            hive_metadata,
+            'frob',
+            4,
+            'node1',
+            )
+        eq_(str(e), 'Bad bucket: 4')
+        assert_raises(
+            connect.NoSuchNodeError,
+            create.move_bucket,
+            hive_metadata,
+            'frob',
+            0,
+            'node3',
+            )
+        hive_metadata.bind.dispose()
+
+    def test_unassign(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        e = assert_raises(
+            connect.UnsupportedPartitioningError,
+            connect.unassign_node,
+            hive_metadata,
+            'frob',
+            1,
+            'node1',
+            )
+        eq_(
+            str(e),
+            'Not possible with the partitioning of the dimension:'
+            ' dimension %r, partitioning bucket' % 'frob',
+            )
+        hive_metadata.bind.dispose()
+
+    def test_bad_count(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        e = assert_raises(
+            ValueError,
+            create.create_dimension,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='sqlite://',
+            db_type='INTEGER',
+            partitioning=hive.BUCKET,
+            )
+        eq_(str(e), 'Bad bucket count: None')
+        hive_metadata.bind.dispose()
@@ -0,0 +1,334 @@
+from nose.tools import eq_
+
+import datetime
+import os
+import time
+import sqlalchemy as sq
+
+from snakepit import create, connect, cache, engines
+
+from snakepit.test.util import maketemp, assert_raises
+
+class Revision_Test(object):
+
+    def test_new_hive(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        eq_(cache.get_revision(hive_metadata), 0)
+        hive_metadata.bind.dispose()
+
+    def test_bump(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        eq_(cache.get_revision(hive_metadata), 1)
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='fake-node-uri',
+            )
+        eq_(cache.get_revision(hive_metadata), 2)
+        hive_metadata.bind.dispose()
+
+    def test_bump_missing_row(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        hive_metadata.tables['semaphore_metadata'].delete().execute()
+        eq_(cache.get_revision(hive_metadata), 0)
+        create.bump_revision(hive_metadata)
+        eq_(cache.get_revision(hive_metadata), 1)
+        hive_metadata.bind.dispose()
+
+class ReadOnly_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        c = cache.get_cache(hive_metadata)
+        eq_(c.is_read_only(), False)
+        create.set_read_only(hive_metadata, True)
+        eq_(c.is_read_only(), True)
+        create.set_read_only(hive_metadata, False)
+        eq_(c.is_read_only(), False)
+        hive_metadata.bind.dispose()
+
+    def test_background(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        c = cache.get_cache(hive_metadata)
+        c.poll_interval = 0.01
+        c.start()
+        try:
+            eq_(c.is_read_only(), False)
+            # as if set by another process
+            t = hive_metadata.tables['semaphore_metadata']
+            t.update(values={t.c.read_only: True}).execute()
+            for i in range(100):
+                if c.is_read_only():
+                    break
+                time.sleep(0.01)
+            eq_(c.is_read_only(), True)
+        finally:
+            c.stop()
+        hive_metadata.bind.dispose()
+
+class HiveMetadataCache_Test(object):
+
+    def test_cached(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        node_id = create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='fake-node-uri',
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(dimension.id, dimension_id)
+        eq_(dimension.index_uri, 'fake-dir-uri')
+        eq_(dimension.db_type, 'INTEGER')
+        node = c.get_node(dimension, node_id)
+        eq_(node.name, 'node1')
+        eq_(node.uri, 'fake-node-uri')
+        eq_(node.read_only, False)
+
+        # changes without a revision bump go unnoticed
+        t = hive_metadata.tables['node_metadata']
+        t.update(values={t.c.uri: 'changed-uri'}).execute()
+        c.refresh(force=True)
+        eq_(c.get_node(dimension, node_id).uri, 'fake-node-uri')
+
+        create.bump_revision(hive_metadata)
+        eq_(c.get_node(dimension, node_id).uri, 'changed-uri')
+        hive_metadata.bind.dispose()
+
+    def test_other_process(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        c = cache.get_cache(hive_metadata)
+        eq_(c.get_dimension('frob'), None)
+
+        other_metadata = connect.get_hive(hive_uri)
+        dimension_id = create.create_dimension(
+            hive_metadata=other_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        other_metadata.bind.dispose()
+
+        # a miss always checks the revision
+        eq_(c.get_dimension('frob').id, dimension_id)
+        hive_metadata.bind.dispose()
+
+    def test_hive_down(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        c = cache.get_cache(hive_metadata)
+        c.poll_interval = 5
+        eq_(c.get_dimension('frob').id, dimension_id)
+
+        # polls fail from now on
+        hive_metadata.tables['semaphore_metadata'].drop()
+        c._next_check = 0
+        eq_(c.get_dimension('frob').id, dimension_id)
+        eq_(c._failures, 1)
+        # backing off, no more polls for now
+        eq_(c.get_dimension('frob').id, dimension_id)
+        eq_(c.is_read_only(), False)
+        eq_(c._failures, 1)
+        assert c._next_check > time.time() + 9
+        assert_raises(sq.exc.SQLAlchemyError, c.refresh, force=True)
+        eq_(c._failures, 2)
+        hive_metadata.bind.dispose()
+
+    def test_get_nodes(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(c.get_nodes(dimension), [])
+        for name in ['node1', 'node2']:
+            create.create_node(
+                hive_metadata=hive_metadata,
+                dimension_id=dimension_id,
+                node_name=name,
+                node_uri='fake-node-uri',
+                )
+        got = [node.name for node in c.get_nodes(dimension)]
+        eq_(got, ['node1', 'node2'])
+        eq_(c.get_node_by_name(dimension, 'node2').name, 'node2')
+        eq_(c.get_node_by_name(dimension, 'node3'), None)
+        hive_metadata.bind.dispose()
+
+    def test_primary_table(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+        directory_metadata = create.create_primary_index(
+            directory_uri=directory_uri,
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=directory_uri,
+            db_type='INTEGER',
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        t = c.get_primary_table(dimension)
+        eq_(t.name, 'hive_primary_frob')
+        assert t.bind is engines.get_engine(directory_uri)
+        assert c.get_primary_table(dimension) is t
+        hive_metadata.bind.dispose()
+
+    def test_primary_statements(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+        directory_metadata = create.create_primary_index(
+            directory_uri=directory_uri,
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=directory_uri,
+            db_type='INTEGER',
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        statements = c.get_primary_statements(dimension)
+        assert c.get_primary_statements(dimension) is statements
+        statements.insert.execute(
+            id=42,
+            node=3,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        eq_(list(statements.lookup.execute(b_id=42).fetchone()), [3, False])
+        eq_(statements.lookup.execute(b_id=43).fetchone(), None)
+        eq_(statements.delete.execute(b_id=42, b_node=2).rowcount, 0)
+        eq_(statements.delete.execute(b_id=42, b_node=3).rowcount, 1)
+
+        # compiled statements are kept until the metadata changes
+        create.bump_revision(hive_metadata)
+        dimension = c.get_dimension('frob')
+        assert c.get_primary_statements(dimension) is not statements
+        hive_metadata.bind.dispose()
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class DirectoryCache_Test(object):
+
+    def test_simple(self):
+        c = cache.DirectoryCache()
+        eq_(c.get('a'), (False, None))
+        c.put('a', 42)
+        eq_(c.get('a'), (True, 42))
+        c.evict('a')
+        eq_(c.get('a'), (False, None))
+        eq_(
+            c.stats(),
+            dict(entries=0, hits=1, misses=2, evictions=0),
+            )
+
+    def test_lru(self):
+        c = cache.DirectoryCache(max_entries=2)
+        c.put('a', 1)
+        c.put('b', 2)
+        # touch a, so b is least recently used
+        eq_(c.get('a'), (True, 1))
+        c.put('c', 3)
+        eq_(len(c), 2)
+        eq_(c.evictions, 1)
+        eq_(c.get('b'), (False, None))
+        eq_(c.get('a'), (True, 1))
+        eq_(c.get('c'), (True, 3))
+
+    def test_ttl(self):
+        clock = FakeClock()
+        c = cache.DirectoryCache(ttl=10, negative_ttl=1, clock=clock)
+        c.put('a', 1)
+        c.put('b', None)
+        eq_(c.get('b'), (True, None))
+        clock.now += 5
+        eq_(c.get('a'), (True, 1))
+        eq_(c.get('b'), (False, None))
+        clock.now += 6
+        eq_(c.get('a'), (False, None))
+
+    def test_no_negative(self):
+        c = cache.DirectoryCache(negative_ttl=0)
+        c.put('a', 1)
+        c.put('a', None)
+        eq_(c.get('a'), (False, None))
+
+    def test_lookup_race(self):
+        c = cache.DirectoryCache()
+        # a lookup that found nothing loses to an assignment made
+        # while it was asking
+        token = c.begin('a')
+        c.put('a', 42)
+        c.put('a', None, token)
+        eq_(c.get('a'), (True, 42))
+        # and to an eviction
+        token = c.begin('a')
+        c.evict('a')
+        c.put('a', 1, token)
+        eq_(c.get('a'), (False, None))
+        # only the latest lookup counts
+        first = c.begin('a')
+        second = c.begin('a')
+        c.put('a', 1, first)
+        eq_(c.get('a'), (False, None))
+        c.put('a', 2, second)
+        eq_(c.get('a'), (True, 2))
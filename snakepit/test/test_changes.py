@@ -0,0 +1,181 @@
+from nose.tools import eq_
+
+import datetime
+import time
+
+import sqlalchemy as sq
+
+from snakepit import connect, cache, changes
+
+from snakepit.test.util import maketemp
+from snakepit.test.test_snapshot import make_hive
+
+def summary(batches):
+    return [
+        [(change.id, change.deleted) for change in batch]
+        for batch in batches
+        ]
+
+def node_of(hive_metadata, node_engine):
+    c = cache.get_cache(hive_metadata)
+    for node in c.get_nodes(c.get_dimension('frob')):
+        if node.uri == str(node_engine.url):
+            return node
+
+class IterChanges_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        time.sleep(0.01)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 2)
+        time.sleep(0.01)
+        connect.assign_node(hive_metadata, 'frob', 3)
+        time.sleep(0.01)
+        node = node_of(hive_metadata, node_engine)
+        connect.unassign_node(hive_metadata, 'frob', 2, node.name)
+
+        batches = list(changes.iter_changes(
+                hive_metadata, 'frob', batch_size=2))
+        eq_(
+            summary(batches),
+            [[(1, False), (3, False)], [(2, True)]],
+            )
+        deleted = batches[-1][-1]
+        eq_(deleted.node, node.id)
+        assert isinstance(deleted.last_updated, datetime.datetime)
+
+        # resume from the second change
+        since = batches[0][1].last_updated
+        eq_(
+            summary(changes.iter_changes(
+                    hive_metadata, 'frob', since, overlap=0)),
+            [[(3, False), (2, True)]],
+            )
+        eq_(
+            summary(changes.iter_changes(
+                    hive_metadata, 'frob', deleted.last_updated,
+                    overlap=0)),
+            [[(2, True)]],
+            )
+        # by default, recent changes are delivered again
+        eq_(
+            summary(changes.iter_changes(hive_metadata, 'frob', since)),
+            [[(1, False), (3, False), (2, True)]],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_late_commit(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        t_primary = c.get_primary_table(c.get_dimension('frob'))
+        node_engine = connect.assign_node(hive_metadata, 'frob', 2)
+        since = list(changes.iter_changes(hive_metadata, 'frob'))[-1][-1]
+        # stamped before 2, but committed after the consumer read 2
+        t_primary.insert().execute(
+            id=1,
+            node=node_of(hive_metadata, node_engine).id,
+            secondary_index_count=0,
+            last_updated=since.last_updated - datetime.timedelta(seconds=1),
+            read_only=False,
+            )
+        eq_(
+            summary(changes.iter_changes(
+                    hive_metadata, 'frob', since.last_updated)),
+            [[(1, False), (2, False)]],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_reassigned(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        node = node_of(hive_metadata, node_engine)
+        connect.unassign_node(hive_metadata, 'frob', 1, node.name)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        # in the same clock tick as the unassign
+        t_tombstone = c.get_tombstone_table(dimension)
+        (stamp,) = sq.select([t_tombstone.c.last_updated]).execute().fetchone()
+        t_primary = c.get_primary_table(dimension)
+        t_primary.update(values={t_primary.c.last_updated: stamp}).execute()
+        eq_(
+            summary(changes.iter_changes(hive_metadata, 'frob')),
+            [[(1, False)]],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_fenced(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        since = datetime.datetime.now()
+        c = cache.get_cache(hive_metadata)
+        t_primary = c.get_primary_table(c.get_dimension('frob'))
+        t_primary.update(
+            values={
+                t_primary.c.read_only: True,
+                t_primary.c.last_updated: datetime.datetime.now(),
+                },
+            ).execute()
+        (batch,) = list(changes.iter_changes(
+                hive_metadata, 'frob', since=since, overlap=0))
+        eq_([(change.id, change.read_only) for change in batch], [(1, True)])
+        hive_metadata.bind.dispose()
+
+    def test_evict_changed(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        dir_cache = connect.configure_directory_cache()
+        try:
+            connect.assign_nodes_bulk(hive_metadata, 'frob', [1, 2])
+            since = changes.evict_changed(hive_metadata, 'frob', None)
+            eq_(len(dir_cache), 0)
+            assert isinstance(since, datetime.datetime)
+
+            connect.get_engines_bulk(hive_metadata, 'frob', [1, 2, 3])
+            eq_(len(dir_cache), 3)
+            time.sleep(0.01)
+            connect.assign_node(hive_metadata, 'frob', 3)
+            dir_cache.put(
+                connect._directory_cache_key(
+                    cache.get_cache(hive_metadata).get_dimension('frob'),
+                    3),
+                None,
+                )
+            got = changes.evict_changed(hive_metadata, 'frob', since)
+            assert got > since
+            # 1 and 2 are at the old cursor, and get evicted again
+            eq_(len(dir_cache), 0)
+            eq_(changes.evict_changed(hive_metadata, 'frob', got), got)
+        finally:
+            connect.disable_directory_cache()
+        hive_metadata.bind.dispose()
+
+    def test_purge_tombstones(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        node = node_of(hive_metadata, node_engine)
+        connect.unassign_node(hive_metadata, 'frob', 1, node.name)
+        eq_(
+            changes.purge_tombstones(
+                hive_metadata,
+                'frob',
+                datetime.datetime.now() - datetime.timedelta(hours=1),
+                ),
+            0,
+            )
+        eq_(
+            changes.purge_tombstones(
+                hive_metadata,
+                'frob',
+                datetime.datetime.now() + datetime.timedelta(seconds=1),
+                ),
+            1,
+            )
+        eq_(list(changes.iter_changes(hive_metadata, 'frob')), [])
+        hive_metadata.bind.dispose()
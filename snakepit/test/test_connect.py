@@ -1,12 +1,14 @@
 import nose
 from nose.tools import eq_
 
+import datetime
 import os
 import sqlalchemy as sq
 
-from snakepit import create, connect
+from snakepit import create, connect, cache, changes, placement
 
 from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
 
 class Get_Hive_Test(object):
 
@@ -40,6 +42,8 @@ class Get_Hive_Test(object):
                     id=dimension_id,
                     name='frob',
                     index_uri=hive_uri,
+                    partitioning='directory',
+                    bucket_count=None,
                     ),
                 ],
             )
@@ -89,7 +93,6 @@ class Get_Engine_Test(object):
             dimension_name='frob',
             dimension_value=1,
             )
-        node_engine.dispose()
 
         got = connect.get_engine(
             hive_metadata=hive_metadata,
@@ -98,7 +101,6 @@ class Get_Engine_Test(object):
             )
         assert isinstance(got, sq.engine.Engine)
         eq_(str(got.url), str(p42_metadata.bind.url))
-        got.dispose()
         hive_metadata.bind.dispose()
         p42_metadata.bind.dispose()
 
@@ -153,7 +155,6 @@ class Get_Engine_Test(object):
             dimension_name='frob',
             dimension_value=dimension_value,
             )
-        node_engine.dispose()
         directory_metadata.bind.dispose()
         e = assert_raises(
             connect.NoSuchIdError,
@@ -198,8 +199,8 @@ class Get_Engine_Test(object):
             dimension_name='frob',
             dimension_value=1,
             )
-        node_engine.dispose()
         hive_metadata.tables['node_metadata'].delete().execute()
+        create.bump_revision(hive_metadata)
         hive_metadata.bind.dispose()
 
         e = assert_raises(
@@ -215,6 +216,141 @@ class Get_Engine_Test(object):
                 % ('frob', node_id)
             )
 
+class Get_Engine_Hive_Directory_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        directory_metadata = create.create_primary_index(
+            directory_uri=hive_uri,
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            )
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node34',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'p34.db'),
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        assert c.in_hive_database(dimension)
+        assert c.get_primary_statements(dimension).lookup_node is not None
+
+        # another process adds a node and assigns a value to it; the
+        # joined lookup finds the node without reloading the metadata
+        t_node = hive_metadata.tables['node_metadata']
+        res = t_node.insert().execute(
+            partition_dimension_id=dimension_id,
+            name='node35',
+            uri='sqlite:///%s' % os.path.join(tmp, 'p35.db'),
+            read_only=False,
+            )
+        (node_id,) = res.last_inserted_ids()
+        t_primary = c.get_primary_table(dimension)
+        t_primary.insert().execute(
+            id=1,
+            node=node_id,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        node_engine = connect.get_engine(hive_metadata, 'frob', 1)
+        eq_(
+            str(node_engine.url),
+            'sqlite:///%s' % os.path.join(tmp, 'p35.db'),
+            )
+        eq_(c.get_node(dimension, node_id), None)
+
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            2,
+            )
+        hive_metadata.bind.dispose()
+
+    def test_other_dimension(self):
+        tmp = maketemp()
+
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        for dimension_name in ['frob', 'quux']:
+            directory_metadata = create.create_primary_index(
+                directory_uri=hive_uri,
+                dimension_name=dimension_name,
+                db_type='INTEGER',
+                )
+            directory_metadata.bind.dispose()
+            dimension_id = create.create_dimension(
+                hive_metadata=hive_metadata,
+                dimension_name=dimension_name,
+                directory_uri=hive_uri,
+                db_type='INTEGER',
+                )
+        quux_node_id = create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node34',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'p34.db'),
+            )
+
+        # points at a node of another dimension
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        c.get_primary_table(dimension).insert().execute(
+            id=1,
+            node=quux_node_id,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        e = assert_raises(
+            connect.NoSuchNodeError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        eq_(
+            str(e),
+            'No such node: dimension %r, node_id %d' % ('frob', quux_node_id),
+            )
+        hive_metadata.bind.dispose()
+
+    def test_separate(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+        directory_metadata = create.create_primary_index(
+            directory_uri=directory_uri,
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=directory_uri,
+            db_type='INTEGER',
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        assert not c.in_hive_database(dimension)
+        eq_(c.get_primary_statements(dimension).lookup_node, None)
+        hive_metadata.bind.dispose()
 
 class AssignNode_Test(object):
 
@@ -259,7 +395,6 @@ class AssignNode_Test(object):
         node_engine = connect.assign_node(hive_metadata, 'frob', 1)
         assert isinstance(node_engine, sq.engine.Engine)
         eq_(str(node_engine.url), str(p42_metadata.bind.url))
-        node_engine.dispose()
 
     def test_repeat(self):
         # assign_node is idempotent and shouldn't even be racy against
@@ -303,12 +438,10 @@ class AssignNode_Test(object):
         node_engine = connect.assign_node(hive_metadata, 'frob', 1)
         assert isinstance(node_engine, sq.engine.Engine)
         eq_(str(node_engine.url), str(p42_metadata.bind.url))
-        node_engine.dispose()
 
         node_engine = connect.assign_node(hive_metadata, 'frob', 1)
         assert isinstance(node_engine, sq.engine.Engine)
         eq_(str(node_engine.url), str(p42_metadata.bind.url))
-        node_engine.dispose()
 
         t = directory_metadata.tables['hive_primary_frob']
         q = sq.select(
@@ -359,6 +492,107 @@ class AssignNode_Test(object):
             )
 
 
+    def test_bad_read_only(self):
+        tmp = maketemp()
+
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' \
+                % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='sqlite://',
+            read_only=True,
+            )
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node2',
+            node_uri='sqlite://',
+            capacity=0,
+            )
+
+        e = assert_raises(
+            connect.NoWritableNodesError,
+            connect.assign_node,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        eq_(
+            str(e),
+            'All nodes of dimension are read-only, full or unavailable: %r'
+            % 'frob',
+            )
+        hive_metadata.bind.dispose()
+        directory_metadata.bind.dispose()
+
+    def test_bad_read_only_hive(self):
+        tmp = maketemp()
+
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' \
+                % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='sqlite://',
+            )
+        create.set_read_only(hive_metadata, True)
+
+        for fn, args in [
+            (connect.assign_node, (1,)),
+            (connect.assign_nodes_bulk, ([1, 2],)),
+            (connect.unassign_node, (1, 'node1')),
+            ]:
+            e = assert_raises(
+                connect.HiveReadOnlyError,
+                fn,
+                hive_metadata,
+                'frob',
+                *args
+                )
+            eq_(str(e), 'Hive is read-only')
+        assert_raises(
+            connect.HiveReadOnlyError,
+            create.create_node,
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node2',
+            node_uri='sqlite://',
+            )
+
+        create.set_read_only(hive_metadata, False)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        hive_metadata.bind.dispose()
+        directory_metadata.bind.dispose()
+
 class UnassignNode_Test(object):
 
     def test_simple(self):
@@ -402,7 +636,6 @@ class UnassignNode_Test(object):
         node_engine = connect.assign_node(hive_metadata, 'frob', 1)
         assert isinstance(node_engine, sq.engine.Engine)
         eq_(str(node_engine.url), str(p42_metadata.bind.url))
-        node_engine.dispose()
 
         got = connect.unassign_node(
             hive_metadata=hive_metadata,
@@ -522,3 +755,385 @@ class UnassignNode_Test(object):
             +' dimension %r value %r, node name %r'
             % ('frob', 1, 'node42'),
             )
+
+
+class GetEnginesBulk_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        for name in ['node1', 'node2']:
+            create.create_node(
+                hive_metadata=hive_metadata,
+                dimension_id=dimension_id,
+                node_name=name,
+                node_uri='sqlite:///%s' % os.path.join(tmp, name+'.db'),
+                )
+        want = {}
+        for value in range(20):
+            node_engine = connect.assign_node(hive_metadata, 'frob', value)
+            want.setdefault(node_engine, []).append(value)
+
+        old_chunk_size = connect.BULK_CHUNK_SIZE
+        connect.BULK_CHUNK_SIZE = 3
+        try:
+            (got, missing) = connect.get_engines_bulk(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                dimension_values=range(25) + [4],
+                )
+        finally:
+            connect.BULK_CHUNK_SIZE = old_chunk_size
+        eq_(got, want)
+        eq_(missing, set(range(20, 25)))
+        hive_metadata.bind.dispose()
+
+    def test_bad_dimension(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        e = assert_raises(
+            connect.NoSuchDimensionError,
+            connect.get_engines_bulk,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=[1, 2],
+            )
+        eq_(
+            str(e),
+            'No such dimension: %r' % 'frob',
+            )
+        hive_metadata.bind.dispose()
+
+
+class AssignNodesBulk_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        for name in ['node1', 'node2']:
+            create.create_node(
+                hive_metadata=hive_metadata,
+                dimension_id=dimension_id,
+                node_name=name,
+                node_uri='sqlite:///%s' % os.path.join(tmp, name+'.db'),
+                )
+        old_engine = connect.assign_node(hive_metadata, 'frob', 3)
+
+        old_chunk_size = connect.BULK_CHUNK_SIZE
+        connect.BULK_CHUNK_SIZE = 4
+        try:
+            got = connect.assign_nodes_bulk(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                dimension_values=range(10) + [5],
+                )
+        finally:
+            connect.BULK_CHUNK_SIZE = old_chunk_size
+        assert 3 in got[old_engine]
+        eq_(sorted(sum(got.values(), [])), range(10))
+
+        (want, missing) = connect.get_engines_bulk(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=range(10),
+            )
+        eq_(got, want)
+        eq_(missing, set())
+
+        t = directory_metadata.tables['hive_primary_frob']
+        q = sq.select(
+            [sq.func.count('*').label('count')],
+            from_obj=[t],
+            )
+        r = q.execute().fetchone()
+        eq_(r['count'], 10)
+        directory_metadata.bind.dispose()
+        hive_metadata.bind.dispose()
+
+    def test_concurrent(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        for name in ['node1', 'node2']:
+            create.create_node(
+                hive_metadata=hive_metadata,
+                dimension_id=dimension_id,
+                node_name=name,
+                node_uri='sqlite:///%s' % os.path.join(tmp, name+'.db'),
+                )
+        c = cache.get_cache(hive_metadata)
+        node2 = c.get_node_by_name(c.get_dimension('frob'), 'node2')
+
+        t = directory_metadata.tables['hive_primary_frob']
+        class RacingPlacement(object):
+            # another process assigns 2 while we are picking
+            raced = False
+            def pick(self, nodes, get_statistics):
+                if not self.raced:
+                    self.raced = True
+                    t.insert().execute(
+                        id=2,
+                        node=node2.id,
+                        secondary_index_count=0,
+                        last_updated=datetime.datetime.now(),
+                        read_only=False,
+                        )
+                return nodes[0]
+        connect.configure_placement(RacingPlacement())
+        try:
+            got = connect.assign_nodes_bulk(hive_metadata, 'frob', [1, 2])
+        finally:
+            connect.configure_placement(placement.RandomPlacement())
+        got = dict(
+            [(str(engine.url), values) for engine, values in got.items()])
+        eq_(
+            got,
+            {
+                'sqlite:///%s' % os.path.join(tmp, 'node1.db'): [1],
+                'sqlite:///%s' % os.path.join(tmp, 'node2.db'): [2],
+                },
+            )
+        directory_metadata.bind.dispose()
+        hive_metadata.bind.dispose()
+
+    def test_bad_no_node(self):
+        tmp = maketemp()
+
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' \
+                % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        e = assert_raises(
+            connect.NoNodesForDimensionError,
+            connect.assign_nodes_bulk,
+            hive_metadata,
+            'frob',
+            [1, 2],
+            )
+        eq_(
+            str(e),
+            'No nodes found for dimension: %r' % 'frob',
+            )
+        t = directory_metadata.tables['hive_primary_frob']
+        eq_(t.select().execute().fetchall(), [])
+        directory_metadata.bind.dispose()
+        hive_metadata.bind.dispose()
+
+
+class DirectoryCache_Test(object):
+
+    def setUp(self):
+        self.directory_cache = connect.configure_directory_cache()
+
+    def tearDown(self):
+        connect.disable_directory_cache()
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node42',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'p42.db'),
+            )
+
+        e = assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        # cached as missing, but assigning updates the cache
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        eq_(self.directory_cache.misses, 1)
+
+        # answered from the cache, even behind the directory's back
+        t = directory_metadata.tables['hive_primary_frob']
+        t.delete().execute()
+        got = connect.get_engine(hive_metadata, 'frob', 1)
+        assert got is node_engine
+        eq_(self.directory_cache.hits, 1)
+
+        connect.assign_node(hive_metadata, 'frob', 1)
+        connect.unassign_node(hive_metadata, 'frob', 1, 'node42')
+        e = assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        directory_metadata.bind.dispose()
+        hive_metadata.bind.dispose()
+
+    def test_bulk(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node42',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'p42.db'),
+            )
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        (got, missing) = connect.get_engines_bulk(
+            hive_metadata, 'frob', [1, 2])
+        eq_(got, {node_engine: [1]})
+        eq_(missing, set([2]))
+        eq_(self.directory_cache.hits, 1)
+        eq_(self.directory_cache.misses, 1)
+
+        got = connect.assign_nodes_bulk(hive_metadata, 'frob', [2, 3])
+        eq_(got, {node_engine: [2, 3]})
+        got = connect.get_engine(hive_metadata, 'frob', 3)
+        eq_(self.directory_cache.hits, 2)
+        hive_metadata.bind.dispose()
+
+    def test_read_only(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        c = cache.get_cache(hive_metadata)
+        t_primary = c.get_primary_table(c.get_dimension('frob'))
+        since = datetime.datetime.now()
+        # fenced by a migration in another process
+        t_primary.update(
+            values={
+                t_primary.c.read_only: True,
+                t_primary.c.last_updated: datetime.datetime.now(),
+                },
+            ).execute()
+
+        # writes are routed from the cache until it hears of the fence
+        assert connect.get_engine(hive_metadata, 'frob', 1) is node_engine
+        eq_(self.directory_cache.hits, 1)
+        changes.evict_changed(hive_metadata, 'frob', since)
+
+        # reads go on, from the directory
+        got = connect.get_engine(hive_metadata, 'frob', 1, write=False)
+        assert got is node_engine
+        eq_(self.directory_cache.hits, 1)
+        e = assert_raises(
+            connect.IdReadOnlyError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        eq_(
+            str(e),
+            'Id is read-only: dimension %r, dimension_value 1' % 'frob',
+            )
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1], write=False),
+            ({node_engine: [1]}, set()),
+            )
+        assert_raises(
+            connect.IdReadOnlyError,
+            connect.get_engines_bulk,
+            hive_metadata,
+            'frob',
+            [1],
+            )
+        assert_raises(
+            connect.IdReadOnlyError,
+            connect.assign_node,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        assert_raises(
+            connect.IdReadOnlyError,
+            connect.assign_nodes_bulk,
+            hive_metadata,
+            'frob',
+            [2, 1],
+            )
+        # nothing was assigned
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [2]),
+            ({}, set([2])),
+            )
+
+        t_primary.update(values={t_primary.c.read_only: False}).execute()
+        assert connect.get_engine(hive_metadata, 'frob', 1) is node_engine
+        hive_metadata.bind.dispose()
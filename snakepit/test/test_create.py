@@ -1,10 +1,11 @@
 import nose
 from nose.tools import eq_
 
+import datetime
 import os
 import sqlalchemy as sq
 
-from snakepit import hive, create
+from snakepit import hive, create, directory, cache, connect
 
 from snakepit.test.util import maketemp, assert_raises
 
@@ -61,10 +62,10 @@ class Create_Primary_Index_Test(object):
         got = res.fetchall()
         res.close()
         engine.dispose()
-        got = [row[0] for row in got]
+        got = sorted([row[0] for row in got])
         eq_(
             got,
-            ['hive_primary_frob'],
+            ['hive_primary_frob', 'hive_tombstone_frob'],
             )
 
     def test_repeat(self):
@@ -83,6 +84,42 @@ class Create_Primary_Index_Test(object):
             )
         directory_metadata.bind.dispose()
 
+    def test_primary_key(self):
+        tmp = maketemp()
+        directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+
+        directory_metadata = create.create_primary_index(
+            directory_uri=directory_uri,
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        t = directory_metadata.tables['hive_primary_frob']
+        eq_([c.name for c in t.primary_key.columns], ['id'])
+        # asking again must not add another id column
+        assert directory.get_primary_table(
+            directory_metadata=directory_metadata,
+            dimension_name='frob',
+            db_type='INTEGER',
+            ) is t
+        eq_([c.name for c in t.columns].count('id'), 1)
+        t.insert().execute(
+            id=1,
+            node=1,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        assert_raises(
+            sq.exc.IntegrityError,
+            t.insert().execute,
+            id=1,
+            node=2,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        directory_metadata.bind.dispose()
+
     def test_types(self):
         for typename, sqlalch_type in [
             ('BIGINT', sq.Integer),
@@ -251,3 +288,240 @@ class Create_Node_Test(object):
             str(e),
             'Node exists already: %r' % 'node1',
             )
+
+
+class Update_Node_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        node_id = create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='fake-node-uri',
+            weight=2.0,
+            capacity=100,
+            )
+        c = cache.get_cache(hive_metadata)
+        node = c.get_node_by_name(c.get_dimension('frob'), 'node1')
+        eq_(node.id, node_id)
+        eq_(node.read_only, False)
+        eq_(node.weight, 2.0)
+        eq_(node.capacity, 100)
+
+        create.update_node(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            node_name='node1',
+            read_only=True,
+            capacity=None,
+            )
+        node = c.get_node_by_name(c.get_dimension('frob'), 'node1')
+        eq_(node.read_only, True)
+        eq_(node.weight, 2.0)
+        eq_(node.capacity, None)
+        hive_metadata.bind.dispose()
+
+    def test_bad_weight(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        e = assert_raises(
+            ValueError,
+            create.create_node,
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='fake-node-uri',
+            weight=-1.0,
+            )
+        eq_(str(e), 'Bad weight: -1.0')
+        hive_metadata.bind.dispose()
+
+    def test_bad_no_node(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri='fake-dir-uri',
+            db_type='INTEGER',
+            )
+        assert_raises(
+            connect.NoSuchNodeError,
+            create.update_node,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            node_name='node1',
+            weight=1.0,
+            )
+        hive_metadata.bind.dispose()
+
+class Create_Resource_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            )
+        resource_id = create.create_resource(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            resource_name='post',
+            db_type='INTEGER',
+            )
+
+        t = hive_metadata.tables['resource_metadata']
+        got = [dict(row) for row in t.select().execute().fetchall()]
+        eq_(
+            got,
+            [
+                dict(
+                    id=resource_id,
+                    dimension_id=dimension_id,
+                    name='post',
+                    db_type='INTEGER',
+                    is_partitioning_resource=False,
+                    ),
+                ],
+            )
+        res = hive_metadata.bind.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type='table' AND name LIKE 'hive_resource_%'")
+        got = [row[0] for row in res.fetchall()]
+        res.close()
+        eq_(got, ['hive_resource_post'])
+        hive_metadata.bind.dispose()
+
+    def test_repeat(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            )
+        create.create_resource(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            resource_name='post',
+            db_type='INTEGER',
+            )
+        e = assert_raises(
+            create.ResourceExistsError,
+            create.create_resource,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            resource_name='post',
+            db_type='INTEGER',
+            )
+        hive_metadata.bind.dispose()
+        eq_(
+            str(e),
+            'Resource exists already: %r' % 'post',
+            )
+
+class Create_Secondary_Index_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            )
+        resource_id = create.create_resource(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            resource_name='post',
+            db_type='INTEGER',
+            is_partitioning_resource=True,
+            )
+        secondary_index_id = create.create_secondary_index(
+            hive_metadata=hive_metadata,
+            resource_name='post',
+            column_name='title',
+            db_type='CHAR',
+            )
+
+        t = hive_metadata.tables['secondary_index_metadata']
+        got = [dict(row) for row in t.select().execute().fetchall()]
+        eq_(
+            got,
+            [
+                dict(
+                    id=secondary_index_id,
+                    resource_id=resource_id,
+                    column_name='title',
+                    db_type='CHAR',
+                    ),
+                ],
+            )
+        res = hive_metadata.bind.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type='table' AND name LIKE 'hive_%'")
+        got = [row[0] for row in res.fetchall()]
+        res.close()
+        eq_(got, ['hive_secondary_post_title'])
+        hive_metadata.bind.dispose()
+
+    def test_repeat(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            )
+        create.create_resource(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            resource_name='post',
+            db_type='INTEGER',
+            )
+        create.create_secondary_index(
+            hive_metadata=hive_metadata,
+            resource_name='post',
+            column_name='title',
+            db_type='CHAR',
+            )
+        e = assert_raises(
+            create.SecondaryIndexExistsError,
+            create.create_secondary_index,
+            hive_metadata=hive_metadata,
+            resource_name='post',
+            column_name='title',
+            db_type='CHAR',
+            )
+        hive_metadata.bind.dispose()
+        eq_(
+            str(e),
+            'Secondary index exists already: %r.%r' % ('post', 'title'),
+            )
@@ -0,0 +1,39 @@
+from nose.tools import eq_
+
+import os
+import sqlalchemy as sq
+
+from snakepit import engines
+
+from snakepit.test.util import maketemp
+
+class EngineRegistry_Test(object):
+
+    def test_shared(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'node.db')
+        registry = engines.EngineRegistry()
+        a = registry.get_engine(uri)
+        assert isinstance(a, sq.engine.Engine)
+        eq_(str(a.url), uri)
+        b = registry.get_engine(uri)
+        assert a is b
+        registry.dispose()
+
+    def test_dispose(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'node.db')
+        registry = engines.EngineRegistry()
+        a = registry.get_engine(uri)
+        registry.dispose()
+        b = registry.get_engine(uri)
+        assert a is not b
+        registry.dispose()
+
+    def test_pool_recycle(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'node.db')
+        registry = engines.EngineRegistry(pool_recycle=60)
+        engine = registry.get_engine(uri)
+        eq_(engine.pool._recycle, 60)
+        registry.dispose()
@@ -20,6 +20,7 @@ import sqlalchemy as sq
 
 from snakepit import connect
 from snakepit import create
+from snakepit import secondary
 
 from snakepit.test.util import maketemp
 
@@ -90,7 +91,6 @@ def test_createAndUseTheHive():
         dimension_name=dimension_name,
         dimension_value=key,
         )
-    node_engine.dispose()
 
     # Just cleaning up the random key.
 
@@ -148,35 +148,21 @@ def test_createAndUseTheHive():
     # First create a Resource and add it to the Hive. All Secondary
     # Indexes will be associated with this Resource.
     resource_name = 'Product'
-#     create.create_secondary_index(
-#         directory_uri=hive_uri,
-#         resource_name=resource_name,
-#         column_name='type', #TODO?
-#         )
-
-    t_resource = hive_metadata.tables['resource_metadata']
-    r = t_resource.insert().execute(
-        dimension_id=dimension_id,
-        name=resource_name,
+    resource_id = create.create_resource(
+        hive_metadata=hive_metadata,
+        dimension_name=dimension_name,
+        resource_name=resource_name,
         db_type='INTEGER',
         is_partitioning_resource=False,
         )
-    (resource_id,) = r.last_inserted_ids()
-
-    # Now create a SecondaryIndex
-#     create.create_secondary_index(
-#         directory_uri=hive_uri,
-#         resource_name=resource_name,
-#         column_name='name',
-#         )
-
-    # Add it to the Hive
-#     create.add_secondary_index(
-#         hive_metadata=hive_metadata,
-#         resource_id=resource_id,
-#         column_name='name',
-#         db_type='CHAR',
-#         )
+
+    # Now create a SecondaryIndex, and add it to the Hive
+    create.create_secondary_index(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name='name',
+        db_type='CHAR',
+        )
     # Note: SecondaryIndexes are identified by
     # ResourceName.IndexColumnName
 
@@ -205,26 +191,21 @@ def test_createAndUseTheHive():
     for table in generic_node_metadata.tables.values():
         table.tometadata(node_metadata)
     node_metadata.tables['products'].insert(spork).execute()
-    node_metadata.bind.dispose()
 
     # Update the resource id so that the hive can locate it
-#     create.insert_resource_id(
-#         hive_metadata=hive_metadata,
-#         dimension_name=dimension_name,
-#         resource_name=resource_name,
-#         id=spork['id'],
-#         pkey=spork['type'],
-#         )
+    secondary.insert_resource_ids(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        resource_ids=[(spork['id'], spork['type'])],
+        )
 
     # Finally we update the SecondaryIndex
-#     connect.insert_secondary_index_key(
-#         hive_metadata=hive_metadata,
-#         dimension_name=dimension_name,
-#         resource_name=resource_name,
-#         column_name='name',
-#         id=spork['name'],
-#         pkey=spork['id'],
-#         )
+    secondary.insert_secondary_keys(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name='name',
+        keys=[(spork['name'], spork['id'])],
+        )
 
     # Retrieve spork by Primary Key
     node_engine = connect.get_engine(
@@ -253,43 +234,40 @@ def test_createAndUseTheHive():
     res = q.execute().fetchone()
     assert res is not None
     product_a = dict(res)
-    node_metadata.bind.dispose()
 
     # Make sure its a spork
     assert spork['name'] == product_a['name']
 
-#     # Retrieve the spork by Name
-#     node_engine = connect.get_engine_by_secondary(
-#         hive_metadata=hive_metadata,
-#         dimension_name=dimension_name,
-#         resource_name=resource_name,
-#         column_name='name',
-#         id=spork['name'],
-#         #TODO access=READ,
-#         )
-
-#     node_metadata = sq.MetaData()
-#     node_metadata.bind = node_engine
-#     for table in generic_node_metadata.tables.values():
-#         table.tometadata(node_metadata)
-
-#     t = node_metadata.tables['products']
-#     q = sq.select(
-#         [
-#             t.c.id,
-#             t.c.name,
-#             ],
-#         t.c.name==spork['name'],
-#         limit=1,
-#         )
-#     res = q.execute().fetchone()
-#     assert res is not None
-#     product_b = dict(res)
-#     node_metadata.bind.dispose()
-
-#     # Make sure its a spork
-#     eq_(spork['id'], product_b['id'])
-
-#     # productA and productB are the same spork
-#     eq_(product_a['id'], product_b['id'])
-#     eq_(product_a['name'], product_b['name'])
+    # Retrieve the spork by Name
+    (node_engine,) = secondary.get_engines_by_secondary(
+        hive_metadata=hive_metadata,
+        resource_name=resource_name,
+        column_name='name',
+        value=spork['name'],
+        #TODO access=READ,
+        )
+
+    node_metadata = sq.MetaData()
+    node_metadata.bind = node_engine
+    for table in generic_node_metadata.tables.values():
+        table.tometadata(node_metadata)
+
+    t = node_metadata.tables['products']
+    q = sq.select(
+        [
+            t.c.id,
+            t.c.name,
+            ],
+        t.c.name==spork['name'],
+        limit=1,
+        )
+    res = q.execute().fetchone()
+    assert res is not None
+    product_b = dict(res)
+
+    # Make sure its a spork
+    eq_(spork['id'], product_b['id'])
+
+    # productA and productB are the same spork
+    eq_(product_a['id'], product_b['id'])
+    eq_(product_a['name'], product_b['name'])
@@ -0,0 +1,81 @@
+from nose.tools import eq_
+
+import os
+import threading
+
+from snakepit import create, connect, executor
+
+from snakepit.test.util import maketemp, assert_raises
+
+class Async_Test(object):
+
+    def tearDown(self):
+        executor.shutdown()
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node42',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'p42.db'),
+            )
+
+        r = executor.assign_node_async(hive_metadata, 'frob', 1)
+        node_engine = r.get(timeout=10)
+        assert node_engine is connect.get_engine(hive_metadata, 'frob', 1)
+
+        done = threading.Event()
+        got = []
+        def callback(result):
+            got.append(result)
+            done.set()
+        executor.get_engine_async(
+            hive_metadata, 'frob', 1, callback=callback)
+        done.wait(10)
+        eq_(got, [node_engine])
+
+        r = executor.get_engines_bulk_async(hive_metadata, 'frob', [1, 2])
+        eq_(r.get(timeout=10), ({node_engine: [1]}, set([2])))
+        r = executor.assign_nodes_bulk_async(hive_metadata, 'frob', [2])
+        eq_(r.get(timeout=10), {node_engine: [2]})
+        r = executor.unassign_node_async(hive_metadata, 'frob', 2, 'node42')
+        eq_(r.get(timeout=10), None)
+        hive_metadata.bind.dispose()
+
+    def test_error(self):
+        tmp = maketemp()
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+
+        done = threading.Event()
+        got = []
+        def errback(e):
+            got.append(e)
+            done.set()
+        r = executor.get_engine_async(
+            hive_metadata, 'frob', 1, errback=errback)
+        assert_raises(
+            connect.NoSuchDimensionError,
+            r.get,
+            timeout=10,
+            )
+        done.wait(10)
+        eq_(len(got), 1)
+        assert isinstance(got[0], connect.NoSuchDimensionError)
+        hive_metadata.bind.dispose()
@@ -0,0 +1,183 @@
+from nose.tools import eq_
+
+import os
+import threading
+
+import sqlalchemy as sq
+
+from snakepit import create, connect, cache, engines, health
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+
+def get_node_uri(hive_metadata, node_name):
+    c = cache.get_cache(hive_metadata)
+    return c.get_node_by_name(c.get_dimension('frob'), node_name).uri
+
+class NodeHealth_Test(object):
+
+    def test_open(self):
+        h = health.NodeHealth('fake', min_requests=4, error_threshold=0.5)
+        for ok in [True, False, True]:
+            h.record(ok, 0.1)
+        # too few requests to judge
+        eq_(h.state, health.CLOSED)
+        h.record(False)
+        eq_(h.state, health.OPEN)
+        eq_(h.error_rate(), 0.5)
+        assert not h.is_available()
+        assert not h.allow()
+
+    def test_trial(self):
+        h = health.NodeHealth('fake', min_requests=1, open_time=0)
+        h.record(False)
+        eq_(h.state, health.OPEN)
+        assert h.is_available()
+        assert h.allow()
+        eq_(h.state, health.HALF_OPEN)
+        h.record(False)
+        eq_(h.state, health.OPEN)
+        assert h.allow()
+        h.record(True, 0.1)
+        eq_(h.state, health.CLOSED)
+        eq_(h.error_rate(), 0.0)
+
+    def test_trial_other_thread(self):
+        h = health.NodeHealth('fake', min_requests=1, open_time=0)
+        h.record(False)
+        assert h.allow()
+        # requests still in flight from before the circuit opened
+        def other():
+            h.record(True, 0.1)
+            h.record(False)
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+        eq_(h.state, health.HALF_OPEN)
+        h.record(True, 0.1)
+        eq_(h.state, health.CLOSED)
+
+    def test_slow(self):
+        h = health.NodeHealth('fake', min_requests=10, slow_threshold=1.0)
+        for i in range(9):
+            h.record(True, 0.1)
+        h.record(True, 5.0)
+        eq_(h.latency_percentile(50), 0.1)
+        eq_(h.latency_percentile(90), 5.0)
+        eq_(h.state, health.OPEN)
+
+    def test_window(self):
+        h = health.NodeHealth('fake', window=3, min_requests=3)
+        h.record(False)
+        for i in range(3):
+            h.record(True, 0.1)
+        eq_(h.error_rate(), 0.0)
+        eq_(h.state, health.CLOSED)
+
+class Engine_Health_Test(object):
+
+    def test_connect_failure(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'missing', 'node.db')
+        engine = engines.get_engine(uri)
+        assert_raises(sq.exc.DBAPIError, engine.execute, 'SELECT 1')
+        eq_(engines.get_health(uri).error_rate(), 1.0)
+
+    def test_statement(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'node.db')
+        engine = engines.get_engine(uri)
+        engine.execute('SELECT 1').close()
+        h = engines.get_health(uri)
+        eq_(h.error_rate(), 0.0)
+        assert h.latency_percentile(50) is not None
+        # bad data is not the database's fault
+        engine.execute('CREATE TABLE t (id INTEGER PRIMARY KEY)')
+        engine.execute('INSERT INTO t (id) VALUES (1)')
+        assert_raises(
+            sq.exc.IntegrityError,
+            engine.execute,
+            'INSERT INTO t (id) VALUES (1)',
+            )
+        eq_(h.error_rate(), 0.0)
+        # neither is a bad schema
+        assert_raises(
+            sq.exc.OperationalError,
+            engine.execute,
+            'SELECT * FROM missing',
+            )
+        eq_(h.error_rate(), 0.0)
+
+    def test_probe(self):
+        tmp = maketemp()
+        uri = 'sqlite:///%s' % os.path.join(tmp, 'node.db')
+        engines.get_engine(uri)
+        h = engines.get_health(uri)
+        h.open_time = 0
+        h.min_requests = 1
+        h.record(False)
+        eq_(h.state, health.OPEN)
+        engines.registry.probe()
+        eq_(h.state, health.CLOSED)
+
+class Routing_Health_Test(object):
+
+    def test_get_engine(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        h = engines.get_health(str(node_engine.url))
+        h.min_requests = 1
+        h.record(False)
+        e = assert_raises(
+            connect.NodeUnavailableError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        assert str(e).startswith(
+            'Node is unavailable: dimension %r, node_id ' % 'frob')
+        assert_raises(
+            connect.NodeUnavailableError,
+            connect.get_engines_bulk,
+            hive_metadata,
+            'frob',
+            [1],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_read_from_replica(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        c = cache.get_cache(hive_metadata)
+        for node in c.get_nodes(c.get_dimension('frob')):
+            if node.uri == str(node_engine.url):
+                node_name = node.name
+        replica_uri = 'sqlite:///%s' % os.path.join(tmp, 'replica.db')
+        create.create_replica(hive_metadata, 'frob', node_name, replica_uri)
+        h = engines.get_health(str(node_engine.url))
+        h.min_requests = 1
+        h.record(False)
+        assert connect.get_engine(
+            hive_metadata, 'frob', 1, write=False) \
+            is engines.get_engine(replica_uri)
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1], write=False),
+            ({engines.get_engine(replica_uri): [1]}, set()),
+            )
+        hive_metadata.bind.dispose()
+
+    def test_placement(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        uri = get_node_uri(hive_metadata, 'node1')
+        engines.get_engine(uri)
+        h = engines.get_health(uri)
+        h.min_requests = 1
+        h.record(False)
+        other = engines.get_engine(get_node_uri(hive_metadata, 'node2'))
+        for value in range(10):
+            assert connect.assign_node(hive_metadata, 'frob', value) is other
+        hive_metadata.bind.dispose()
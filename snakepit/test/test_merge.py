@@ -0,0 +1,115 @@
+from nose.tools import eq_
+
+import os
+import sqlalchemy as sq
+
+from snakepit import create, merge
+
+from snakepit.test.util import maketemp
+
+node_metadata = sq.MetaData()
+t_frob = sq.Table(
+    'frob',
+    node_metadata,
+    sq.Column('id', sq.Integer, primary_key=True),
+    sq.Column('name', sq.String(10), nullable=False),
+    )
+
+def make_hive(tmp, nodes):
+    hive_metadata = create.create_hive(
+        'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri='fake-dir-uri',
+        db_type='INTEGER',
+        )
+    for name, ids in nodes:
+        engine = sq.create_engine(
+            'sqlite:///%s' % os.path.join(tmp, '%s.db' % name),
+            )
+        node_metadata.create_all(bind=engine)
+        if ids:
+            engine.execute(
+                t_frob.insert(),
+                [dict(id=id_, name='%s-%d' % (name, id_)) for id_ in ids],
+                )
+        engine.dispose()
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri=str(engine.url),
+            )
+    return hive_metadata
+
+class Merge_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(
+            tmp,
+            [
+                ('node1', [1, 4, 7, 8]),
+                ('node2', [2, 3, 9]),
+                ('node3', []),
+                ('node4', [5, 6]),
+                ],
+            )
+        got = merge.merge_iter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement=sq.select([t_frob.c.id], order_by=[t_frob.c.id]),
+            key='id',
+            batch_size=2,
+            )
+        eq_([row['id'] for row in got], range(1, 10))
+        hive_metadata.bind.dispose()
+
+    def test_reverse(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(
+            tmp,
+            [
+                ('node1', [1, 4, 7, 8]),
+                ('node2', [2, 3, 9]),
+                ],
+            )
+        got = merge.merge_iter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement='SELECT id, name FROM frob ORDER BY id DESC',
+            key=lambda row: row['id'],
+            reverse=True,
+            )
+        eq_(
+            [row['name'] for row in got],
+            ['node2-9', 'node1-8', 'node1-7', 'node1-4',
+             'node2-3', 'node2-2', 'node1-1'],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_page(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(
+            tmp,
+            [
+                ('node1', [1, 4, 7, 8]),
+                ('node2', [2, 3, 9]),
+                ('node3', [5, 6]),
+                ],
+            )
+        q = sq.select([t_frob.c.id], order_by=[t_frob.c.id])
+        pages = []
+        for offset in [0, 3, 6, 9]:
+            got = merge.page(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                statement=q,
+                key='id',
+                limit=3,
+                offset=offset,
+                )
+            pages.append([row['id'] for row in got])
+        eq_(pages, [[1, 2, 3], [4, 5, 6], [7, 8, 9], []])
+        hive_metadata.bind.dispose()
@@ -0,0 +1,287 @@
+from nose.tools import eq_
+
+import datetime
+import os
+
+import sqlalchemy as sq
+
+from snakepit import connect, cache, engines, migration
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+
+class Crash(Exception):
+    pass
+
+def make_records(hive_metadata, values):
+    """
+    Put each value on node1, with two rows in its C{post} table.
+    """
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension('frob')
+    node1 = c.get_node_by_name(dimension, 'node1')
+    t_primary = c.get_primary_table(dimension)
+    for node in c.get_nodes(dimension):
+        engines.get_engine(node.uri).execute(
+            'CREATE TABLE post (id INTEGER PRIMARY KEY, frob INTEGER)')
+    for value in values:
+        t_primary.insert().execute(
+            id=value,
+            node=node1.id,
+            secondary_index_count=0,
+            last_updated=datetime.datetime.now(),
+            read_only=False,
+            )
+        for i in range(2):
+            engines.get_engine(node1.uri).execute(
+                'INSERT INTO post (id, frob) VALUES (?, ?)',
+                value*10+i, value)
+
+def get_posts(hive_metadata, node_name):
+    c = cache.get_cache(hive_metadata)
+    node = c.get_node_by_name(c.get_dimension('frob'), node_name)
+    res = engines.get_engine(node.uri).execute(
+        'SELECT frob FROM post ORDER BY id')
+    return [row[0] for row in res.fetchall()]
+
+def get_read_only(hive_metadata):
+    c = cache.get_cache(hive_metadata)
+    t_primary = c.get_primary_table(c.get_dimension('frob'))
+    q = sq.select([t_primary.c.id], t_primary.c.read_only==True)
+    return [row[0] for row in q.execute().fetchall()]
+
+class MoveValues_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3, 4, 5])
+        messages = []
+        got = migration.move_values(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=[2, 4, 5, 42],
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            batch_size=2,
+            report=messages.append,
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(got, 3)
+        eq_(messages, [
+                'frob: 2/4 values done',
+                'frob: 4/4 values done',
+                ])
+        eq_(get_posts(hive_metadata, 'node1'), [1, 1, 3, 3])
+        eq_(get_posts(hive_metadata, 'node2'), [2, 2, 4, 4, 5, 5])
+        node2 = engines.get_engine(
+            cache.get_cache(hive_metadata).get_node_by_name(
+                cache.get_cache(hive_metadata).get_dimension('frob'),
+                'node2').uri)
+        for value in [2, 4, 5]:
+            assert connect.get_engine(hive_metadata, 'frob', value) is node2
+        eq_(get_read_only(hive_metadata), [])
+        hive_metadata.bind.dispose()
+
+    def test_split(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3, 4, 5])
+        got = migration.split_node(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(got, 3)
+        eq_(get_posts(hive_metadata, 'node1'), [1, 1, 2, 2])
+        eq_(get_posts(hive_metadata, 'node2'), [3, 3, 4, 4, 5, 5])
+        hive_metadata.bind.dispose()
+
+    def test_resume(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3, 4, 5])
+        checkpoint = os.path.join(tmp, 'frob.migration')
+        def crash(message):
+            raise Crash()
+        assert_raises(
+            Crash,
+            migration.move_values,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=[1, 2, 3, 4],
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            checkpoint=checkpoint,
+            batch_size=2,
+            report=crash,
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(get_posts(hive_metadata, 'node2'), [1, 1, 2, 2])
+
+        # the next batch died after the copy
+        c = cache.get_cache(hive_metadata)
+        t_primary = c.get_primary_table(c.get_dimension('frob'))
+        t_primary.update(
+            t_primary.c.id.in_([3, 4]),
+            values={t_primary.c.read_only: True},
+            ).execute()
+        node2 = c.get_node_by_name(c.get_dimension('frob'), 'node2')
+        engines.get_engine(node2.uri).execute(
+            'INSERT INTO post (id, frob) VALUES (30, 3)')
+
+        got = migration.resume(
+            hive_metadata=hive_metadata,
+            checkpoint=checkpoint,
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(got, 2)
+        eq_(get_posts(hive_metadata, 'node1'), [5, 5])
+        eq_(get_posts(hive_metadata, 'node2'), [1, 1, 2, 2, 3, 3, 4, 4])
+        eq_(get_read_only(hive_metadata), [])
+        hive_metadata.bind.dispose()
+
+    def test_deferred_delete(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3])
+        checkpoint = os.path.join(tmp, 'frob.migration')
+        def crash(message):
+            raise Crash()
+        assert_raises(
+            Crash,
+            migration.move_values,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=[1, 2],
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            checkpoint=checkpoint,
+            report=crash,
+            fence_wait=0,
+            cache_ttl=0.2,
+            )
+        # routed to the target, but cached routes may still point to
+        # the source
+        eq_(get_posts(hive_metadata, 'node1'), [1, 1, 2, 2, 3, 3])
+        eq_(get_posts(hive_metadata, 'node2'), [1, 1, 2, 2])
+
+        messages = []
+        got = migration.resume(
+            hive_metadata=hive_metadata,
+            checkpoint=checkpoint,
+            report=messages.append,
+            fence_wait=0,
+            )
+        eq_(got, 0)
+        eq_(get_posts(hive_metadata, 'node1'), [3, 3])
+        eq_(get_posts(hive_metadata, 'node2'), [1, 1, 2, 2])
+        hive_metadata.bind.dispose()
+
+    def test_no_wait(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3])
+        checkpoint = os.path.join(tmp, 'frob.migration')
+        got = migration.move_values(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            dimension_values=[1, 2],
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            checkpoint=checkpoint,
+            fence_wait=0,
+            cache_ttl=0.2,
+            wait=False,
+            )
+        eq_(got, 2)
+        eq_(get_posts(hive_metadata, 'node1'), [1, 1, 2, 2, 3, 3])
+        assert os.path.exists(checkpoint + '.values')
+
+        got = migration.resume(
+            hive_metadata=hive_metadata,
+            checkpoint=checkpoint,
+            fence_wait=0,
+            )
+        eq_(got, 0)
+        eq_(get_posts(hive_metadata, 'node1'), [3, 3])
+        eq_(get_posts(hive_metadata, 'node2'), [1, 1, 2, 2])
+        hive_metadata.bind.dispose()
+
+    def test_no_wait_checkpoint(self):
+        e = assert_raises(
+            ValueError,
+            migration.move_values,
+            hive_metadata=None,
+            dimension_name='frob',
+            dimension_values=[1],
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            wait=False,
+            )
+        eq_(str(e), 'Need a checkpoint to delete moved records later')
+
+    def test_split_resume(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        make_records(hive_metadata, [1, 2, 3, 4, 5, 6, 7])
+        checkpoint = os.path.join(tmp, 'frob.migration')
+        def crash(message):
+            raise Crash()
+        assert_raises(
+            Crash,
+            migration.split_node,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            source_name='node1',
+            target_name='node2',
+            tables=[('post', 'frob')],
+            checkpoint=checkpoint,
+            batch_size=2,
+            report=crash,
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(get_posts(hive_metadata, 'node2'), [4, 4, 5, 5])
+
+        messages = []
+        got = migration.resume(
+            hive_metadata=hive_metadata,
+            checkpoint=checkpoint,
+            batch_size=2,
+            report=messages.append,
+            fence_wait=0,
+            cache_ttl=0,
+            )
+        eq_(got, 2)
+        eq_(messages, ['frob: 4/4 values done'])
+        eq_(get_posts(hive_metadata, 'node1'), [1, 1, 2, 2, 3, 3])
+        eq_(get_posts(hive_metadata, 'node2'), [4, 4, 5, 5, 6, 6, 7, 7])
+        eq_(get_read_only(hive_metadata), [])
+        hive_metadata.bind.dispose()
+
+    def test_bad_checkpoint(self):
+        tmp = maketemp()
+        path = os.path.join(tmp, 'frob.migration')
+        f = file(path, 'wb')
+        f.write('not a checkpoint')
+        f.close()
+        e = assert_raises(
+            migration.BadCheckpointError,
+            migration.resume,
+            None,
+            path,
+            )
+        eq_(str(e), 'Not a migration checkpoint: %r' % path)
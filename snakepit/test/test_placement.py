@@ -0,0 +1,134 @@
+from nose.tools import eq_
+
+from snakepit import cache, placement
+
+from snakepit.test.util import assert_raises
+
+def make_nodes(n):
+    return [
+        cache.Node(
+            id=i,
+            dimension_id=1,
+            name='node%d' % i,
+            uri='fake',
+            read_only=False,
+            )
+        for i in range(1, n+1)
+        ]
+
+def make_statistics(**kw):
+    stats = {}
+    for name, (record_count, latency) in kw.items():
+        node_id = int(name[len('node'):])
+        stats[node_id] = cache.NodeStatistics(
+            node_id=node_id,
+            record_count=record_count,
+            latency=latency,
+            )
+    def get_statistics(node):
+        return stats[node.id]
+    return get_statistics
+
+class Writable_Test(object):
+
+    def test_simple(self):
+        nodes = make_nodes(4)
+        nodes[0].read_only = True
+        nodes[1].capacity = 10
+        nodes[2].capacity = 11
+        nodes[3].weight = 0.0
+        get_statistics = make_statistics(
+            node1=(0, None),
+            node2=(10, None),
+            node3=(10, None),
+            node4=(0, None),
+            )
+        got = placement.writable(nodes, get_statistics)
+        eq_([node.name for node in got], ['node3'])
+
+class Random_Test(object):
+
+    def test_simple(self):
+        nodes = make_nodes(3)
+        get_statistics = make_statistics()
+        s = placement.RandomPlacement()
+        got = set()
+        for i in range(100):
+            got.add(s.pick(nodes, get_statistics).name)
+        eq_(got, set(['node1', 'node2', 'node3']))
+
+    def test_weight(self):
+        nodes = make_nodes(2)
+        nodes[1].weight = 9.0
+        get_statistics = make_statistics()
+        s = placement.RandomPlacement()
+        got = [s.pick(nodes, get_statistics).name for i in range(1000)]
+        assert got.count('node2') > 800, got.count('node2')
+
+class LeastRecords_Test(object):
+
+    def test_simple(self):
+        nodes = make_nodes(3)
+        get_statistics = make_statistics(
+            node1=(10, 0.1),
+            node2=(3, 0.5),
+            node3=(7, 0.0),
+            )
+        s = placement.LeastRecordsPlacement()
+        for i in range(10):
+            eq_(s.pick(nodes, get_statistics).name, 'node2')
+
+class Weighted_Test(object):
+
+    def test_simple(self):
+        nodes = make_nodes(2)
+        get_statistics = make_statistics(
+            node1=(0, None),
+            node2=(0, None),
+            )
+        s = placement.WeightedPlacement(
+            weight=lambda node, stat: {1: 0, 2: 1}[node.id])
+        for i in range(10):
+            eq_(s.pick(nodes, get_statistics).name, 'node2')
+
+    def test_default(self):
+        nodes = make_nodes(2)
+        get_statistics = make_statistics(
+            node1=(999, None),
+            node2=(0, None),
+            )
+        s = placement.WeightedPlacement()
+        got = [s.pick(nodes, get_statistics).name for i in range(1000)]
+        assert got.count('node2') > 900, got.count('node2')
+
+class PowerOfTwo_Test(object):
+
+    def test_latency(self):
+        nodes = make_nodes(2)
+        get_statistics = make_statistics(
+            node1=(0, 0.5),
+            node2=(100, 0.1),
+            )
+        s = placement.PowerOfTwoPlacement()
+        for i in range(10):
+            eq_(s.pick(nodes, get_statistics).name, 'node2')
+
+    def test_record_count(self):
+        nodes = make_nodes(3)
+        get_statistics = make_statistics(
+            node1=(0, 0.5),
+            node2=(100, 0.1),
+            node3=(200, 0.1),
+            )
+        s = placement.PowerOfTwoPlacement(metric='record_count')
+        got = set([s.pick(nodes, get_statistics).name for i in range(100)])
+        # node3 is never the better of two
+        eq_(got, set(['node1', 'node2']))
+
+    def test_bad_metric(self):
+        e = assert_raises(
+            ValueError,
+            placement.PowerOfTwoPlacement,
+            metric='xyzzy',
+            )
+        eq_(str(e), "Unknown metric: 'xyzzy'")
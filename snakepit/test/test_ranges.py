@@ -0,0 +1,302 @@
+from nose.tools import eq_
+
+import os
+
+from snakepit import hive, create, connect, cache, engines, ranges
+
+from snakepit.test.util import maketemp, assert_raises
+
+def make_hive(tmp):
+    hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+    directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+    directory_metadata = create.create_range_index(
+        directory_uri=directory_uri,
+        dimension_name='frob',
+        db_type='INTEGER',
+        )
+    directory_metadata.bind.dispose()
+    hive_metadata = create.create_hive(hive_uri)
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri=directory_uri,
+        db_type='INTEGER',
+        partitioning=hive.RANGE,
+        )
+    for name in ['node1', 'node2']:
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri='sqlite:///%s' % os.path.join(tmp, '%s.db' % name),
+            )
+    return hive_metadata
+
+def get_node_engine(hive_metadata, node_name):
+    c = cache.get_cache(hive_metadata)
+    node = c.get_node_by_name(c.get_dimension('frob'), node_name)
+    return engines.get_engine(node.uri)
+
+class RangeMap_Test(object):
+
+    def setUp(self):
+        self.range_map = ranges.RangeMap([
+                ranges.Range(10, 20, 2),
+                ranges.Range(0, 10, 1),
+                ranges.Range(30, None, 3),
+                ])
+
+    def test_find(self):
+        eq_(self.range_map.find(-1), None)
+        eq_(self.range_map.find(0).node_id, 1)
+        eq_(self.range_map.find(9).node_id, 1)
+        eq_(self.range_map.find(10).node_id, 2)
+        eq_(self.range_map.find(20), None)
+        eq_(self.range_map.find(30).node_id, 3)
+        eq_(self.range_map.find(10**12).node_id, 3)
+
+    def test_covering(self):
+        got = [
+            (r.node_id, low, high)
+            for (r, low, high) in self.range_map.covering(5, 35)
+            ]
+        eq_(got, [(1, 5, 10), (2, 10, 20), (3, 30, 35)])
+        got = [
+            (r.node_id, low, high)
+            for (r, low, high) in self.range_map.covering(15, None)
+            ]
+        eq_(got, [(2, 15, 20), (3, 30, None)])
+        eq_(self.range_map.covering(20, 30), [])
+
+    def test_overlaps(self):
+        assert not self.range_map.overlaps(-5, 0)
+        assert not self.range_map.overlaps(20, 30)
+        assert self.range_map.overlaps(19, 21)
+        assert self.range_map.overlaps(25, None)
+
+class Range_Routing_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.add_range(hive_metadata, 'frob', 0, 100, 'node1')
+        create.add_range(hive_metadata, 'frob', 100, None, 'node2')
+        node1 = get_node_engine(hive_metadata, 'node1')
+        node2 = get_node_engine(hive_metadata, 'node2')
+
+        assert connect.get_engine(hive_metadata, 'frob', 0) is node1
+        assert connect.get_engine(hive_metadata, 'frob', 99) is node1
+        assert connect.get_engine(hive_metadata, 'frob', 100) is node2
+        assert connect.assign_node(hive_metadata, 'frob', 5) is node1
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            -1,
+            )
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.assign_node,
+            hive_metadata,
+            'frob',
+            -1,
+            )
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1, 200, -1, 2]),
+            ({node1: [1, 2], node2: [200]}, set([-1])),
+            )
+        assert_raises(
+            connect.UnsupportedPartitioningError,
+            connect.unassign_node,
+            hive_metadata,
+            'frob',
+            1,
+            'node1',
+            )
+        hive_metadata.bind.dispose()
+
+    def test_get_engines_for_range(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.add_range(hive_metadata, 'frob', 0, 100, 'node1')
+        create.add_range(hive_metadata, 'frob', 100, 200, 'node2')
+        create.add_range(hive_metadata, 'frob', 200, None, 'node1')
+        node1 = get_node_engine(hive_metadata, 'node1')
+        node2 = get_node_engine(hive_metadata, 'node2')
+
+        eq_(
+            connect.get_engines_for_range(hive_metadata, 'frob', 10, 20),
+            {node1: [(10, 20)]},
+            )
+        eq_(
+            connect.get_engines_for_range(hive_metadata, 'frob', 50, None),
+            {node1: [(50, 100), (200, None)], node2: [(100, 200)]},
+            )
+        eq_(
+            connect.get_engines_for_range(hive_metadata, 'frob', -10, 0),
+            {},
+            )
+        e = assert_raises(
+            ValueError,
+            connect.get_engines_for_range,
+            hive_metadata,
+            'frob',
+            20,
+            10,
+            )
+        eq_(str(e), 'Empty range: [20, 10)')
+        hive_metadata.bind.dispose()
+
+    def test_not_range(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        hive_metadata = create.create_hive(hive_uri)
+        create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=hive_uri,
+            db_type='INTEGER',
+            partitioning=hive.BUCKET,
+            bucket_count=4,
+            )
+        e = assert_raises(
+            connect.UnsupportedPartitioningError,
+            connect.get_engines_for_range,
+            hive_metadata,
+            'frob',
+            0,
+            10,
+            )
+        eq_(
+            str(e),
+            'Not possible with the partitioning of the dimension:'
+            ' dimension %r, partitioning bucket' % 'frob',
+            )
+        hive_metadata.bind.dispose()
+
+class AddRange_Test(object):
+
+    def test_overlap(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.add_range(hive_metadata, 'frob', 0, 100, 'node1')
+        e = assert_raises(
+            create.RangeOverlapError,
+            create.add_range,
+            hive_metadata,
+            'frob',
+            50,
+            150,
+            'node2',
+            )
+        eq_(
+            str(e),
+            'Range overlaps existing ranges:'
+            ' dimension %r, range [50, 150)' % 'frob',
+            )
+        create.add_range(hive_metadata, 'frob', 100, 150, 'node2')
+        eq_(len(cache.get_cache(hive_metadata).get_ranges(
+                    cache.get_cache(hive_metadata).get_dimension('frob'))),
+            2)
+        hive_metadata.bind.dispose()
+
+    def test_overlap_not_cached(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(len(c.get_ranges(dimension)), 0)
+        # added by another process, not noticed yet
+        node1 = c.get_node_by_name(dimension, 'node1')
+        c.get_range_table(dimension).insert().execute(
+            low=0,
+            high=100,
+            node=node1.id,
+            )
+        assert_raises(
+            create.RangeOverlapError,
+            create.add_range,
+            hive_metadata,
+            'frob',
+            50,
+            None,
+            'node2',
+            )
+        create.split_range(hive_metadata, 'frob', 50, 'node2')
+        assert connect.get_engine(hive_metadata, 'frob', 50) is (
+            get_node_engine(hive_metadata, 'node2'))
+        hive_metadata.bind.dispose()
+
+    def test_empty(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        e = assert_raises(
+            ValueError,
+            create.add_range,
+            hive_metadata,
+            'frob',
+            10,
+            10,
+            'node1',
+            )
+        eq_(str(e), 'Empty range: [10, 10)')
+        hive_metadata.bind.dispose()
+
+    def test_no_node(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        assert_raises(
+            connect.NoSuchNodeError,
+            create.add_range,
+            hive_metadata,
+            'frob',
+            0,
+            10,
+            'node3',
+            )
+        hive_metadata.bind.dispose()
+
+class SplitRange_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.add_range(hive_metadata, 'frob', 0, None, 'node1')
+        node1 = get_node_engine(hive_metadata, 'node1')
+        node2 = get_node_engine(hive_metadata, 'node2')
+
+        create.split_range(hive_metadata, 'frob', 1000, 'node2')
+        assert connect.get_engine(hive_metadata, 'frob', 999) is node1
+        assert connect.get_engine(hive_metadata, 'frob', 1000) is node2
+        assert connect.get_engine(hive_metadata, 'frob', 10**9) is node2
+
+        create.split_range(hive_metadata, 'frob', 500)
+        c = cache.get_cache(hive_metadata)
+        got = [
+            (r.low, r.high, r.node_id)
+            for r in c.get_ranges(c.get_dimension('frob'))
+            ]
+        node1_id = c.get_node_by_name(c.get_dimension('frob'), 'node1').id
+        node2_id = c.get_node_by_name(c.get_dimension('frob'), 'node2').id
+        eq_(got, [
+                (0, 500, node1_id),
+                (500, 1000, node1_id),
+                (1000, None, node2_id),
+                ])
+        hive_metadata.bind.dispose()
+
+    def test_not_inside(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.add_range(hive_metadata, 'frob', 0, 100, 'node1')
+        for at in [-1, 0, 100]:
+            e = assert_raises(
+                ValueError,
+                create.split_range,
+                hive_metadata,
+                'frob',
+                at,
+                )
+            eq_(str(e), 'Not inside a range: %r' % at)
+        hive_metadata.bind.dispose()
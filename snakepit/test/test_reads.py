@@ -0,0 +1,125 @@
+from nose.tools import eq_
+
+import os
+
+from snakepit import create, connect, cache, engines, executor, reads
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+
+def make_node(replicas):
+    return cache.Node(
+        id=1,
+        dimension_id=1,
+        name='node1',
+        uri='sqlite:///primary.db',
+        read_only=False,
+        replicas=replicas,
+        )
+
+class RoundRobin_Test(object):
+
+    def test_simple(self):
+        s = reads.RoundRobinSelection()
+        uris = ['a', 'b', 'c']
+        got = [s.pick(uris) for i in range(6)]
+        eq_(got, ['a', 'b', 'c', 'a', 'b', 'c'])
+
+class LeastOutstanding_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        uris = [
+            'sqlite:///%s' % os.path.join(tmp, '%s.db' % name)
+            for name in ['replica1', 'replica2']
+            ]
+        s = reads.LeastOutstandingSelection()
+        got = set([s.pick(uris) for i in range(100)])
+        eq_(got, set(uris))
+
+class Choose_Test(object):
+
+    def tearDown(self):
+        reads._down.clear()
+
+    def test_no_replicas(self):
+        node = make_node([])
+        eq_(reads.choose(node, reads.RoundRobinSelection()), node.uri)
+
+    def test_down(self):
+        node = make_node(['a', 'b'])
+        s = reads.RoundRobinSelection()
+        reads.mark_down('a')
+        assert reads.is_down('a')
+        got = set([reads.choose(node, s) for i in range(4)])
+        eq_(got, set(['b']))
+
+        reads.mark_down('b')
+        eq_(reads.choose(node, s), node.uri)
+
+        reads.mark_up('a')
+        eq_(reads.choose(node, s), 'a')
+
+    def test_expire(self):
+        reads.mark_down('a', seconds=-1)
+        assert not reads.is_down('a')
+
+class Read_Routing_Test(object):
+
+    def tearDown(self):
+        reads._down.clear()
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        primary = connect.assign_node(hive_metadata, 'frob', 1)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        for node in c.get_nodes(dimension):
+            if node.uri == str(primary.url):
+                node_name = node.name
+        replica_uri = 'sqlite:///%s' % os.path.join(tmp, 'replica.db')
+        create.create_replica(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            node_name=node_name,
+            replica_uri=replica_uri,
+            )
+        eq_(c.get_node_by_name(dimension, node_name).replicas, [replica_uri])
+
+        replica = engines.get_engine(replica_uri)
+        assert connect.get_engine(hive_metadata, 'frob', 1) is primary
+        assert connect.get_engine(
+            hive_metadata, 'frob', 1, write=False) is replica
+        r = executor.get_engine_async(hive_metadata, 'frob', 1, write=False)
+        assert r.get(timeout=10) is replica
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1], write=False),
+            ({replica: [1]}, set()),
+            )
+        r = executor.get_engines_bulk_async(
+            hive_metadata, 'frob', [1], write=False)
+        eq_(r.get(timeout=10), ({replica: [1]}, set()))
+
+        reads.mark_down(replica_uri)
+        assert connect.get_engine(
+            hive_metadata, 'frob', 1, write=False) is primary
+        hive_metadata.bind.dispose()
+
+    def test_repeat(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.create_replica(hive_metadata, 'frob', 'node1', 'sqlite://')
+        e = assert_raises(
+            create.ReplicaExistsError,
+            create.create_replica,
+            hive_metadata,
+            'frob',
+            'node1',
+            'sqlite://',
+            )
+        eq_(
+            str(e),
+            'Replica exists already: %r of node %r' % ('sqlite://', 'node1'),
+            )
+        hive_metadata.bind.dispose()
@@ -0,0 +1,144 @@
+from nose.tools import eq_
+
+import array
+import datetime
+import os
+import time
+
+from snakepit import connect, cache, replica
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+
+class Merge_Test(object):
+
+    def test_simple(self):
+        ids = array.array('l', [1, 3, 5, 7])
+        nodes = array.array('i', [10, 30, 50, 70])
+        (got_ids, got_nodes) = replica._merge(
+            ids,
+            nodes,
+            {0: 1, 3: 31, 4: 40, 7: None, 8: 80, 9: None},
+            )
+        eq_(list(got_ids), [0, 1, 3, 4, 5, 8])
+        eq_(list(got_nodes), [1, 10, 31, 40, 50, 80])
+
+class DirectoryReplica_Test(object):
+
+    def tearDown(self):
+        connect.snapshots.clear()
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        by_engine = connect.assign_nodes_bulk(
+            hive_metadata, 'frob', [5, 3, 9, 1])
+        r = replica.DirectoryReplica(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            chunk_size=3,
+            )
+        eq_(r.load(), 4)
+        eq_(len(r), 4)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        for node_engine, values in by_engine.items():
+            for value in values:
+                node = c.get_node(dimension, r.lookup(value))
+                eq_(node.uri, str(node_engine.url))
+        eq_(r.lookup(2), None)
+        eq_(r.lookup('3'), None)
+        hive_metadata.bind.dispose()
+
+    def test_refresh(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_nodes_bulk(hive_metadata, 'frob', [1, 2])
+        r = replica.DirectoryReplica(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            merge_threshold=4,
+            overlap=0,
+            )
+        r.load()
+        mark = r.high_water_mark
+        assert isinstance(mark, datetime.datetime)
+
+        # make the new rows clearly newer than the high water mark
+        time.sleep(0.01)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 3)
+        eq_(r.lookup(3), None)
+        # rows at the high water mark are fetched again
+        eq_(r.refresh(), 3)
+        assert r.high_water_mark > mark
+        node = cache.get_cache(hive_metadata).get_node(
+            cache.get_cache(hive_metadata).get_dimension('frob'),
+            r.lookup(3),
+            )
+        eq_(node.uri, str(node_engine.url))
+        eq_(len(r), 3)
+        eq_(len(r._changes), 3)
+
+        time.sleep(0.01)
+        connect.assign_nodes_bulk(hive_metadata, 'frob', [4, 5])
+        eq_(r.refresh(), 3)
+        # merged into the arrays
+        eq_(len(r._changes), 0)
+        eq_(list(r._arrays[0]), [1, 2, 3, 4, 5])
+        eq_(len(r), 5)
+        hive_metadata.bind.dispose()
+
+    def test_unassign(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        r = replica.DirectoryReplica(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            )
+        r.load()
+        assert r.lookup(1) is not None
+        c = cache.get_cache(hive_metadata)
+        for node in c.get_nodes(c.get_dimension('frob')):
+            if node.uri == str(node_engine.url):
+                connect.unassign_node(hive_metadata, 'frob', 1, node.name)
+        r.refresh()
+        eq_(r.lookup(1), None)
+        eq_(len(r), 0)
+        hive_metadata.bind.dispose()
+
+    def test_routing(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        r = replica.DirectoryReplica(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            refresh_interval=0.01,
+            )
+        r.start()
+        try:
+            connect.use_snapshot(hive_metadata, 'frob', r)
+            c = cache.get_cache(hive_metadata)
+            t_primary = c.get_primary_table(c.get_dimension('frob'))
+            t_primary.delete().execute()
+            assert connect.get_engine(hive_metadata, 'frob', 1) is node_engine
+        finally:
+            r.stop()
+        hive_metadata.bind.dispose()
+
+    def test_bad_type(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, db_type='VARCHAR')
+        e = assert_raises(
+            replica.UnsupportedDimensionTypeError,
+            replica.DirectoryReplica,
+            hive_metadata,
+            'frob',
+            )
+        eq_(
+            str(e),
+            'Only dimensions with integer values can be replicated:'
+            ' dimension %r, db_type VARCHAR' % 'frob',
+            )
+        hive_metadata.bind.dispose()
@@ -0,0 +1,199 @@
+from nose.tools import eq_
+
+import os
+import time
+import sqlalchemy as sq
+
+from snakepit import create, connect, engines, scatter
+
+from snakepit.test.util import maketemp
+
+def make_hive(tmp, node_names):
+    hive_metadata = create.create_hive(
+        'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri='fake-dir-uri',
+        db_type='INTEGER',
+        )
+    for i, name in enumerate(node_names):
+        node_metadata = sq.MetaData()
+        node_metadata.bind = sq.create_engine(
+            'sqlite:///%s' % os.path.join(tmp, '%s.db' % name),
+            )
+        t = sq.Table(
+            'frob',
+            node_metadata,
+            sq.Column('id', sq.Integer, primary_key=True),
+            )
+        node_metadata.create_all()
+        t.insert().execute([dict(id=i*10+j) for j in range(i+1)])
+        node_metadata.bind.dispose()
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri=str(node_metadata.bind.url),
+            )
+    return hive_metadata
+
+class Scatter_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2', 'node3'])
+        got = scatter.scatter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement='SELECT id FROM frob ORDER BY id',
+            max_workers=2,
+            )
+        eq_([r.node.name for r in got], ['node1', 'node2', 'node3'])
+        eq_([r.error for r in got], [None, None, None])
+        eq_(
+            [[row[0] for row in r.rows] for r in got],
+            [[0], [10, 11], [20, 21, 22]],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_error(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2'])
+        got = scatter.scatter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement='SELECT id FROM frob WHERE id > :min_id',
+            params=dict(min_id=5),
+            )
+        eq_([len(r.rows) for r in got], [0, 2])
+        got = scatter.scatter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement='SELECT id FROM no_such_table',
+            )
+        eq_([r.rows for r in got], [[], []])
+        for r in got:
+            assert isinstance(r.error, sq.exc.DBAPIError)
+        hive_metadata.bind.dispose()
+
+    def test_stream(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2', 'node3'])
+        got = {}
+        finals = []
+        for r in scatter.scatter_iter(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            statement='SELECT id FROM frob ORDER BY id',
+            batch_size=2,
+            ):
+            assert r.node.name not in finals
+            got.setdefault(r.node.name, []).append(
+                [row[0] for row in r.rows])
+            if r.final:
+                finals.append(r.node.name)
+        eq_(sorted(finals), ['node1', 'node2', 'node3'])
+        eq_(
+            got,
+            dict(
+                node1=[[0], []],
+                node2=[[10, 11], []],
+                node3=[[20, 21], [22], []],
+                ),
+            )
+        hive_metadata.bind.dispose()
+
+    def test_timeout(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2', 'node3'])
+
+        orig_run = scatter._run
+        def slow_run(task, *a, **kw):
+            if task.node.name == 'node2':
+                time.sleep(1)
+            return orig_run(task, *a, **kw)
+        scatter._run = slow_run
+        try:
+            start = time.time()
+            got = scatter.scatter(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                statement='SELECT id FROM frob',
+                max_workers=1,
+                timeout=0.2,
+                )
+            elapsed = time.time() - start
+        finally:
+            scatter._run = orig_run
+        assert elapsed < 0.9, elapsed
+        eq_([len(r.rows) for r in got], [1, 0, 3])
+        assert got[0].error is None
+        assert isinstance(got[1].error, scatter.NodeTimeoutError)
+        eq_(
+            str(got[1].error),
+            'Node did not answer in time: node %r after 0.2 seconds'
+            % u'node2',
+            )
+        assert got[2].error is None
+        hive_metadata.bind.dispose()
+
+    def test_circuit_open(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2'])
+
+        orig_allow = engines.allow
+        def allow(uri):
+            return not uri.endswith('node1.db')
+        engines.allow = allow
+        try:
+            got = scatter.scatter(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                statement='SELECT id FROM frob',
+                )
+        finally:
+            engines.allow = orig_allow
+        eq_([len(r.rows) for r in got], [0, 2])
+        assert isinstance(got[0].error, connect.NodeUnavailableError)
+        assert got[1].error is None
+        hive_metadata.bind.dispose()
+
+    def test_max_threads(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, ['node1', 'node2', 'node3'])
+
+        orig_run = scatter._run
+        def slow_run(task, *a, **kw):
+            if task.node.name == 'node1':
+                time.sleep(0.5)
+            return orig_run(task, *a, **kw)
+        scatter._run = slow_run
+        orig_max_threads = scatter.MAX_THREADS
+        scatter.MAX_THREADS = 1
+        try:
+            got = scatter.scatter(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                statement='SELECT id FROM frob',
+                max_workers=1,
+                timeout=0.1,
+                )
+            # the stuck thread still counts
+            eq_(scatter._thread_count, 1)
+        finally:
+            scatter._run = orig_run
+            scatter.MAX_THREADS = orig_max_threads
+        assert isinstance(got[0].error, scatter.NodeTimeoutError)
+        for r in got[1:]:
+            assert isinstance(r.error, scatter.NoThreadError)
+        eq_(
+            str(got[1].error),
+            'No thread left to query node: node %r' % u'node2',
+            )
+        for i in range(100):
+            if not scatter._thread_count:
+                break
+            time.sleep(0.01)
+        eq_(scatter._thread_count, 0)
+        hive_metadata.bind.dispose()
@@ -0,0 +1,190 @@
+from nose.tools import eq_
+
+import os
+
+from snakepit import create, connect, secondary
+
+from snakepit.test.util import maketemp, assert_raises
+
+def make_hive(tmp):
+    hive_metadata = create.create_hive(
+        'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+    directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+    directory_metadata = create.create_primary_index(
+        directory_uri=directory_uri,
+        dimension_name='user',
+        db_type='INTEGER',
+        )
+    directory_metadata.bind.dispose()
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='user',
+        directory_uri=directory_uri,
+        db_type='INTEGER',
+        )
+    for name in ['node1', 'node2']:
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri='sqlite:///%s' % os.path.join(tmp, name+'.db'),
+            )
+    create.create_resource(
+        hive_metadata=hive_metadata,
+        dimension_name='user',
+        resource_name='blogpost',
+        db_type='INTEGER',
+        )
+    create.create_secondary_index(
+        hive_metadata=hive_metadata,
+        resource_name='blogpost',
+        column_name='tag',
+        db_type='CHAR',
+        )
+    return hive_metadata
+
+class Secondary_Test(object):
+
+    def tearDown(self):
+        connect.disable_directory_cache()
+
+    def check_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        user_engines = dict(
+            [(user_id, connect.assign_node(hive_metadata, 'user', user_id))
+             for user_id in [1, 2, 3]])
+
+        # blogpost id -> user id
+        secondary.insert_resource_ids(
+            hive_metadata=hive_metadata,
+            resource_name='blogpost',
+            resource_ids=[(10, 1), (11, 1), (20, 2), (30, 3)],
+            )
+        eq_(
+            secondary.get_dimension_values_bulk(
+                hive_metadata, 'blogpost', [10, 20, 40]),
+            {10: 1, 20: 2},
+            )
+
+        secondary.insert_secondary_keys(
+            hive_metadata=hive_metadata,
+            resource_name='blogpost',
+            column_name='tag',
+            keys=[('cats', 10), ('cats', 20), ('dogs', 11), ('dogs', 10)],
+            )
+        eq_(
+            secondary.get_resource_ids_bulk(
+                hive_metadata, 'blogpost', 'tag', ['cats', 'dogs', 'cows']),
+            {'cats': [10, 20], 'dogs': [10, 11]},
+            )
+
+        (got, missing) = secondary.get_engines_by_secondary_bulk(
+            hive_metadata=hive_metadata,
+            resource_name='blogpost',
+            column_name='tag',
+            values=['cats', 'dogs', 'cows'],
+            )
+        want = {}
+        for tag, user_ids in [('cats', [1, 2]), ('dogs', [1])]:
+            for engine in set([user_engines[u] for u in user_ids]):
+                want.setdefault(engine, []).append(tag)
+        eq_(got, want)
+        eq_(missing, set(['cows']))
+
+        eq_(
+            secondary.get_engines_by_secondary(
+                hive_metadata, 'blogpost', 'tag', 'dogs'),
+            [user_engines[1]],
+            )
+
+        secondary.delete_secondary_keys(
+            hive_metadata=hive_metadata,
+            resource_name='blogpost',
+            column_name='tag',
+            keys=[('dogs', 10), ('dogs', 11)],
+            )
+        e = assert_raises(
+            connect.NoSuchIdError,
+            secondary.get_engines_by_secondary,
+            hive_metadata, 'blogpost', 'tag', 'dogs',
+            )
+        eq_(
+            str(e),
+            'No such id: resource %r, column %r, value %r'
+            % ('blogpost', 'tag', 'dogs'),
+            )
+
+        secondary.delete_resource_ids(hive_metadata, 'blogpost', [20])
+        eq_(
+            secondary.get_engines_by_secondary(
+                hive_metadata, 'blogpost', 'tag', 'cats'),
+            [user_engines[1]],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_simple(self):
+        self.check_simple()
+
+    def test_cached(self):
+        directory_cache = connect.configure_directory_cache()
+        self.check_simple()
+        assert directory_cache.hits > 0
+
+    def test_partitioning_resource(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        create.create_resource(
+            hive_metadata=hive_metadata,
+            dimension_name='user',
+            resource_name='profile',
+            db_type='INTEGER',
+            is_partitioning_resource=True,
+            )
+        create.create_secondary_index(
+            hive_metadata=hive_metadata,
+            resource_name='profile',
+            column_name='email',
+            db_type='CHAR',
+            )
+        node_engine = connect.assign_node(hive_metadata, 'user', 1)
+        # nothing to store, the resource id is the user id
+        secondary.insert_resource_ids(
+            hive_metadata, 'profile', [(1, 1)])
+        secondary.insert_secondary_keys(
+            hive_metadata=hive_metadata,
+            resource_name='profile',
+            column_name='email',
+            keys=[('jdoe@example.com', 1)],
+            )
+        eq_(
+            secondary.get_engines_by_secondary(
+                hive_metadata, 'profile', 'email', 'jdoe@example.com'),
+            [node_engine],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_bad_resource(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        e = assert_raises(
+            secondary.NoSuchResourceError,
+            secondary.get_engines_by_secondary,
+            hive_metadata, 'xyzzy', 'tag', 'cats',
+            )
+        eq_(str(e), 'No such resource: %r' % 'xyzzy')
+        hive_metadata.bind.dispose()
+
+    def test_bad_secondary_index(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        e = assert_raises(
+            secondary.NoSuchSecondaryIndexError,
+            secondary.get_engines_by_secondary,
+            hive_metadata, 'blogpost', 'xyzzy', 'cats',
+            )
+        eq_(
+            str(e),
+            'No such secondary index: %r.%r' % ('blogpost', 'xyzzy'),
+            )
+        hive_metadata.bind.dispose()
@@ -0,0 +1,112 @@
+from nose.tools import eq_
+
+import threading
+import time
+
+from snakepit import connect, cache, singleflight
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+
+def wait_for_waiters(flight, key, count):
+    for i in range(500):
+        call = flight._calls.get(key)
+        if call is not None and call.waiters >= count:
+            return
+        time.sleep(0.01)
+    raise AssertionError('waiters never arrived')
+
+def run_threads(count, fn):
+    results = []
+    def run():
+        try:
+            results.append(fn())
+        except Exception, e:
+            results.append(e)
+    threads = [threading.Thread(target=run) for i in range(count)]
+    for t in threads:
+        t.start()
+    return (threads, results)
+
+class SingleFlight_Test(object):
+
+    def test_shared(self):
+        flight = singleflight.SingleFlight()
+        release = threading.Event()
+        calls = []
+        def fn():
+            calls.append(1)
+            release.wait()
+            return 42
+        (threads, results) = run_threads(5, lambda: flight.do('k', fn))
+        wait_for_waiters(flight, 'k', 4)
+        release.set()
+        for t in threads:
+            t.join()
+        eq_(len(calls), 1)
+        eq_(results, [42]*5)
+        eq_(flight._calls, {})
+
+    def test_error(self):
+        flight = singleflight.SingleFlight()
+        release = threading.Event()
+        def fn():
+            release.wait()
+            raise ValueError('frob')
+        (threads, results) = run_threads(3, lambda: flight.do('k', fn))
+        wait_for_waiters(flight, 'k', 2)
+        release.set()
+        for t in threads:
+            t.join()
+        eq_([str(e) for e in results], ['frob']*3)
+        for e in results:
+            assert isinstance(e, ValueError)
+
+    def test_not_cached(self):
+        flight = singleflight.SingleFlight()
+        calls = []
+        def fn():
+            calls.append(1)
+            return len(calls)
+        eq_(flight.do('k', fn), 1)
+        eq_(flight.do('k', fn), 2)
+
+class Lookup_Coalescing_Test(object):
+
+    def setUp(self):
+        self.orig_query_node = connect._query_node
+
+    def tearDown(self):
+        connect._query_node = self.orig_query_node
+
+    def test_get_engine(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+
+        release = threading.Event()
+        calls = []
+        def slow_query_node(**kw):
+            calls.append(kw['dimension_value'])
+            release.wait()
+            return self.orig_query_node(**kw)
+        connect._query_node = slow_query_node
+
+        (threads, results) = run_threads(
+            5,
+            lambda: connect.get_engine(hive_metadata, 'frob', 1),
+            )
+        wait_for_waiters(
+            connect._lookups,
+            (cache.get_cache(hive_metadata).get_dimension(
+                    'frob').index_uri, 'frob', 1),
+            4,
+            )
+        release.set()
+        for t in threads:
+            t.join()
+        eq_(calls, [1])
+        eq_(len(results), 5)
+        for got in results:
+            assert got is node_engine
+        hive_metadata.bind.dispose()
@@ -0,0 +1,226 @@
+from nose.tools import eq_
+
+import os
+
+from snakepit import create, connect, cache, snapshot
+
+from snakepit.test.util import maketemp, assert_raises
+
+def make_hive(tmp, db_type='INTEGER'):
+    hive_metadata = create.create_hive(
+        'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+    directory_uri = 'sqlite:///%s' % os.path.join(tmp, 'directory.db')
+    directory_metadata = create.create_primary_index(
+        directory_uri=directory_uri,
+        dimension_name='frob',
+        db_type=db_type,
+        )
+    directory_metadata.bind.dispose()
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri=directory_uri,
+        db_type=db_type,
+        )
+    for name in ['node1', 'node2']:
+        create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name=name,
+            node_uri='sqlite:///%s' % os.path.join(tmp, '%s.db' % name),
+            )
+    return hive_metadata
+
+def unassign(hive_metadata, value):
+    node_engine = connect.get_engine(hive_metadata, 'frob', value)
+    c = cache.get_cache(hive_metadata)
+    (node,) = [
+        node for node in c.get_nodes(c.get_dimension('frob'))
+        if node.uri == str(node_engine.url)
+        ]
+    connect.unassign_node(hive_metadata, 'frob', value, node.name)
+
+class Snapshot_Test(object):
+
+    def tearDown(self):
+        connect.snapshots.clear()
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        by_engine = connect.assign_nodes_bulk(
+            hive_metadata, 'frob', [5, 3, 9, 1])
+        path = os.path.join(tmp, 'frob.snap')
+        got = snapshot.write_snapshot(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            path=path,
+            )
+        eq_(got, 4)
+        eq_(os.path.getsize(path), 32 + 4*12)
+
+        snap = snapshot.Snapshot(path)
+        eq_(len(snap), 4)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        for node_engine, values in by_engine.items():
+            for value in values:
+                node = c.get_node(dimension, snap.lookup(value))
+                eq_(node.uri, str(node_engine.url))
+        eq_(snap.lookup(0), None)
+        eq_(snap.lookup(4), None)
+        eq_(snap.lookup(10), None)
+        eq_(snap.lookup('3'), None)
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_empty(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        path = os.path.join(tmp, 'frob.snap')
+        eq_(snapshot.write_snapshot(hive_metadata, 'frob', path), 0)
+        snap = snapshot.Snapshot(path)
+        eq_(len(snap), 0)
+        eq_(snap.lookup(1), None)
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_routing(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        path = os.path.join(tmp, 'frob.snap')
+        snapshot.write_snapshot(hive_metadata, 'frob', path)
+        snap = snapshot.Snapshot(path)
+        connect.use_snapshot(hive_metadata, 'frob', snap)
+
+        # found in the snapshot, without asking the directory
+        c = cache.get_cache(hive_metadata)
+        t_primary = c.get_primary_table(c.get_dimension('frob'))
+        t_primary.delete().execute()
+        assert connect.get_engine(hive_metadata, 'frob', 1) is node_engine
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1, 2]),
+            ({node_engine: [1]}, set([2])),
+            )
+
+        # assigned after the snapshot
+        other = connect.assign_node(hive_metadata, 'frob', 2)
+        assert connect.get_engine(hive_metadata, 'frob', 2) is other
+
+        assert connect.drop_snapshot(hive_metadata, 'frob') is snap
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_changed_since(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        gone_engine = connect.assign_node(hive_metadata, 'frob', 1)
+        node_engine = connect.assign_node(hive_metadata, 'frob', 2)
+        c = cache.get_cache(hive_metadata)
+        (gone,) = [
+            node for node in c.get_nodes(c.get_dimension('frob'))
+            if node.uri == str(gone_engine.url)
+            ]
+        path = os.path.join(tmp, 'frob.snap')
+        snapshot.write_snapshot(hive_metadata, 'frob', path)
+        snap = snapshot.Snapshot(path)
+        connect.use_snapshot(hive_metadata, 'frob', snap)
+        snap.poll_interval = 0
+
+        # unassigned after the snapshot, the directory knows better
+        connect.unassign_node(hive_metadata, 'frob', 1, gone.name)
+        eq_(snap.lookup(1), None)
+        assert_raises(
+            connect.NoSuchIdError,
+            connect.get_engine,
+            hive_metadata,
+            'frob',
+            1,
+            )
+        eq_(
+            connect.get_engines_bulk(hive_metadata, 'frob', [1, 2]),
+            ({node_engine: [2]}, set([1])),
+            )
+        assert connect.drop_snapshot(hive_metadata, 'frob') is snap
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_checking(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_node(hive_metadata, 'frob', 1)
+        path = os.path.join(tmp, 'frob.snap')
+        snapshot.write_snapshot(hive_metadata, 'frob', path)
+        snap = snapshot.Snapshot(path)
+        snap.follow(hive_metadata, 'frob', poll_interval=0, overlap=0)
+        assert snap.lookup(1) is not None
+
+        # another lookup is checking, go with what is known
+        snap._lock.acquire()
+        try:
+            unassign(hive_metadata, 1)
+            assert snap.lookup(1) is not None
+        finally:
+            snap._lock.release()
+        eq_(snap.lookup(1), None)
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_stale(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        connect.assign_nodes_bulk(hive_metadata, 'frob', [1, 2, 3])
+        path = os.path.join(tmp, 'frob.snap')
+        snapshot.write_snapshot(hive_metadata, 'frob', path)
+        snap = snapshot.Snapshot(path)
+        snap.follow(
+            hive_metadata, 'frob', poll_interval=0, overlap=0, max_changed=1)
+        assert snap.lookup(3) is not None
+        eq_(snap.stale, False)
+
+        for value in [1, 2]:
+            unassign(hive_metadata, value)
+        eq_(snap.lookup(3), None)
+        eq_(snap.stale, True)
+        eq_(snap._changed, set())
+        snap.close()
+        hive_metadata.bind.dispose()
+
+    def test_bad_type(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp, db_type='VARCHAR')
+        e = assert_raises(
+            snapshot.UnsupportedDimensionTypeError,
+            snapshot.write_snapshot,
+            hive_metadata,
+            'frob',
+            os.path.join(tmp, 'frob.snap'),
+            )
+        eq_(
+            str(e),
+            'Only dimensions with integer values can be snapshotted:'
+            ' dimension %r, db_type VARCHAR' % 'frob',
+            )
+        assert not os.path.exists(os.path.join(tmp, 'frob.snap'))
+        hive_metadata.bind.dispose()
+
+    def test_bad_file(self):
+        tmp = maketemp()
+        path = os.path.join(tmp, 'frob.snap')
+        f = file(path, 'wb')
+        f.write('not a snapshot, but long enough to have a header')
+        f.close()
+        e = assert_raises(
+            snapshot.BadSnapshotError,
+            snapshot.Snapshot,
+            path,
+            )
+        eq_(str(e), 'Not a directory snapshot: %r' % path)
@@ -0,0 +1,170 @@
+from nose.tools import eq_
+
+import os
+import sqlalchemy as sq
+
+from snakepit import create, connect, cache, placement, statistics
+
+from snakepit.test.util import maketemp, assert_raises
+from snakepit.test.test_snapshot import make_hive
+from snakepit.test import test_buckets, test_ranges
+
+class Collect_Test(object):
+
+    def tearDown(self):
+        connect.configure_placement(placement.RandomPlacement())
+
+    def test_simple(self):
+        tmp = maketemp()
+
+        hive_metadata = create.create_hive(
+            'sqlite:///%s' % os.path.join(tmp, 'hive.db'))
+        directory_metadata = create.create_primary_index(
+            directory_uri='sqlite:///%s' % os.path.join(tmp, 'directory.db'),
+            dimension_name='frob',
+            db_type='INTEGER',
+            )
+        dimension_id = create.create_dimension(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            directory_uri=str(directory_metadata.bind.url),
+            db_type='INTEGER',
+            )
+        directory_metadata.bind.dispose()
+        node1_id = create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node1',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'node1.db'),
+            )
+        connect.assign_nodes_bulk(hive_metadata, 'frob', range(5))
+        node2_id = create.create_node(
+            hive_metadata=hive_metadata,
+            dimension_id=dimension_id,
+            node_name='node2',
+            node_uri='sqlite:///%s' % os.path.join(tmp, 'node2.db'),
+            )
+
+        got = statistics.collect(hive_metadata, 'frob')
+        eq_(
+            [(s.node_id, s.record_count) for s in got],
+            [(node1_id, 5), (node2_id, 0)],
+            )
+        for s in got:
+            assert s.latency >= 0
+
+        t = hive_metadata.tables['node_statistics']
+        q = sq.select(
+            [t.c.node_id, t.c.record_count],
+            order_by=[t.c.node_id],
+            )
+        eq_(
+            [tuple(row) for row in q.execute().fetchall()],
+            [(node1_id, 5), (node2_id, 0)],
+            )
+
+        # collecting again replaces the rows
+        statistics.collect(hive_metadata, 'frob')
+        eq_(len(t.select().execute().fetchall()), 2)
+
+        # the new node catches up
+        connect.configure_placement(placement.LeastRecordsPlacement())
+        got = connect.assign_nodes_bulk(hive_metadata, 'frob', range(5, 10))
+        got = dict(
+            [(str(engine.url), sorted(values))
+             for engine, values in got.items()])
+        eq_(
+            got,
+            {
+                'sqlite:///%s' % os.path.join(tmp, 'node2.db'):
+                    [5, 6, 7, 8, 9],
+                },
+            )
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(
+            [c.get_statistics(node).record_count
+             for node in c.get_nodes(dimension)],
+            [5, 5],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_buckets(self):
+        tmp = maketemp()
+        hive_metadata = test_buckets.make_hive(tmp)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        (node1, node2) = c.get_nodes(dimension)
+        t = hive_metadata.tables['bucket_metadata']
+        for (bucket, node) in [(0, node1), (1, node1), (2, node2)]:
+            t.insert().execute(
+                partition_dimension_id=dimension.id,
+                bucket=bucket,
+                node_id=node.id,
+                )
+        got = statistics.collect(hive_metadata, 'frob')
+        eq_(
+            [(s.node_id, s.record_count) for s in got],
+            [(node1.id, 2), (node2.id, 1)],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_ranges(self):
+        tmp = maketemp()
+        hive_metadata = test_ranges.make_hive(tmp)
+        e = assert_raises(
+            connect.UnsupportedPartitioningError,
+            statistics.collect,
+            hive_metadata,
+            'frob',
+            )
+        eq_(
+            str(e),
+            'Not possible with the partitioning of the dimension:'
+            ' dimension %r, partitioning range' % 'frob',
+            )
+        t = hive_metadata.tables['node_statistics']
+        eq_(t.select().execute().fetchall(), [])
+        hive_metadata.bind.dispose()
+
+    def test_retry(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        picks = []
+        class Conflicting(placement.LeastRecordsPlacement):
+            def pick(self, nodes, get_statistics):
+                picks.append(True)
+                if len(picks) == 2:
+                    # as if someone else assigned the second value at
+                    # the same time, after the first was picked
+                    raise sq.exc.IntegrityError('INSERT', [], None)
+                return super(Conflicting, self).pick(nodes, get_statistics)
+        connect.configure_placement(Conflicting())
+        connect.assign_nodes_bulk(hive_metadata, 'frob', range(4))
+        eq_(len(picks), 6)
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        # spread within the transaction, counted once it committed
+        eq_(
+            [c.get_statistics(node).record_count
+             for node in c.get_nodes(dimension)],
+            [2, 2],
+            )
+        hive_metadata.bind.dispose()
+
+    def test_old_hive(self):
+        tmp = maketemp()
+        hive_metadata = make_hive(tmp)
+        # not upgraded yet
+        hive_metadata.tables['node_statistics'].drop()
+
+        connect.configure_placement(placement.LeastRecordsPlacement())
+        connect.assign_nodes_bulk(hive_metadata, 'frob', range(4))
+        c = cache.get_cache(hive_metadata)
+        dimension = c.get_dimension('frob')
+        eq_(
+            [c.get_statistics(node).record_count
+             for node in c.get_nodes(dimension)],
+            [2, 2],
+            )
+        hive_metadata.bind.dispose()
@@ -0,0 +1,143 @@
+from nose.tools import eq_
+
+import datetime
+import os
+import sqlalchemy as sq
+
+from snakepit import create, connect, cache, upgrade
+
+from snakepit.test.util import maketemp, assert_raises
+
+def make_old_directory(tmp, ids):
+    hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+    hive_metadata = create.create_hive(hive_uri)
+    engine = sq.create_engine(hive_uri)
+    # what create_primary_index used to make
+    engine.execute(
+        'CREATE TABLE hive_primary_frob ('
+        ' node SMALLINT NOT NULL,'
+        ' secondary_index_count INTEGER NOT NULL,'
+        ' last_updated TIMESTAMP NOT NULL,'
+        ' read_only BOOLEAN NOT NULL,'
+        ' id INTEGER NOT NULL)')
+    for id_ in ids:
+        engine.execute(
+            'INSERT INTO hive_primary_frob VALUES (1, 0, ?, 0, ?)',
+            datetime.datetime.now(), id_)
+    engine.dispose()
+    dimension_id = create.create_dimension(
+        hive_metadata=hive_metadata,
+        dimension_name='frob',
+        directory_uri=hive_uri,
+        db_type='INTEGER',
+        )
+    create.create_node(
+        hive_metadata=hive_metadata,
+        dimension_id=dimension_id,
+        node_name='node1',
+        node_uri='sqlite://',
+        )
+    return hive_metadata
+
+class AddDirectoryKey_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_old_directory(tmp, [1, 2, 3])
+        messages = []
+        got = upgrade.add_directory_key(
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            report=messages.append,
+            )
+        eq_(got, 'ix_hive_primary_frob_id')
+        eq_(messages[0], 'hive_primary_frob: 3 rows')
+        assert messages[-1].startswith('hive_primary_frob: done in ')
+
+        res = hive_metadata.bind.execute(
+            "SELECT sql FROM sqlite_master WHERE name=?", got)
+        (sql,) = res.fetchone()
+        res.close()
+        eq_(
+            sql,
+            'CREATE UNIQUE INDEX ix_hive_primary_frob_id'
+            ' ON hive_primary_frob (id)',
+            )
+
+        # lookups still work
+        node_engine = connect.get_engine(hive_metadata, 'frob', 2)
+        eq_(str(node_engine.url), 'sqlite://')
+        hive_metadata.bind.dispose()
+
+    def test_duplicates(self):
+        tmp = maketemp()
+        hive_metadata = make_old_directory(tmp, [1, 2, 2, 3, 3])
+        e = assert_raises(
+            upgrade.DuplicateIdsError,
+            upgrade.add_directory_key,
+            hive_metadata=hive_metadata,
+            dimension_name='frob',
+            )
+        eq_(
+            str(e),
+            'Directory has ids assigned to more than one node:'
+            ' dimension %r, ids 2, 3' % 'frob',
+            )
+        hive_metadata.bind.dispose()
+
+class AddTombstoneTable_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_metadata = make_old_directory(tmp, [1])
+        messages = []
+        for i in range(2):
+            got = upgrade.add_tombstone_table(
+                hive_metadata=hive_metadata,
+                dimension_name='frob',
+                report=messages.append,
+                )
+            eq_(got, 'hive_tombstone_frob')
+        eq_(
+            messages,
+            ['hive_tombstone_frob: creating table if missing'] * 2,
+            )
+        connect.unassign_node(hive_metadata, 'frob', 1, 'node1')
+        res = hive_metadata.bind.execute(
+            'SELECT id, node FROM hive_tombstone_frob')
+        eq_([tuple(row) for row in res.fetchall()], [(1, 1)])
+        res.close()
+        hive_metadata.bind.dispose()
+
+class UpgradeHive_Test(object):
+
+    def test_simple(self):
+        tmp = maketemp()
+        hive_uri = 'sqlite:///%s' % os.path.join(tmp, 'hive.db')
+        engine = sq.create_engine(hive_uri)
+        # partition_dimension_metadata as in the HiveDB schema
+        engine.execute(
+            'CREATE TABLE partition_dimension_metadata ('
+            ' id INTEGER NOT NULL PRIMARY KEY,'
+            ' name VARCHAR(64) NOT NULL UNIQUE,'
+            ' index_uri VARCHAR(255) NOT NULL,'
+            ' db_type VARCHAR(64) NOT NULL)')
+        engine.execute(
+            "INSERT INTO partition_dimension_metadata"
+            " VALUES (1, 'frob', 'sqlite://', 'INTEGER')")
+        engine.dispose()
+
+        hive_metadata = connect.get_hive(hive_uri)
+        messages = []
+        upgrade.upgrade_hive(hive_metadata, report=messages.append)
+        assert 'partition_dimension_metadata: adding column partitioning' \
+            in messages
+        assert 'bucket_metadata: creating table' in messages
+        dimension = cache.get_cache(hive_metadata).get_dimension('frob')
+        eq_(dimension.partitioning, 'directory')
+
+        # nothing left to do
+        messages = []
+        upgrade.upgrade_hive(hive_metadata, report=messages.append)
+        eq_(messages, [])
+        hive_metadata.bind.dispose()
@@ -0,0 +1,166 @@
+"""
+Bring existing directories up to date with the current schema.
+"""
+
+import time
+
+import sqlalchemy as sq
+
+from snakepit import cache, connect
+
+class DuplicateIdsError(Exception):
+    """Directory has ids assigned to more than one node"""
+
+    def __str__(self):
+        return ': '.join([self.__doc__]+list(self.args))
+
+def _ignore(message):
+    pass
+
+def _create_unique_index(t_primary, index_name):
+    engine = t_primary.bind
+    name = engine.dialect.name
+    if name == 'mysql':
+        # build the index without blocking writes
+        engine.execute(
+            'ALTER TABLE %s ADD UNIQUE INDEX %s (id),'
+            ' ALGORITHM=INPLACE, LOCK=NONE'
+            % (t_primary.name, index_name))
+    elif name in ('postgres', 'postgresql'):
+        # CONCURRENTLY can't run inside a transaction block
+        conn = engine.raw_connection()
+        try:
+            isolation_level = conn.connection.isolation_level
+            # autocommit
+            conn.connection.set_isolation_level(0)
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (id)'
+                    % (index_name, t_primary.name))
+                cursor.close()
+            finally:
+                # the connection goes back to the pool
+                conn.connection.set_isolation_level(isolation_level)
+        finally:
+            conn.close()
+    else:
+        sq.Index(index_name, t_primary.c.id, unique=True).create()
+
+def add_directory_key(hive_metadata, dimension_name, report=_ignore):
+    """
+    Add a unique index on C{id} to the primary index of
+    C{dimension_name}.
+
+    Directories created by older versions have no index on C{id},
+    making every lookup a full table scan. Where the database
+    supports it, the index is built without blocking writes.
+
+    @param report: called with a progress message for each step
+
+    @type report: callable
+
+    @return: name of the created index
+
+    @rtype: str
+
+    @raise DuplicateIdsError: some ids are assigned to several nodes,
+    and have to be cleaned up by hand first
+    """
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    t_primary = c.get_primary_table(dimension)
+    index_name = 'ix_%s_id' % t_primary.name
+    start = time.time()
+
+    q = sq.select(
+        [sq.func.count('*').label('count')],
+        from_obj=[t_primary],
+        )
+    count = q.execute().fetchone()['count']
+    report('%s: %d rows' % (t_primary.name, count))
+
+    report('%s: checking for duplicate ids' % t_primary.name)
+    q = sq.select(
+        [t_primary.c.id],
+        group_by=[t_primary.c.id],
+        having=sq.func.count('*') > 1,
+        limit=10,
+        )
+    duplicates = [row[t_primary.c.id] for row in q.execute().fetchall()]
+    if duplicates:
+        raise DuplicateIdsError(
+            'dimension %r, ids %s'
+            % (dimension_name, ', '.join([repr(d) for d in duplicates])))
+
+    report('%s: creating index %s' % (t_primary.name, index_name))
+    _create_unique_index(t_primary, index_name)
+    report(
+        '%s: done in %.1f seconds'
+        % (t_primary.name, time.time() - start))
+    return index_name
+
+def add_tombstone_table(hive_metadata, dimension_name, report=_ignore):
+    """
+    Create the table of values unassigned from the primary index of
+    C{dimension_name}, needed by L{snakepit.connect.unassign_node}
+    since directories remember unassigned values.
+
+    Does nothing if the table exists already.
+
+    @param report: called with a progress message for each step
+
+    @type report: callable
+
+    @return: name of the table
+
+    @rtype: str
+    """
+    c = cache.get_cache(hive_metadata)
+    dimension = c.get_dimension(dimension_name)
+    if dimension is None:
+        raise connect.NoSuchDimensionError(repr(dimension_name))
+    t_tombstone = c.get_tombstone_table(dimension)
+    report('%s: creating table if missing' % t_tombstone.name)
+    t_tombstone.create(checkfirst=True)
+    return t_tombstone.name
+
+def upgrade_hive(hive_metadata, report=_ignore):
+    """
+    Add the tables and columns added to the hive schema since the
+    hive was created.
+
+    New columns are all nullable, so existing rows keep working.
+
+    @param report: called with a progress message for each step
+
+    @type report: callable
+    """
+    engine = hive_metadata.bind
+    for table in hive_metadata.sorted_tables:
+        if not table.exists():
+            report('%s: creating table' % table.name)
+            table.create()
+            continue
+        existing = sq.Table(
+            table.name,
+            sq.MetaData(bind=engine),
+            autoload=True,
+            )
+        for column in table.columns:
+            if column.name in existing.c:
+                continue
+            type_compiler = getattr(engine.dialect, 'type_compiler', None)
+            if type_compiler is not None:
+                # sqlalchemy 0.6
+                col_spec = type_compiler.process(column.type)
+            else:
+                col_spec = engine.dialect.type_descriptor(
+                    column.type).get_col_spec()
+            report('%s: adding column %s' % (table.name, column.name))
+            engine.execute(
+                'ALTER TABLE %s ADD COLUMN %s %s'
+                % (table.name, column.name, col_spec))
+    cache.get_cache(hive_metadata).invalidate()